@@ -1,96 +1,54 @@
-from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit, join_room, leave_room
-from sqlalchemy.pool import NullPool
+from flask import Flask, Blueprint, current_app, render_template, request, jsonify, abort, send_file, Response, stream_with_context
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 import random
 import uuid
 from datetime import datetime
 import os
+import io
 import json
 import sys
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from db_pool import postgres_engine_options, pool_metrics
 
 # Fix encoding for Windows console
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'not-the-end-secret-key-change-in-production')
-
-# Database configuration - PostgreSQL in produzione, SQLite in locale
-DATABASE_URL = os.environ.get('DATABASE_URL')
-if DATABASE_URL:
-    # Render fornisce DATABASE_URL con postgres://, ma SQLAlchemy richiede postgresql://
-    if DATABASE_URL.startswith('postgres://'):
-        DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
-    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-    print(f"🗄️  Using PostgreSQL database")
-    # Configurazione pool per eventlet - usa NullPool per evitare conflitti con greenlets
-    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'poolclass': NullPool  # NullPool crea una nuova connessione per ogni richiesta, evita problemi con eventlet
-    }
-else:
-    # Fallback a SQLite per sviluppo locale
-    # Usa check_same_thread=False per permettere l'uso multi-threaded con eventlet
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///not_the_end.db?check_same_thread=False'
-    print(f"⚠️  DATABASE_URL not found - using SQLite (development only)")
-    # Configurazione pool per SQLite
-    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'pool_pre_ping': True,
-        'pool_recycle': 300,
-    }
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-# Inizializza database
-from models import db, User, Room, RoomPlayer, Character, DrawHistory, Session
-from auth import create_user, login_user, verify_session, logout_user
-
-db.init_app(app)
-
-# Crea tabelle se non esistono e aggiorna schema
-with app.app_context():
-    db.create_all()
-
-    # Migrazione: aggiungi colonne mancanti per PostgreSQL
-    try:
-        with db.engine.connect() as conn:
-            # Verifica e aggiungi is_master a room_players
-            result = conn.execute(db.text("""
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_name='room_players' AND column_name='is_master'
-            """))
-            if not result.fetchone():
-                print("🔄 Aggiunta colonna is_master a room_players...")
-                conn.execute(db.text("ALTER TABLE room_players ADD COLUMN is_master BOOLEAN DEFAULT FALSE"))
-                conn.execute(db.text("""
-                    UPDATE room_players
-                    SET is_master = TRUE
-                    WHERE id IN (
-                        SELECT MIN(id) FROM room_players GROUP BY room_id
-                    )
-                """))
-                conn.commit()
-                print("✅ Colonna is_master aggiunta")
-
-            # Verifica e aggiungi visible_to_all a characters
-            result = conn.execute(db.text("""
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_name='characters' AND column_name='visible_to_all'
-            """))
-            if not result.fetchone():
-                print("🔄 Aggiunta colonna visible_to_all a characters...")
-                conn.execute(db.text("ALTER TABLE characters ADD COLUMN visible_to_all BOOLEAN DEFAULT FALSE"))
-                conn.commit()
-                print("✅ Colonna visible_to_all aggiunta")
-    except Exception as e:
-        print(f"⚠️  Errore durante la migrazione dello schema: {str(e)}")
-        # Non bloccare l'avvio dell'app se la migrazione fallisce
-
-# Cache temporanea per le stanze attive (sacchetto in memoria)
-active_rooms_cache = {}  # room_id: {'bag': {...}, 'adrenaline': {}, 'confusion': {}}
+# Con più worker i broadcast passano dalla coda messaggi (es. redis://...)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+socketio = SocketIO()
+
+# Route HTTP, registrate sull'app da create_app()
+main = Blueprint('main', __name__)
+
+from models import db, User, Room, RoomPlayer, Character, DrawHistory, Session, photo_url
+from auth import create_user, login_user, verify_session, logout_user, session_cache
+from room_state import RoomStateRegistry, BagConflict, bag_metrics
+import draw_engine
+from room_overview import get_user_rooms
+from room_snapshot import get_room_snapshot
+import photo_store
+import history
+import history_archive
+import session_sweeper
+import session_tokens
+import draw_stats
+from state_broadcast import StateBroadcaster
+import wire_format
+import instrumentation
+import migrations
+import sqlite_mode
+
+# Stato delle stanze attive (sacchetto, adrenalina, confusione) in memoria.
+# È la fonte autoritativa durante il gioco e viene salvato sul database in
+# modo asincrono ogni BAG_FLUSH_INTERVAL secondi e allo spegnimento.
+active_rooms_cache = RoomStateRegistry()
+
+# Aggiornamenti di adrenalina/confusione raggruppati in un solo broadcast
+state_broadcaster = StateBroadcaster(socketio)
 
 # Dizionario per generare meteo
 METEO_DATA = {
@@ -133,12 +91,156 @@ METEO_DATA = {
 }
 
 
-@app.route('/')
+@main.route('/')
 def index():
     """Pagina principale"""
     return render_template('index.html')
 
 
+@main.route('/photos', methods=['POST'])
+def upload_photo():
+    """Carica una foto personaggio e restituisce la sua URL (richiede una sessione)"""
+    session_id = request.form.get('session_id') or request.headers.get('X-Session-Id')
+    if not session_id:
+        return jsonify({'error': 'Sessione non valida'}), 401
+    user, error = verify_session(session_id)
+    if error:
+        return jsonify({'error': error}), 401
+
+    file = request.files.get('photo')
+    if not file:
+        return jsonify({'error': 'Nessuna foto inviata'}), 400
+
+    try:
+        photo_hash = photo_store.store_photo(
+            file.read(photo_store.PHOTO_MAX_BYTES + 1),
+            file.mimetype
+        )
+        db.session.commit()
+    except photo_store.InvalidPhoto as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except IntegrityError:
+        # La stessa foto è stata salvata in parallelo: è già nell'archivio
+        db.session.rollback()
+        if photo_store.get_photo(photo_hash) is None:
+            raise
+
+    return jsonify({'id': photo_hash, 'url': photo_url(photo_hash)})
+
+
+@main.route('/photos/<photo_hash>')
+def get_photo(photo_hash):
+    """Serve una foto dall'archivio (contenuto immutabile)"""
+    photo = photo_store.get_photo(photo_hash)
+    if not photo:
+        abort(404)
+
+    response = send_file(
+        io.BytesIO(photo.data),
+        mimetype=photo.mime_type,
+        etag=photo.hash,
+        max_age=31536000,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def _parse_flag(value):
+    """Filtro booleano opzionale da query string (None = nessun filtro)"""
+    if value is None or value == '':
+        return None
+    return value.lower() in ('1', 'true', 'yes')
+
+
+@main.route('/api/rooms/<room_id>/history')
+def api_room_history(room_id):
+    """Storico della stanza paginato a cursore (equivalente HTTP di get_history)"""
+    state = active_rooms_cache.get(room_id)
+    if not state:
+        return jsonify({'error': 'Stanza non trovata'}), 404
+
+    # Lo storico in sospeso deve essere sul database prima di leggerlo
+    active_rooms_cache.flush(room_id)
+
+    try:
+        entries, next_cursor = history.get_history_page(
+            state.room_pk,
+            cursor=request.args.get('cursor'),
+            limit=request.args.get('limit', type=int),
+            player=request.args.get('player'),
+            **{flag: _parse_flag(request.args.get(flag)) for flag in history.FLAG_FILTERS}
+        )
+    except history.InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'room_id': room_id, 'entries': entries, 'next_cursor': next_cursor})
+
+
+@main.route('/api/rooms/<room_id>/history/archive')
+def api_room_history_archive(room_id):
+    """Storico archiviato della stanza come flusso NDJSON, in ordine cronologico"""
+    room = Room.query.filter_by(room_id=room_id).first()
+    if not room:
+        return jsonify({'error': 'Stanza non trovata'}), 404
+
+    def generate():
+        for entry in history_archive.iter_archived_history(room.id):
+            yield json.dumps(entry, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@main.route('/api/rooms/<room_id>/history/archive/summary')
+def api_room_history_archive_summary(room_id):
+    """Contatori dello storico archiviato della stanza"""
+    room = Room.query.filter_by(room_id=room_id).first()
+    if not room:
+        return jsonify({'error': 'Stanza non trovata'}), 404
+
+    summary = room.archive_summary
+    return jsonify({
+        'room_id': room_id,
+        'archived': summary.to_dict() if summary else None
+    })
+
+
+# Servizi del processo che serve i client (vedi start_services)
+_services_started = False
+_services_lock = threading.Lock()
+
+
+def start_services(app):
+    """Controllo dello schema e task periodici, una volta per processo.
+
+    Partono alla prima connessione Socket.IO (o dal server di sviluppo):
+    importare app.py per i test o per gli strumenti (migrate_db.py, flask
+    migrate, benchmark) non interroga il database e non avvia task.
+    """
+    global _services_started
+    with _services_lock:
+        if _services_started:
+            return
+        _services_started = True
+
+    migrations.check_schema(app)
+
+    # Archiviazione periodica dello storico vecchio (vedi history_archive.py)
+    history_archive.init_app(app, socketio)
+
+    # Pulizia periodica delle sessioni scadute (vedi session_sweeper.py)
+    session_sweeper.init_app(app, socketio)
+
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    """Nuova connessione: avvia i servizi del processo se non sono ancora partiti"""
+    if not _services_started:
+        start_services(current_app._get_current_object())
+
+
 @socketio.on('register')
 def handle_register(data):
     """Registrazione nuovo utente"""
@@ -177,37 +279,8 @@ def handle_refresh_rooms(data):
         emit('error', {'message': error})
         return
 
-    # Trova stanze di cui è proprietario
-    owned_rooms = Room.query.filter_by(owner_id=user.id, is_active=True).all()
-
-    # Trova stanze condivise (in cui è giocatore ma non proprietario)
-    shared_room_ids = db.session.query(RoomPlayer.room_id).filter_by(user_id=user.id).distinct().all()
-    shared_rooms = []
-    for (room_id,) in shared_room_ids:
-        room = Room.query.get(room_id)
-        if room and room.is_active and room.owner_id != user.id:
-            shared_rooms.append(room)
-
-    # Prepara dettagli stanze
-    owned_rooms_details = []
-    for room in owned_rooms:
-        my_player = room.players.filter_by(user_id=user.id).first()
-        owned_rooms_details.append({
-            'id': room.room_id,
-            'players': [p.player_name for p in room.players.all()],
-            'created_at': room.created_at.isoformat(),
-            'my_player_name': my_player.player_name if my_player else None
-        })
-
-    shared_rooms_details = []
-    for room in shared_rooms:
-        my_player = room.players.filter_by(user_id=user.id).first()
-        shared_rooms_details.append({
-            'id': room.room_id,
-            'players': [p.player_name for p in room.players.all()],
-            'created_at': room.created_at.isoformat(),
-            'my_player_name': my_player.player_name if my_player else None
-        })
+    # Stanze proprie e condivise (numero fisso di query)
+    owned_rooms_details, shared_rooms_details = get_user_rooms(user.id)
 
     emit('rooms_refreshed', {
         'owned_rooms': owned_rooms_details,
@@ -231,39 +304,8 @@ def handle_login(data):
         emit('error', {'message': error})
         return
 
-    # Ottieni le stanze dell'utente
-    owned_rooms = Room.query.filter_by(owner_id=user.id, is_active=True).all()
-
-    # Stanze condivise (dove l'utente è un giocatore ma non owner)
-    shared_room_ids = db.session.query(RoomPlayer.room_id).filter_by(user_id=user.id).distinct().all()
-    shared_rooms = []
-    for (room_id,) in shared_room_ids:
-        room = Room.query.get(room_id)
-        if room and room.is_active and room.owner_id != user.id:
-            shared_rooms.append(room)
-
-    # Prepara dettagli stanze
-    owned_rooms_details = []
-    for room in owned_rooms:
-        # Trova il nome del giocatore in questa stanza
-        my_player = room.players.filter_by(user_id=user.id).first()
-        owned_rooms_details.append({
-            'id': room.room_id,
-            'players': [p.player_name for p in room.players.all()],
-            'created_at': room.created_at.isoformat(),
-            'my_player_name': my_player.player_name if my_player else None
-        })
-
-    shared_rooms_details = []
-    for room in shared_rooms:
-        # Trova il nome del giocatore in questa stanza
-        my_player = room.players.filter_by(user_id=user.id).first()
-        shared_rooms_details.append({
-            'id': room.room_id,
-            'players': [p.player_name for p in room.players.all()],
-            'created_at': room.created_at.isoformat(),
-            'my_player_name': my_player.player_name if my_player else None
-        })
+    # Ottieni le stanze dell'utente (numero fisso di query)
+    owned_rooms_details, shared_rooms_details = get_user_rooms(user.id)
 
     emit('login_success', {
         'username': username,
@@ -274,6 +316,19 @@ def handle_login(data):
     })
 
 
+@socketio.on('logout')
+def handle_logout(data):
+    """Logout: elimina la sessione sul database o revoca il token"""
+    session_id = data.get('session_id')
+
+    if not session_id:
+        emit('error', {'message': 'Sessione non valida'})
+        return
+
+    logout_user(session_id)
+    emit('logout_success', {})
+
+
 @socketio.on('create_room')
 def handle_create_room(data):
     """Crea una nuova stanza di gioco"""
@@ -313,13 +368,11 @@ def handle_create_room(data):
         db.session.add(new_room)
         db.session.commit()
 
-        # Inizializza cache per la stanza
-        active_rooms_cache[room_id_str] = {
-            'adrenaline': {},
-            'confusion': {}
-        }
+        # Inizializza lo stato in memoria della stanza
+        active_rooms_cache.register(new_room)
 
         join_room(room_id_str)
+        wire_format.join_format_room(room_id_str)
         emit('room_created', {
             'room_id': room_id_str,
             'player_name': player_name,
@@ -338,72 +391,69 @@ def handle_join_room(data):
     player_name = data.get('player_name', 'Giocatore')
     user_id = data.get('user_id')  # ID utente
 
-    # Trova la stanza nel database
-    room = Room.query.filter_by(room_id=room_id_str, is_active=True).first()
+    # Stato in memoria della stanza (database solo al primo accesso)
+    state = active_rooms_cache.get(room_id_str)
 
-    if not room:
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
-    # Verifica limite giocatori
-    if room.players.count() >= 10:
-        emit('error', {'message': 'Stanza piena (max 10 giocatori)'})
-        return
-
-    # Controlla se il giocatore è già nella stanza
-    existing_player = room.players.filter_by(player_name=player_name).first()
+    try:
+        # Dati della stanza dallo snapshot (ricostruito solo se la stanza è cambiata)
+        snapshot = get_room_snapshot(state, active_rooms_cache)
 
-    # Se il nome esiste ma è lo stesso utente, è un re-join (non fare nulla, continua)
-    if existing_player and existing_player.user_id != user_id:
-        emit('error', {'message': f'Nome "{player_name}" già in uso in questa stanza'})
-        return
+        # Verifica limite giocatori
+        if len(snapshot['players']) >= 10:
+            emit('error', {'message': 'Stanza piena (max 10 giocatori)'})
+            return
 
-    # Se il giocatore non è ancora nella stanza, aggiungilo
-    if not existing_player:
-        room_player = RoomPlayer(
-            room_id=room.id,
-            user_id=user_id,
-            player_name=player_name
-        )
-        db.session.add(room_player)
+        # Controlla se il giocatore è già nella stanza
+        existing_user_id = None
+        existing_player = False
+        for name, player_user_id in snapshot['players']:
+            if name == player_name:
+                existing_player = True
+                existing_user_id = player_user_id
+                break
+
+        # Se il nome esiste ma è lo stesso utente, è un re-join (non fare nulla, continua)
+        if existing_player and existing_user_id != user_id:
+            emit('error', {'message': f'Nome "{player_name}" già in uso in questa stanza'})
+            return
 
-    try:
-        # Commit solo se abbiamo aggiunto un nuovo giocatore
+        # Se il giocatore non è ancora nella stanza, aggiungilo
         if not existing_player:
+            room_player = RoomPlayer(
+                room_id=state.room_pk,
+                user_id=user_id,
+                player_name=player_name
+            )
+            db.session.add(room_player)
             db.session.commit()
 
-        # Inizializza cache se non esiste
-        if room_id_str not in active_rooms_cache:
-            active_rooms_cache[room_id_str] = {
-                'adrenaline': {},
-                'confusion': {}
-            }
+            state.bump()
+            snapshot = get_room_snapshot(state, active_rooms_cache)
 
         join_room(room_id_str)
+        wire_format.join_format_room(room_id_str)
 
         # Prepara dati stanza
-        players_list = [p.player_name for p in room.players.all()]
-
-        # Ottieni il nome del proprietario
-        owner_player = room.players.filter_by(user_id=room.owner_id).first()
-        owner_name = owner_player.player_name if owner_player else 'Sconosciuto'
+        players_list = snapshot['players_list']
+        owner_name = snapshot['owner_name']
 
         room_data = {
             'room_id': room_id_str,
             'players': players_list,
             'owner_name': owner_name,
-            'bag': {
-                'successi': room.bag_successi,
-                'complicazioni': room.bag_complicazioni
-            },
-            'history': [h.to_dict() for h in room.history.order_by(DrawHistory.timestamp.desc()).limit(20).all()]
+            'bag': state.bag(),
+            'history': snapshot['history']
         }
 
-        emit('room_joined', {
+        wire_format.emit_to_client('room_joined', {
             'room_id': room_id_str,
             'player_name': player_name,
             'room_data': room_data
-        })
+        }, wire_format.compact_room_joined)
 
         emit('player_joined', {
             'player_name': player_name,
@@ -414,28 +464,41 @@ def handle_join_room(data):
         # Carica scheda personaggio se esiste
         my_character = None
         if user_id:
-            character = Character.query.filter_by(room_id=room.id, user_id=user_id).first()
-            if character:
-                my_character = character.to_dict()
+            my_character = snapshot['characters_by_user'].get(user_id)
 
         emit('my_character_loaded', {
             'character': my_character
         })
 
         # Invia tutte le schede degli altri giocatori
-        characters_dict = {}
-        for char in room.characters.all():
-            characters_dict[char.player_name] = char.to_dict()
-
-        emit('characters_loaded', {
-            'characters': characters_dict
-        })
+        wire_format.emit_to_client('characters_loaded', {
+            'characters': snapshot['characters']
+        }, wire_format.compact_characters_loaded)
 
     except Exception as e:
         db.session.rollback()
         emit('error', {'message': f'Errore nell\'unirsi alla stanza: {str(e)}'})
 
 
+@socketio.on('set_wire_format')
+def handle_set_wire_format(data):
+    """Negozia il formato dei messaggi: 'json' (default) o 'msgpack' compatto"""
+    requested = (data or {}).get('format', wire_format.JSON)
+
+    if requested not in wire_format.available_formats():
+        emit('error', {'message': f'Formato non supportato: {requested}'})
+        return
+
+    # Sposta nelle sotto-stanze del nuovo formato le stanze già aperte
+    room_ids = [room for room in rooms() if room != request.sid and '#' not in room]
+    wire_format.set_format(requested, room_ids)
+
+    emit('wire_format_set', {
+        'format': requested,
+        'available': wire_format.available_formats()
+    })
+
+
 @socketio.on('configure_bag')
 def handle_configure_bag(data):
     """Configura il sacchetto di token"""
@@ -443,27 +506,27 @@ def handle_configure_bag(data):
     successi = int(data.get('successi', 0))
     complicazioni = int(data.get('complicazioni', 0))
 
-    # Trova la stanza nel database
-    room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
 
-    if not room:
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
-    # Aggiorna sacchetto nel database
-    room.bag_successi = successi
-    room.bag_complicazioni = complicazioni
-
+    # Aggiorna sacchetto (salvato sul database in modo asincrono)
     try:
-        db.session.commit()
+        state.set_bag(successi, complicazioni)
+    except BagConflict as e:
+        emit('error', {'message': str(e)})
+        return
 
-        emit('bag_configured', {
-            'successi': successi,
-            'complicazioni': complicazioni
-        }, room=room_id)
-    except Exception as e:
-        db.session.rollback()
-        emit('error', {'message': f'Errore nella configurazione del sacchetto: {str(e)}'})
+    # Cambio di scena: salvato subito
+    active_rooms_cache.flush_now(room_id)
+
+    emit('bag_configured', {
+        'successi': successi,
+        'complicazioni': complicazioni
+    }, room=room_id)
 
 @socketio.on('add_help')
 def handle_add_help(data):
@@ -471,49 +534,50 @@ def handle_add_help(data):
     room_id = data.get('room_id')
     player_name = data.get('player_name', 'Giocatore')
 
-    # Trova la stanza nel database
-    room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
 
-    if not room:
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
     # Aggiungi 1 token bianco
-    room.bag_successi += 1
-
     try:
-        db.session.commit()
+        bag = state.update_bag(lambda successi, complicazioni: (
+            successi + 1, complicazioni,
+            {'successi': successi + 1, 'complicazioni': complicazioni}
+        ))
+    except BagConflict as e:
+        emit('error', {'message': str(e)})
+        return
 
-        # Broadcast a tutti nella stanza
-        emit('help_added', {
-            'helper': player_name,
-            'bag': {
-                'successi': room.bag_successi,
-                'complicazioni': room.bag_complicazioni
-            }
-        }, room=room_id)
-    except Exception as e:
-        db.session.rollback()
-        emit('error', {'message': f'Errore nell\'aggiungere aiuto: {str(e)}'})
+    # Broadcast a tutti nella stanza
+    emit('help_added', {
+        'helper': player_name,
+        'bag': bag
+    }, room=room_id)
 
 @socketio.on('draw_tokens')
 def handle_draw_tokens(data):
     """Estrai token dal sacchetto con supporto adrenalina e confusione"""
     try:
         room_id = data.get('room_id')
-        num_tokens = data.get('num_tokens', 1)
         player_name = data.get('player_name', 'Giocatore')
         adrenaline = data.get('adrenaline', False)
         confusion = data.get('confusion', False)
+        num_tokens = draw_engine.effective_num_tokens(data.get('num_tokens', 1), adrenaline)
 
         print(f"🎲 draw_tokens ricevuto: room={room_id}, tokens={num_tokens}, player={player_name}, adrenaline={adrenaline}, confusion={confusion}")
 
-        # Trova la stanza nel database
-        room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+        # Trova la stanza in memoria
+        state = active_rooms_cache.get(room_id)
 
-        if not room:
+        if not state:
             emit('error', {'message': 'Stanza non trovata'})
             return
+    except draw_engine.InvalidDraw as e:
+        emit('error', {'message': str(e)})
+        return
     except Exception as e:
         print(f"❌ Errore in draw_tokens (inizio): {e}")
         import traceback
@@ -521,103 +585,37 @@ def handle_draw_tokens(data):
         emit('error', {'message': f'Errore: {str(e)}'})
         return
 
+    def draw_from(bag_successi, bag_complicazioni):
+        # Estrazione in un solo passo (adrenalina forza 4 token)
+        outcome = draw_engine.draw(
+            bag_successi, bag_complicazioni, num_tokens,
+            adrenaline=adrenaline,
+            confusion=confusion
+        )
+        return outcome.bag_successi, outcome.bag_complicazioni, (outcome, bag_successi + bag_complicazioni)
+
     try:
-        # Usa i valori del database
-        bag_successi = room.bag_successi
-        bag_complicazioni = room.bag_complicazioni
-
-        # Adrenalina forza 4 token
-        if adrenaline:
-            num_tokens = 4
-
-        # Verifica che ci siano abbastanza token
-        total_tokens = bag_successi + bag_complicazioni
-        if total_tokens < num_tokens:
-            emit('error', {'message': 'Non ci sono abbastanza token nel sacchetto'})
+        # Aggiorna il sacchetto con compare-and-set (riprova se cambia nel frattempo)
+        try:
+            outcome, bag_size = state.update_bag(draw_from)
+        except (draw_engine.NotEnoughTokens, BagConflict) as e:
+            emit('error', {'message': str(e)})
             return
 
-        # ========== GESTIONE CONFUSIONE ==========
-        if confusion:
-            # Con confusione: i token BIANCHI diventano random
-            # I token NERI restano neri
-
-            drawn = []
-            temp_successi = bag_successi
-            temp_complicazioni = bag_complicazioni
-
-            for _ in range(num_tokens):
-                if temp_successi + temp_complicazioni == 0:
-                    break
-
-                # Estrai un token
-                total = temp_successi + temp_complicazioni
-                rand = random.random()
-
-                if rand < temp_complicazioni / total:
-                    # Estratto un NERO (resta nero)
-                    drawn.append('complicazione')
-                    temp_complicazioni -= 1
-                    bag_complicazioni -= 1
-                else:
-                    # Estratto un BIANCO (diventa RANDOM)
-                    # 50% bianco, 50% nero
-                    if random.random() < 0.5:
-                        drawn.append('successo')
-                    else:
-                        drawn.append('complicazione')
-                    temp_successi -= 1
-                    # Aggiorna sacchetto reale: togli sempre il token BIANCO estratto fisicamente
-                    bag_successi -= 1
+        drawn = outcome.drawn
+        successi = outcome.successi
+        complicazioni = outcome.complicazioni
+        bag_successi = outcome.bag_successi
+        bag_complicazioni = outcome.bag_complicazioni
 
-        else:
-            # ========== ESTRAZIONE NORMALE ==========
-            drawn = []
-            for _ in range(num_tokens):
-                if bag_successi + bag_complicazioni == 0:
-                    break
-
-                # Protezione: assicurati che almeno un peso sia > 0
-                if bag_successi <= 0 and bag_complicazioni <= 0:
-                    break
-
-                # Estrai usando random.choices
-                token_key = random.choices(
-                    ['successi', 'complicazioni'],
-                    weights=[max(0, bag_successi), max(0, bag_complicazioni)]
-                )[0]
-
-                # Aggiungi al risultato usando la forma SINGOLARE
-                token_name = 'successo' if token_key == 'successi' else 'complicazione'
-                drawn.append(token_name)
-
-                # Decrementa
-                if token_key == 'successi':
-                    bag_successi -= 1
-                else:
-                    bag_complicazioni -= 1
-
-        # Conta risultati
-        successi = drawn.count('successo')
-        complicazioni = drawn.count('complicazione')
-
-        # Aggiorna il sacchetto nel database
-        room.bag_successi = bag_successi
-        room.bag_complicazioni = bag_complicazioni
-
-        # Crea entry storico nel database
-        history_entry = DrawHistory(
-            room_id=room.id,
-            player_name=player_name,
-            drawn_tokens=json.dumps(drawn),
-            successi=successi,
-            complicazioni=complicazioni,
+        # Accoda lo storico (salvato in modo asincrono)
+        timestamp = state.record_draw(
+            player_name, drawn, successi, complicazioni,
             adrenaline=adrenaline,
-            confusion=confusion
+            confusion=confusion,
+            bag_size=bag_size
         )
 
-        db.session.add(history_entry)
-        db.session.commit()
-
         # Invia risultato
         result = {
             'player': player_name,
@@ -633,7 +631,7 @@ def handle_draw_tokens(data):
                 'drawn': drawn,
                 'successi': successi,
                 'complicazioni': complicazioni,
-                'timestamp': history_entry.timestamp.isoformat(),
+                'timestamp': timestamp.isoformat(),
                 'adrenaline': adrenaline,
                 'confusion': confusion
             },
@@ -641,10 +639,9 @@ def handle_draw_tokens(data):
             'confusion': confusion
         }
         print(f"📤 Inviando tokens_drawn: {result}")
-        emit('tokens_drawn', result, room=room_id)
+        wire_format.emit_to_room('tokens_drawn', result, room_id, wire_format.compact_tokens_drawn)
 
     except Exception as e:
-        db.session.rollback()
         print(f"❌ Errore in draw_tokens: {e}")
         import traceback
         traceback.print_exc()
@@ -654,101 +651,152 @@ def handle_draw_tokens(data):
 def handle_risk_all(data):
     """Rischia tutto - estrai fino a 5 token totali"""
     room_id = data.get('room_id')
-    num_tokens = data.get('num_tokens', 1)
     player_name = data.get('player_name', 'Giocatore')
     previous_successi = data.get('previous_successi', 0)
     previous_complicazioni = data.get('previous_complicazioni', 0)
 
-    # Trova la stanza nel database
-    room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+    try:
+        num_tokens = draw_engine.check_num_tokens(data.get('num_tokens', 1))
+    except draw_engine.InvalidDraw as e:
+        emit('error', {'message': str(e)})
+        return
 
-    if not room:
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
+
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
-    bag_successi = room.bag_successi
-    bag_complicazioni = room.bag_complicazioni
+    def draw_from(bag_successi, bag_complicazioni):
+        # Estrazione normale (niente adrenalina/confusione per risk_all)
+        outcome = draw_engine.draw(
+            bag_successi, bag_complicazioni, num_tokens,
+            risk_all=True
+        )
+        return outcome.bag_successi, outcome.bag_complicazioni, (outcome, bag_successi + bag_complicazioni)
 
-    # Verifica che ci siano abbastanza token
-    total_tokens = bag_successi + bag_complicazioni
-    if total_tokens < num_tokens:
-        emit('error', {'message': 'Non ci sono abbastanza token nel sacchetto'})
+    # Aggiorna il sacchetto con compare-and-set (riprova se cambia nel frattempo)
+    try:
+        outcome, bag_size = state.update_bag(draw_from)
+    except (draw_engine.NotEnoughTokens, BagConflict) as e:
+        emit('error', {'message': str(e)})
         return
 
-    # Estrazione normale (niente adrenalina/confusione per risk_all)
-    drawn = []
-    for _ in range(num_tokens):
-        if bag_successi + bag_complicazioni == 0:
-            break
-
-        # Estrai usando random.choices
-        token_key = random.choices(
-            ['successi', 'complicazioni'],
-            weights=[max(0, bag_successi), max(0, bag_complicazioni)]
-        )[0]
-
-        # Aggiungi al risultato usando la forma SINGOLARE
-        token_name = 'successo' if token_key == 'successi' else 'complicazione'
-        drawn.append(token_name)
-
-        # Decrementa
-        if token_key == 'successi':
-            bag_successi -= 1
-        else:
-            bag_complicazioni -= 1
+    drawn = outcome.drawn
+    bag_successi = outcome.bag_successi
+    bag_complicazioni = outcome.bag_complicazioni
 
     # Conta risultati NUOVI
-    new_successi = drawn.count('successo')
-    new_complicazioni = drawn.count('complicazione')
+    new_successi = outcome.successi
+    new_complicazioni = outcome.complicazioni
+
+    # Accoda lo storico (salvato in modo asincrono)
+    timestamp = state.record_draw(
+        player_name, drawn, new_successi, new_complicazioni,
+        risk_all=True,
+        bag_size=bag_size
+    )
+
+    # Rischia tutto conta: sacchetto e storico salvati subito
+    active_rooms_cache.flush_now(room_id)
 
     # Calcola totali CUMULATIVI
     total_successi = previous_successi + new_successi
     total_complicazioni = previous_complicazioni + new_complicazioni
 
-    # Aggiorna il sacchetto nel database
-    room.bag_successi = bag_successi
-    room.bag_complicazioni = bag_complicazioni
-
-    # Crea entry storico nel database
-    history_entry = DrawHistory(
-        room_id=room.id,
-        player_name=player_name,
-        drawn_tokens=json.dumps(drawn),
-        successi=new_successi,
-        complicazioni=new_complicazioni,
-        risk_all=True
-    )
-
-    try:
-        db.session.add(history_entry)
-        db.session.commit()
-
-        # Invia risultato con totali corretti
-        emit('risk_all_result', {
+    # Invia risultato con totali corretti
+    wire_format.emit_to_room('risk_all_result', {
+        'player': player_name,
+        'drawn': drawn,
+        'successi': new_successi,
+        'complicazioni': new_complicazioni,
+        'total_successi': total_successi,
+        'total_complicazioni': total_complicazioni,
+        'bag_remaining': {
+            'successi': bag_successi,
+            'complicazioni': bag_complicazioni
+        },
+        'history': {
             'player': player_name,
             'drawn': drawn,
             'successi': new_successi,
             'complicazioni': new_complicazioni,
+            'timestamp': timestamp.isoformat(),
+            'risk_all': True,
             'total_successi': total_successi,
-            'total_complicazioni': total_complicazioni,
-            'bag_remaining': {
-                'successi': bag_successi,
-                'complicazioni': bag_complicazioni
-            },
-            'history': {
-                'player': player_name,
-                'drawn': drawn,
-                'successi': new_successi,
-                'complicazioni': new_complicazioni,
-                'timestamp': history_entry.timestamp.isoformat(),
-                'risk_all': True,
-                'total_successi': total_successi,
-                'total_complicazioni': total_complicazioni
+            'total_complicazioni': total_complicazioni
+        }
+    }, room_id, wire_format.compact_risk_all_result)
+
+@socketio.on('preview_odds')
+def handle_preview_odds(data):
+    """Anteprima delle probabilità di un'estrazione (sacchetto della stanza o ipotetico)"""
+    room_id = data.get('room_id')
+
+    try:
+        # Stesso ordine di draw_tokens: prima l'adrenalina, poi i limiti sul numero di token
+        num_tokens = draw_engine.effective_num_tokens(
+            data.get('num_tokens', 1),
+            adrenaline=data.get('adrenaline', False),
+            risk_all=data.get('risk_all', False)
+        )
+        if data.get('successi') is not None or data.get('complicazioni') is not None:
+            # Sacchetto ipotetico
+            bag_successi = int(data.get('successi') or 0)
+            bag_complicazioni = int(data.get('complicazioni') or 0)
+        else:
+            state = active_rooms_cache.get(room_id)
+            if not state:
+                emit('error', {'message': 'Stanza non trovata'})
+                return
+            bag = state.bag()
+            bag_successi, bag_complicazioni = bag['successi'], bag['complicazioni']
+    except draw_engine.InvalidDraw as e:
+        emit('error', {'message': str(e)})
+        return
+    except (TypeError, ValueError):
+        emit('error', {'message': 'Parametri non validi'})
+        return
+
+    if bag_successi < 0 or bag_complicazioni < 0:
+        emit('error', {'message': 'Parametri non validi'})
+        return
+
+    # Limite prima di arrivare al motore: il calcolo blocca il loop di eventlet
+    if bag_successi + bag_complicazioni > draw_engine.ODDS_MAX_BAG:
+        emit('error', {'message': f'Anteprima disponibile fino a {draw_engine.ODDS_MAX_BAG} token nel sacchetto'})
+        return
+
+    try:
+        num_tokens, probabilities = draw_engine.odds(
+            bag_successi, bag_complicazioni, num_tokens,
+            adrenaline=data.get('adrenaline', False),
+            confusion=data.get('confusion', False),
+            risk_all=data.get('risk_all', False)
+        )
+    except (draw_engine.InvalidDraw, draw_engine.NotEnoughTokens) as e:
+        emit('error', {'message': str(e)})
+        return
+
+    emit('odds_preview', {
+        'room_id': room_id,
+        'bag': {
+            'successi': bag_successi,
+            'complicazioni': bag_complicazioni
+        },
+        'num_tokens': num_tokens,
+        'distribution': [
+            {
+                'successi': successi,
+                'complicazioni': num_tokens - successi,
+                'probability': probability
             }
-        }, room=room_id)
-    except Exception as e:
-        db.session.rollback()
-        emit('error', {'message': f'Errore durante rischia tutto: {str(e)}'})
+            for successi, probability in enumerate(probabilities)
+        ],
+        'expected_successi': sum(s * p for s, p in enumerate(probabilities)),
+        'no_complicazioni': probabilities[num_tokens]
+    })
 
 @socketio.on('return_tokens')
 def handle_return_tokens(data):
@@ -757,28 +805,92 @@ def handle_return_tokens(data):
     successi = int(data.get('successi', 0))
     complicazioni = int(data.get('complicazioni', 0))
 
-    # Trova la stanza nel database
-    room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
 
-    if not room:
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
-    room.bag_successi += successi
-    room.bag_complicazioni += complicazioni
+    try:
+        bag = state.update_bag(lambda bag_successi, bag_complicazioni: (
+            bag_successi + successi, bag_complicazioni + complicazioni,
+            {'successi': bag_successi + successi, 'complicazioni': bag_complicazioni + complicazioni}
+        ))
+    except BagConflict as e:
+        emit('error', {'message': str(e)})
+        return
+
+    emit('tokens_returned', {
+        'bag': bag
+    }, room=room_id)
+
+
+@socketio.on('get_history')
+def handle_get_history(data):
+    """Pagina di storico della stanza (paginazione a cursore, filtri opzionali)"""
+    room_id = data.get('room_id')
+
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
+
+    if not state:
+        emit('error', {'message': 'Stanza non trovata'})
+        return
 
     try:
-        db.session.commit()
+        # Lo storico in sospeso deve essere sul database prima di leggerlo
+        active_rooms_cache.flush(room_id)
+
+        entries, next_cursor = history.get_history_page(
+            state.room_pk,
+            cursor=data.get('cursor'),
+            limit=data.get('limit'),
+            player=data.get('player'),
+            **{flag: data.get(flag) for flag in history.FLAG_FILTERS}
+        )
+    except history.InvalidCursor as e:
+        emit('error', {'message': str(e)})
+        return
+    except Exception as e:
+        db.session.rollback()
+        emit('error', {'message': f'Errore nel caricare lo storico: {str(e)}'})
+        return
 
-        emit('tokens_returned', {
-            'bag': {
-                'successi': room.bag_successi,
-                'complicazioni': room.bag_complicazioni
-            }
-        }, room=room_id)
+    emit('history_page', {
+        'room_id': room_id,
+        'entries': entries,
+        'next_cursor': next_cursor
+    })
+
+
+@socketio.on('get_room_stats')
+def handle_get_room_stats(data):
+    """Statistiche delle estrazioni della stanza (totali e per giocatore)"""
+    room_id = data.get('room_id')
+
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
+
+    if not state:
+        emit('error', {'message': 'Stanza non trovata'})
+        return
+
+    try:
+        # Le estrazioni in sospeso aggiornano le statistiche quando vengono salvate
+        active_rooms_cache.flush(room_id)
+
+        stats = draw_stats.get_room_stats(state.room_pk)
     except Exception as e:
         db.session.rollback()
-        emit('error', {'message': f'Errore nel rimettere i token: {str(e)}'})
+        emit('error', {'message': f'Errore nel caricare le statistiche: {str(e)}'})
+        return
+
+    emit('room_stats', {
+        'room_id': room_id,
+        'room': stats['room'],
+        'players': stats['players']
+    })
 
 
 @socketio.on('update_adrenaline')
@@ -788,23 +900,17 @@ def handle_update_adrenaline(data):
     player_name = data.get('player_name')
     adrenaline = int(data.get('adrenaline', 0))
 
-    # Verifica che la stanza esista nel database
-    room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+    # Stanza attiva (database solo se è uscita dalla memoria o è di un altro worker)
+    state = active_rooms_cache.get(room_id)
 
-    if not room:
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
-    # Usa cache per stati temporanei
-    if room_id not in active_rooms_cache:
-        active_rooms_cache[room_id] = {'adrenaline': {}, 'confusion': {}}
+    state.set_player_state('adrenaline', player_name, adrenaline)
 
-    active_rooms_cache[room_id]['adrenaline'][player_name] = adrenaline
-
-    emit('adrenaline_updated', {
-        'player': player_name,
-        'adrenaline': adrenaline
-    }, room=room_id)
+    # Broadcast raggruppato ('states_updated') con l'ultimo valore per giocatore
+    state_broadcaster.push(room_id, 'adrenaline', player_name, adrenaline)
 
 
 @socketio.on('update_confusion')
@@ -814,23 +920,17 @@ def handle_update_confusion(data):
     player_name = data.get('player_name')
     confusion = int(data.get('confusion', 0))
 
-    # Verifica che la stanza esista nel database
-    room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+    # Stanza attiva (database solo se è uscita dalla memoria o è di un altro worker)
+    state = active_rooms_cache.get(room_id)
 
-    if not room:
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
-    # Usa cache per stati temporanei
-    if room_id not in active_rooms_cache:
-        active_rooms_cache[room_id] = {'adrenaline': {}, 'confusion': {}}
+    state.set_player_state('confusion', player_name, confusion)
 
-    active_rooms_cache[room_id]['confusion'][player_name] = confusion
-
-    emit('confusion_updated', {
-        'player': player_name,
-        'confusion': confusion
-    }, room=room_id)
+    # Broadcast raggruppato ('states_updated') con l'ultimo valore per giocatore
+    state_broadcaster.push(room_id, 'confusion', player_name, confusion)
 
 
 @socketio.on('generate_weather')
@@ -870,22 +970,23 @@ def handle_reset_bag(data):
     """Resetta il sacchetto"""
     room_id = data.get('room_id')
 
-    # Trova la stanza nel database
-    room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
 
-    if not room:
+    if not state:
         emit('error', {'message': 'Stanza non trovata'})
         return
 
-    room.bag_successi = 0
-    room.bag_complicazioni = 0
-
     try:
-        db.session.commit()
-        emit('bag_reset', {}, room=room_id)
-    except Exception as e:
-        db.session.rollback()
-        emit('error', {'message': f'Errore nel resettare il sacchetto: {str(e)}'})
+        state.set_bag(0, 0)
+    except BagConflict as e:
+        emit('error', {'message': str(e)})
+        return
+
+    # Fine scena: salvato subito
+    active_rooms_cache.flush_now(room_id)
+
+    emit('bag_reset', {}, room=room_id)
 
 @socketio.on('save_character')
 def handle_save_character(data):
@@ -915,22 +1016,26 @@ def handle_save_character(data):
     ).first()
 
     try:
+        # La foto viene salvata nell'archivio: sulla scheda resta solo l'hash
+        photo = photo_store.photo_ref_from_client(character.get('photo', ''))
+
         if existing_character:
             # Aggiorna scheda esistente
             existing_character.player_name = player_name
             existing_character.name = character.get('name', '')
             existing_character.motivation = character.get('motivation', '')
             existing_character.archetype = character.get('archetype', '')
-            existing_character.photo = character.get('photo', '')
-            existing_character.traits = json.dumps(character.get('traits', []))
-            existing_character.selected_traits = json.dumps(character.get('selected_traits', []))
-            existing_character.empowered_traits = json.dumps(character.get('empowered_traits', []))
+            existing_character.photo = photo
+            existing_character.traits = character.get('traits', [])
+            existing_character.selected_traits = character.get('selected_traits', [])
+            existing_character.empowered_traits = character.get('empowered_traits', [])
             existing_character.quality_counter = character.get('quality_counter', 0)
             existing_character.ability_counter = character.get('ability_counter', 0)
-            existing_character.misfortunes = json.dumps(character.get('misfortunes', []))
-            existing_character.lessons = json.dumps(character.get('lessons', []))
+            existing_character.misfortunes = character.get('misfortunes', [])
+            existing_character.lessons = character.get('lessons', [])
             existing_character.resources = character.get('resources', '')
             existing_character.notes = character.get('notes', '')
+            existing_character.version = (existing_character.version or 0) + 1
         else:
             # Crea nuova scheda
             new_character = Character(
@@ -940,25 +1045,131 @@ def handle_save_character(data):
                 name=character.get('name', ''),
                 motivation=character.get('motivation', ''),
                 archetype=character.get('archetype', ''),
-                photo=character.get('photo', ''),
-                traits=json.dumps(character.get('traits', [])),
-                selected_traits=json.dumps(character.get('selected_traits', [])),
-                empowered_traits=json.dumps(character.get('empowered_traits', [])),
+                photo=photo,
+                traits=character.get('traits', []),
+                selected_traits=character.get('selected_traits', []),
+                empowered_traits=character.get('empowered_traits', []),
                 quality_counter=character.get('quality_counter', 0),
                 ability_counter=character.get('ability_counter', 0),
-                misfortunes=json.dumps(character.get('misfortunes', [])),
-                lessons=json.dumps(character.get('lessons', [])),
+                misfortunes=character.get('misfortunes', []),
+                lessons=character.get('lessons', []),
                 resources=character.get('resources', ''),
-                notes=character.get('notes', '')
+                notes=character.get('notes', ''),
+                version=1
             )
             db.session.add(new_character)
 
         db.session.commit()
+        active_rooms_cache.bump(room_id)
+
+        saved = existing_character or new_character
 
-        # Notifica tutti nella stanza
+        # Notifica tutti nella stanza (la foto viaggia solo come URL)
         emit('character_saved', {
             'player_name': player_name,
-            'character': character
+            'character': dict(character, photo=photo_url(photo), version=saved.version)
+        }, room=room_id)
+
+    except Exception as e:
+        db.session.rollback()
+        emit('error', {'message': f'Errore nel salvare la scheda: {str(e)}'})
+
+
+# Campi della scheda aggiornabili con save_character_delta
+CHARACTER_DELTA_FIELDS = {
+    'name', 'motivation', 'archetype', 'photo',
+    'traits', 'selected_traits', 'empowered_traits',
+    'quality_counter', 'ability_counter',
+    'misfortunes', 'lessons', 'resources', 'notes'
+}
+
+
+@socketio.on('save_character_delta')
+def handle_save_character_delta(data):
+    """Salva solo i campi modificati della scheda (concorrenza ottimistica)"""
+    room_id = data.get('room_id')
+    player_name = data.get('player_name')
+    changes = data.get('changes') or {}
+
+    try:
+        base_version = int(data.get('base_version', 0))
+    except (TypeError, ValueError):
+        emit('error', {'message': 'Versione della scheda non valida'})
+        return
+
+    unknown = set(changes) - CHARACTER_DELTA_FIELDS
+    if unknown:
+        emit('error', {'message': f'Campi non validi: {", ".join(sorted(unknown))}'})
+        return
+
+    # Trova la stanza in memoria
+    state = active_rooms_cache.get(room_id)
+
+    if not state:
+        emit('error', {'message': 'Stanza non trovata'})
+        return
+
+    # Trova il giocatore nella stanza
+    room_player = RoomPlayer.query.filter_by(room_id=state.room_pk, player_name=player_name).first()
+
+    if not room_player:
+        emit('error', {'message': 'Giocatore non trovato nella stanza'})
+        return
+
+    try:
+        values = {}
+        broadcast_changes = dict(changes)
+        for field, value in changes.items():
+            if field == 'photo':
+                value = photo_store.photo_ref_from_client(value)
+                broadcast_changes['photo'] = photo_url(value)
+            values[field] = value
+
+        character_id = db.session.query(Character.id).filter_by(
+            room_id=state.room_pk,
+            user_id=room_player.user_id
+        ).scalar()
+
+        if character_id is None:
+            # Prima scheda del giocatore: si parte dalla versione 0
+            updated = base_version == 0
+            if updated:
+                db.session.add(Character(
+                    room_id=state.room_pk,
+                    user_id=room_player.user_id,
+                    player_name=player_name,
+                    version=1,
+                    **values
+                ))
+        else:
+            # Aggiorna solo se nessuno ha salvato nel frattempo
+            values['player_name'] = player_name
+            values['version'] = Character.version + 1
+            values['updated_at'] = datetime.utcnow()
+            result = db.session.execute(
+                db.update(Character)
+                .where(Character.id == character_id, Character.version == base_version)
+                .values(**values)
+            )
+            updated = result.rowcount == 1
+
+        if not updated:
+            db.session.rollback()
+            current = Character.query.get(character_id) if character_id else None
+            emit('character_conflict', {
+                'player_name': player_name,
+                'character': current.to_dict() if current else None
+            })
+            return
+
+        db.session.commit()
+        active_rooms_cache.bump(room_id)
+
+        # Notifica tutti nella stanza solo con i campi cambiati
+        emit('character_updated', {
+            'player_name': player_name,
+            'version': base_version + 1,
+            'changes': broadcast_changes
         }, room=room_id)
 
     except Exception as e:
@@ -991,10 +1202,10 @@ def handle_get_characters(data):
         if is_master or character.user_id == user_id or character.visible_to_all:
             characters_dict[character.player_name] = character.to_dict()
 
-    emit('characters_loaded', {
+    wire_format.emit_to_client('characters_loaded', {
         'characters': characters_dict,
         'is_master': is_master
-    })
+    }, wire_format.compact_characters_loaded)
 
 
 @socketio.on('get_all_characters_for_master')
@@ -1050,17 +1261,13 @@ def handle_toggle_character_visibility(data):
         return
 
     try:
-        # Prima imposta tutte le schede come non visibili
+        # Visibili solo le schede selezionate (una sola query per tutte)
+        visible_ids = {str(char_id) for char_id in character_ids}
         for character in room.characters.all():
-            character.visible_to_all = False
-
-        # Poi rendi visibili solo quelle selezionate
-        for char_id in character_ids:
-            character = Character.query.filter_by(id=char_id, room_id=room.id).first()
-            if character:
-                character.visible_to_all = True
+            character.visible_to_all = str(character.id) in visible_ids
 
         db.session.commit()
+        active_rooms_cache.bump(room_id)
 
         # Notifica tutti nella stanza che la visibilità è cambiata
         emit('visibility_updated', {
@@ -1097,7 +1304,86 @@ def handle_load_my_character(data):
             'character': None
         })
 
+
+def configure_database(app):
+    """Database: PostgreSQL in produzione (DATABASE_URL), SQLite in locale"""
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url and not database_url.startswith('sqlite'):
+        # Render fornisce DATABASE_URL con postgres://, ma SQLAlchemy richiede postgresql://
+        if database_url.startswith('postgres://'):
+            database_url = database_url.replace('postgres://', 'postgresql://', 1)
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+        print(f"🗄️  Using PostgreSQL database")
+        # Pool di connessioni limitato, sicuro con i greenlet di eventlet (vedi db_pool.py)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = postgres_engine_options()
+    elif sqlite_mode.is_production():
+        # SQLite su un solo server: WAL e un writer alla volta (vedi sqlite_mode.py)
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///not_the_end.db'
+        print(f"🗄️  Using SQLite database (WAL, single writer)")
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite_mode.engine_options()
+    else:
+        # Fallback a SQLite per sviluppo locale
+        # Usa check_same_thread=False per permettere l'uso multi-threaded con eventlet
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///not_the_end.db?check_same_thread=False'
+        if database_url:
+            print(f"⚠️  Using SQLite database (development only)")
+        else:
+            print(f"⚠️  DATABASE_URL not found - using SQLite (development only)")
+        # Configurazione pool per SQLite
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_pre_ping': True,
+            'pool_recycle': 300,
+        }
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+
+def create_app(config=None):
+    """Crea e configura l'app Flask.
+
+    Non modifica lo schema del database: le migrazioni si applicano a parte
+    con `flask --app app migrate` o `python migrate_db.py` (vedi migrations.py).
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'not-the-end-secret-key-change-in-production')
+    configure_database(app)
+    if config:
+        app.config.update(config)
+
+    db.init_app(app)
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') and sqlite_mode.is_production():
+        sqlite_mode.init_app(app, db)
+        instrumentation.event_metrics.register_collector('sqlite_writer', sqlite_mode.writer_gate.stats)
+    socketio.init_app(app, cors_allowed_origins="*", message_queue=SOCKETIO_MESSAGE_QUEUE)
+    app.register_blueprint(main)
+    migrations.init_app(app)
+
+    if SOCKETIO_MESSAGE_QUEUE and not active_rooms_cache.backend.shared:
+        print("⚠️  SOCKETIO_MESSAGE_QUEUE impostata ma stato delle stanze in memoria: con più worker usa ROOM_STATE_BACKEND=redis://...")
+    active_rooms_cache.init_app(app, socketio)
+    if SOCKETIO_MESSAGE_QUEUE and session_tokens.SESSION_MODE == 'token' and not session_tokens.denylist.shared:
+        print("⚠️  SESSION_MODE=token con più worker: usa SESSION_DENYLIST=redis://... per propagare i logout")
+    if SOCKETIO_MESSAGE_QUEUE and session_tokens.SESSION_MODE != 'token' and not session_tokens.denylist.shared:
+        # Un logout su un worker non raggiungerebbe le cache degli altri
+        print("⚠️  Cache delle sessioni disattivata con più worker: usa SESSION_DENYLIST=redis://... per condividere i logout")
+        session_cache.ttl = 0
+
+    # Metriche di tutti gli handler registrati sopra, esposte su /metrics
+    instrumentation.init_app(app, socketio, db)
+    instrumentation.event_metrics.register_collector('db_pool', pool_metrics.stats)
+    instrumentation.event_metrics.register_collector('session_cache', session_cache.stats)
+    instrumentation.event_metrics.register_collector('session_denylist', session_tokens.denylist.stats)
+    instrumentation.event_metrics.register_collector('bag', bag_metrics.stats)
+    instrumentation.event_metrics.register_collector('state_broadcast', state_broadcaster.stats)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    # Server di sviluppo: un solo processo, le migrazioni si applicano qui
+    migrations.upgrade(app)
+    start_services(app)
     socketio.run(app, debug=True, host='0.0.0.0', port=port)
 
@@ -1,18 +1,143 @@
 import bcrypt
+from flask import current_app
 from models import db, User, Session
-from datetime import datetime, timedelta
+import session_tokens
+from datetime import datetime
+from collections import OrderedDict, namedtuple
+import os
+import threading
+import time
 import uuid
 
+try:
+    from eventlet import patcher as eventlet_patcher, tpool
+except ImportError:  # eventlet non installato (es. sviluppo con threading)
+    eventlet_patcher = None
+    tpool = None
+
+
+# Utente autenticato restituito da verify_session
+SessionUser = namedtuple('SessionUser', ['id', 'username'])
+
+
+class SessionCache:
+    """Cache LRU delle sessioni verificate, con scadenza (TTL)"""
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # session_id: (user_id, username, expires_at, valid_until)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """Restituisce (user_id, username, expires_at) o None"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[3] < time.monotonic() or entry[2] < datetime.utcnow():
+                del self._entries[session_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return entry[:3]
+
+    def put(self, session_id, user_id, username, expires_at):
+        """Memorizza una sessione valida; il TTL non supera la scadenza reale"""
+        remaining = (expires_at - datetime.utcnow()).total_seconds()
+        ttl = min(self.ttl, remaining)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[session_id] = (user_id, username, expires_at, time.monotonic() + ttl)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, session_id):
+        """Rimuove subito una sessione dalla cache"""
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self):
+        """Svuota la cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Contatori della cache"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+session_cache = SessionCache(
+    max_size=int(os.environ.get('SESSION_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('SESSION_CACHE_TTL', '300'))
+)
+
+
+# Durata di una sessione (sul database o token)
+SESSION_LIFETIME = session_tokens.SESSION_LIFETIME
+
+# Sessioni attive per utente: al login le più vecchie oltre il limite vengono eliminate
+SESSION_MAX_PER_USER = int(os.environ.get('SESSION_MAX_PER_USER', '10'))
+
+
+# Massimo numero di operazioni bcrypt in corso o in coda nel pool di thread
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', '16'))
+
+_bcrypt_pending = 0
+_bcrypt_lock = threading.Lock()
+
+
+class ServerBusy(Exception):
+    """Troppe operazioni bcrypt in coda: il client deve riprovare"""
+
+
+def _run_bcrypt(func, *args):
+    """Esegue bcrypt fuori dall'hub eventlet, con un limite alla coda.
+
+    Con eventlet (monkey patching attivo) il lavoro va nel pool di thread
+    nativi di tpool (dimensione: EVENTLET_THREADPOOL_SIZE), così un login
+    non blocca le estrazioni nelle altre stanze. Senza eventlet bcrypt
+    rilascia già il GIL e viene chiamato direttamente.
+    """
+    global _bcrypt_pending
+
+    with _bcrypt_lock:
+        if _bcrypt_pending >= BCRYPT_MAX_PENDING:
+            raise ServerBusy("Server occupato, riprova tra qualche istante")
+        _bcrypt_pending += 1
+
+    try:
+        if tpool is not None and eventlet_patcher.is_monkey_patched('thread'):
+            return tpool.execute(func, *args)
+        return func(*args)
+    finally:
+        with _bcrypt_lock:
+            _bcrypt_pending -= 1
+
 
 def hash_password(password):
     """Hash della password con bcrypt"""
     salt = bcrypt.gensalt()
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+    return _run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
 
 
 def verify_password(password, password_hash):
     """Verifica la password"""
-    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    return _run_bcrypt(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
 
 
 def create_user(username, password):
@@ -23,7 +148,10 @@ def create_user(username, password):
         return None, "Username già esistente"
 
     # Crea nuovo utente
-    password_hash = hash_password(password)
+    try:
+        password_hash = hash_password(password)
+    except ServerBusy as e:
+        return None, str(e)
     new_user = User(username=username, password_hash=password_hash)
 
     try:
@@ -42,15 +170,23 @@ def login_user(username, password):
     if not user:
         return None, None, "Username non trovato"
 
-    if not verify_password(password, user.password_hash):
+    try:
+        password_ok = verify_password(password, user.password_hash)
+    except ServerBusy as e:
+        return None, None, str(e)
+
+    if not password_ok:
         return None, None, "Password errata"
 
     # Aggiorna ultimo login
     user.last_login = datetime.utcnow()
 
+    if session_tokens.SESSION_MODE == 'token':
+        return _login_with_token(user)
+
     # Crea sessione
     session_id = str(uuid.uuid4())
-    expires_at = datetime.utcnow() + timedelta(days=7)  # Sessione valida per 7 giorni
+    expires_at = datetime.utcnow() + SESSION_LIFETIME
 
     session = Session(
         session_id=session_id,
@@ -60,6 +196,7 @@ def login_user(username, password):
 
     try:
         db.session.add(session)
+        _evict_oldest_sessions(user.id)
         db.session.commit()
         return user, session_id, None
     except Exception as e:
@@ -67,27 +204,109 @@ def login_user(username, password):
         return None, None, f"Errore nella creazione sessione: {str(e)}"
 
 
+def _login_with_token(user):
+    """Login senza stato: token firmato, nessuna riga in sessions"""
+    expires_at = time.time() + SESSION_LIFETIME.total_seconds()
+    token = session_tokens.issue_token(current_app.config['SECRET_KEY'], user.id, user.username, expires_at)
+    try:
+        db.session.commit()
+        return user, token, None
+    except Exception as e:
+        db.session.rollback()
+        return None, None, f"Errore nella creazione sessione: {str(e)}"
+
+
+def _evict_oldest_sessions(user_id):
+    """Elimina le sessioni dell'utente oltre le SESSION_MAX_PER_USER più recenti"""
+    if SESSION_MAX_PER_USER <= 0:
+        return
+    oldest = db.session.query(Session.id, Session.session_id, Session.expires_at) \
+        .filter(Session.user_id == user_id) \
+        .order_by(Session.created_at.desc(), Session.id.desc()) \
+        .offset(SESSION_MAX_PER_USER) \
+        .all()
+    if not oldest:
+        return
+    Session.query.filter(Session.id.in_([row.id for row in oldest])).delete(synchronize_session=False)
+    for row in oldest:
+        _forget_session(row.session_id, row.expires_at)
+
+
+def _forget_session(session_id, expires_at):
+    """Toglie una sessione chiusa dalla cache di questo worker e, con la denylist condivisa, di tutti"""
+    session_cache.invalidate(session_id)
+    if session_tokens.denylist.shared:
+        ttl = session_cache.ttl
+        if expires_at is not None:
+            ttl = min(ttl, (expires_at - datetime.utcnow()).total_seconds())
+        if ttl > 0:
+            # Serve solo finché una copia della sessione può restare nelle cache degli altri worker
+            session_tokens.denylist.revoke_session(session_id, time.time() + ttl)
+
+
 def verify_session(session_id):
-    """Verifica se la sessione è valida"""
-    session = Session.query.filter_by(session_id=session_id).first()
+    """Verifica se la sessione è valida (token firmato, poi cache, poi database)"""
+    if session_tokens.is_token(session_id):
+        return _verify_token(session_id)
+
+    cached = session_cache.get(session_id)
+    if cached and session_tokens.denylist.shared and session_tokens.denylist.is_session_revoked(session_id):
+        # Chiusa su un altro worker: la copia in cache non vale più
+        session_cache.invalidate(session_id)
+        cached = None
+    if cached:
+        user_id, username, _ = cached
+        return SessionUser(user_id, username), None
 
-    if not session:
+    row = db.session.query(Session.expires_at, User.id, User.username) \
+        .join(User, Session.user_id == User.id) \
+        .filter(Session.session_id == session_id) \
+        .first()
+
+    if not row:
         return None, "Sessione non trovata"
 
-    if session.expires_at < datetime.utcnow():
+    expires_at, user_id, username = row
+
+    if expires_at < datetime.utcnow():
         return None, "Sessione scaduta"
 
-    return session.user, None
+    session_cache.put(session_id, user_id, username, expires_at)
+    return SessionUser(user_id, username), None
+
+
+def _verify_token(token):
+    """Verifica di un token firmato: solo calcolo, nessuna query"""
+    if session_tokens.SESSION_MODE != 'token':
+        return None, "Sessione non valida"
+    try:
+        claims = session_tokens.decode_token(current_app.config['SECRET_KEY'], token)
+    except session_tokens.InvalidToken as e:
+        return None, str(e)
+    if session_tokens.is_revoked(claims):
+        return None, "Sessione non trovata"
+    return SessionUser(claims['u'], claims['n']), None
 
 
 def logout_user(session_id):
-    """Logout utente (elimina sessione)"""
+    """Logout utente (elimina sessione o revoca il token)"""
+    if session_tokens.is_token(session_id):
+        try:
+            claims = session_tokens.decode_token(current_app.config['SECRET_KEY'], session_id)
+        except session_tokens.InvalidToken:
+            return False
+        session_tokens.denylist.revoke(claims['u'], claims['jti'], claims['exp'])
+        return True
+
+    session_cache.invalidate(session_id)
     session = Session.query.filter_by(session_id=session_id).first()
 
     if session:
+        expires_at = session.expires_at
         try:
             db.session.delete(session)
             db.session.commit()
+            _forget_session(session_id, expires_at)
             return True
         except Exception as e:
             db.session.rollback()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark di contesa sul sacchetto.
+
+N giocatori per stanza estraggono un token e lo rimettono nel sacchetto in
+continuazione, tutti insieme. Misura il throughput delle modifiche, il
+tasso di ritentativi del compare-and-set e verifica che alla fine nessun
+token sia stato perso o duplicato.
+
+Uso:
+    python benchmarks/bag_contention.py --rooms 4 --drawers 8 --seconds 5
+    ROOM_STATE_BACKEND=redis://localhost:6379/0 python benchmarks/bag_contention.py
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import draw_engine  # noqa: E402
+from room_state import RoomState, BagConflict, bag_metrics  # noqa: E402
+from state_backend import create_backend  # noqa: E402
+
+
+def take_one(bag_successi, bag_complicazioni):
+    outcome = draw_engine.draw(bag_successi, bag_complicazioni, 1)
+    return outcome.bag_successi, outcome.bag_complicazioni, outcome.successi
+
+
+def drawer(state, deadline, counters, index):
+    """Estrai un token e rimettilo finché non scade il tempo"""
+    ops = conflicts = 0
+    while time.perf_counter() < deadline:
+        try:
+            white = state.update_bag(take_one)
+        except BagConflict:
+            conflicts += 1
+            continue
+        except draw_engine.NotEnoughTokens:
+            continue
+        ops += 1
+
+        # Il token estratto va rimesso comunque, anche dopo un conflitto
+        while True:
+            try:
+                state.update_bag(lambda s, c: (s + white, c + 1 - white, None))
+                break
+            except BagConflict:
+                conflicts += 1
+        ops += 1
+    counters[index] = (ops, conflicts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--drawers', type=int, default=8, help='giocatori per stanza')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--successi', type=int, default=20)
+    parser.add_argument('--complicazioni', type=int, default=20)
+    parser.add_argument('--switch-interval', type=float, default=1e-5,
+                        help='intervallo di cambio thread (s): più basso = più contesa')
+    args = parser.parse_args()
+
+    sys.setswitchinterval(args.switch_interval)
+    backend = create_backend()
+    run_id = f'bench-{os.getpid()}-{int(time.time())}'
+
+    states = [
+        RoomState(room_pk=i, room_id=f'{run_id}-{i}', owner_id=0,
+                  bag_successi=args.successi, bag_complicazioni=args.complicazioni,
+                  backend=backend)
+        for i in range(args.rooms)
+    ]
+
+    counters = [None] * (args.rooms * args.drawers)
+    deadline = time.perf_counter() + args.seconds
+    threads = [
+        threading.Thread(target=drawer, args=(state, deadline, counters, r * args.drawers + d))
+        for r, state in enumerate(states)
+        for d in range(args.drawers)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ops = sum(c[0] for c in counters)
+    conflicts = sum(c[1] for c in counters)
+    stats = bag_metrics.stats()
+
+    print(f"Backend: {type(backend).__name__}")
+    print(f"Stanze: {args.rooms}, giocatori per stanza: {args.drawers}, durata: {elapsed:.2f}s")
+    print(f"Modifiche al sacchetto: {ops} ({ops / elapsed:.0f}/s)")
+    print(f"Ritentativi: {stats['retries']} (tasso {stats['retry_rate']:.4f} per modifica)")
+    print(f"Modifiche fallite dopo {os.environ.get('BAG_MAX_RETRIES', '8')} tentativi: {conflicts}")
+
+    lost = 0
+    for state in states:
+        bag = state.bag()
+        if (bag['successi'], bag['complicazioni']) != (args.successi, args.complicazioni):
+            lost += 1
+            print(f"❌ {state.room_id}: sacchetto {bag}, atteso "
+                  f"{{'successi': {args.successi}, 'complicazioni': {args.complicazioni}}}")
+    if lost:
+        sys.exit(1)
+    print("✅ Nessun token perso o duplicato")
+
+
+if __name__ == '__main__':
+    main()
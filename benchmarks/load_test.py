@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark di carico Socket.IO.
+
+Crea N stanze con fino a 10 giocatori ciascuna (registrazione, login,
+creazione e ingresso nella stanza), poi esegue un mix realistico di
+draw_tokens, risk_all, save_character e update_adrenaline alla frequenza
+indicata. Per ogni evento riporta latenza p50/p95/p99, throughput e query
+SQL per evento; il salvataggio write-behind delle stanze è misurato a parte
+come evento 'flush'.
+
+Usa il test client di Flask-SocketIO: tutti i client girano nello stesso
+processo e gli eventi sono eseguiti uno alla volta, quindi la latenza è il
+tempo di servizio dell'handler (senza rete).
+
+Uso:
+    python benchmarks/load_test.py --rooms 10 --players 6 --duration 20
+    python benchmarks/load_test.py --rooms 2 --players 4 --events 50 \\
+        --max-p95 draw_tokens=25 --max-queries save_character=6
+    DATABASE_URL=postgresql://... python benchmarks/load_test.py --rooms 20
+    python benchmarks/load_test.py --events 20 --sql-profile --fail-on-repeated
+
+Esce con codice 1 se una soglia (--max-p95, --max-queries, --max-error-rate)
+non è rispettata: si può usare in CI per trovare le regressioni. Con
+--sql-profile stampa anche il profilo SQL per evento (instrumentation.py) e
+fallisce se un evento supera il suo budget (SQL_QUERY_BUDGETS) o, con
+--fail-on-repeated, se esegue una query in un ciclo (N+1).
+"""
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_MIX = 'draw_tokens=50,risk_all=10,save_character=10,update_adrenaline=30'
+MAX_PLAYERS = 10
+
+
+def parse_pairs(values, cast=float):
+    """'evento=valore' (anche separati da virgola) -> {evento: valore}"""
+    pairs = {}
+    for value in values or []:
+        for item in value.split(','):
+            if item.strip():
+                name, number = item.split('=', 1)
+                pairs[name.strip()] = cast(number)
+    return pairs
+
+
+def percentile(sorted_values, pct):
+    """Percentile nearest-rank di una lista già ordinata"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Recorder:
+    """Latenze, errori e query SQL per evento"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.query_count = 0
+
+    def on_query(self, *args):
+        self.query_count += 1
+
+    @contextlib.contextmanager
+    def measure(self, event):
+        queries = self.query_count
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies[event].append(time.perf_counter() - start)
+            self.queries[event] += self.query_count - queries
+
+    def report(self):
+        rows = {}
+        for event, values in self.latencies.items():
+            values = sorted(values)
+            rows[event] = {
+                'count': len(values),
+                'errors': self.errors[event],
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'max_ms': values[-1] * 1000,
+                'queries_per_event': self.queries[event] / len(values)
+            }
+        return rows
+
+
+class Player:
+    """Un giocatore collegato con il proprio test client"""
+
+    def __init__(self, client, username, player_name):
+        self.client = client
+        self.username = username
+        self.player_name = player_name
+        self.user_id = None
+        self.room_id = None
+
+
+def load_app(database_url, quiet):
+    """Importa l'app configurata per il benchmark"""
+    os.environ['DATABASE_URL'] = database_url
+    # Niente task periodici: il flush viene chiamato dal benchmark
+    os.environ.setdefault('BAG_FLUSH_INTERVAL', '3600')
+    os.environ.setdefault('HISTORY_ARCHIVE_INTERVAL', '0')
+    os.environ.setdefault('STATE_COALESCE_WINDOW', '0')
+    os.environ.setdefault('MIGRATIONS_CHECK', '0')
+
+    output = io.StringIO() if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        import app as app_module
+        import migrations
+        migrations.upgrade(app_module.app)
+    return app_module
+
+
+def emit(recorder, player, event, payload):
+    """Invia un evento, misurandolo, e scarta i messaggi ricevuti"""
+    with recorder.measure(event):
+        player.client.emit(event, payload)
+    received = player.client.get_received()
+    errors = [r for r in received if r['name'] == 'error']
+    if errors:
+        recorder.errors[event] += 1
+    return received
+
+
+def character_sheet(rng, player_name):
+    traits = [{'id': 'archetype', 'name': 'Esploratrice', 'type': 'archetype'}]
+    traits += [{'id': f'q{i}', 'name': f'Qualità {i}', 'type': 'quality'} for i in range(4)]
+    traits += [{'id': f'a{i}', 'name': f'Abilità {i}', 'type': 'ability'} for i in range(6)]
+    return {
+        'name': f'Personaggio di {player_name}',
+        'motivation': 'Ritrovare la torre perduta',
+        'archetype': 'Esploratrice',
+        'photo': '',
+        'traits': traits,
+        'selected_traits': rng.sample([t['id'] for t in traits], 2),
+        'empowered_traits': [],
+        'quality_counter': rng.randint(0, 3),
+        'ability_counter': rng.randint(0, 3),
+        'misfortunes': ['', '', '', ''],
+        'lessons': ['', '', ''],
+        'resources': 'Corda, lanterna',
+        'notes': '<p>Appunti</p>' * rng.randint(1, 20)
+    }
+
+
+def event_payload(event, player, rng):
+    if event == 'draw_tokens':
+        return {
+            'room_id': player.room_id,
+            'player_name': player.player_name,
+            'num_tokens': rng.randint(1, 4),
+            'adrenaline': rng.random() < 0.1,
+            'confusion': rng.random() < 0.1
+        }
+    if event == 'risk_all':
+        return {
+            'room_id': player.room_id,
+            'player_name': player.player_name,
+            'num_tokens': rng.randint(1, 3),
+            'previous_successi': 1,
+            'previous_complicazioni': 1
+        }
+    if event == 'save_character':
+        return {
+            'room_id': player.room_id,
+            'player_name': player.player_name,
+            'character': character_sheet(rng, player.player_name)
+        }
+    if event == 'update_adrenaline':
+        return {
+            'room_id': player.room_id,
+            'player_name': player.player_name,
+            'adrenaline': rng.randint(0, 3)
+        }
+    raise ValueError(f'Evento non supportato: {event}')
+
+
+def setup_rooms(app_module, recorder, args, run_id):
+    """Registra i giocatori, crea le stanze e fa entrare tutti"""
+    socketio, app = app_module.socketio, app_module.app
+    rooms = []
+    for r in range(args.rooms):
+        players = []
+        for p in range(args.players):
+            username = f'load_{run_id}_{r}_{p}'
+            player = Player(socketio.test_client(app), username, f'Giocatore {p + 1}')
+            emit(recorder, player, 'register', {'username': username, 'password': 'password'})
+            received = emit(recorder, player, 'login', {'username': username, 'password': 'password'})
+            login = [m for m in received if m['name'] == 'login_success']
+            if not login:
+                raise RuntimeError(f'Login fallito per {username}: {received}')
+            player.user_id = login[0]['args'][0]['user_id']
+            players.append(player)
+
+        owner = players[0]
+        received = emit(recorder, owner, 'create_room', {'player_name': owner.player_name, 'user_id': owner.user_id})
+        room_id = [m for m in received if m['name'] == 'room_created'][0]['args'][0]['room_id']
+        for player in players:
+            player.room_id = room_id
+            emit(recorder, player, 'join_room', {
+                'room_id': room_id,
+                'player_name': player.player_name,
+                'user_id': player.user_id
+            })
+
+        # Sacchetto abbastanza grande per tutta la durata del test
+        emit(recorder, owner, 'configure_bag', {
+            'room_id': room_id,
+            'successi': args.bag,
+            'complicazioni': args.bag
+        })
+        rooms.append(players)
+    return rooms
+
+
+def run_workload(app_module, recorder, rooms, args, rng):
+    """Esegue il mix di eventi; restituisce (eventi, secondi)"""
+    mix = parse_pairs([args.mix])
+    events, weights = list(mix), list(mix.values())
+    players = [player for room in rooms for player in room]
+
+    # Coda (istante previsto, indice giocatore): ogni giocatore invia
+    # args.rate eventi al secondo (0 = il più velocemente possibile)
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    start = time.perf_counter()
+    queue = [(start + rng.random() * interval, i) for i in range(len(players))]
+    heapq.heapify(queue)
+
+    sent = defaultdict(int)
+    total = 0
+    next_flush = start + args.flush_interval
+    deadline = start + args.duration if args.duration else None
+
+    while queue:
+        due, index = heapq.heappop(queue)
+        now = time.perf_counter()
+        if deadline and now >= deadline:
+            break
+        if due > now:
+            time.sleep(due - now)
+
+        player = players[index]
+        event = rng.choices(events, weights)[0]
+        emit(recorder, player, event, event_payload(event, player, rng))
+        sent[index] += 1
+        total += 1
+
+        if time.perf_counter() >= next_flush:
+            flush(app_module, recorder)
+            next_flush = time.perf_counter() + args.flush_interval
+
+        if not args.events or sent[index] < args.events:
+            heapq.heappush(queue, (max(due + interval, time.perf_counter()), index))
+
+        # I broadcast si accumulano nelle code di tutti i client
+        if total % 200 == 0:
+            for other in players:
+                other.client.get_received()
+
+    elapsed = time.perf_counter() - start
+    flush(app_module, recorder)
+    return total, elapsed
+
+
+def flush(app_module, recorder):
+    """Salvataggio write-behind delle stanze (misurato come evento 'flush')"""
+    with app_module.app.app_context():
+        with recorder.measure('flush'):
+            app_module.active_rooms_cache.flush()
+
+
+def print_report(rows, total, elapsed, args):
+    print(f"\nStanze: {args.rooms}, giocatori per stanza: {args.players}, "
+          f"eventi: {total} in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} eventi/s)\n")
+    print(f"{'evento':<20} {'n':>7} {'errori':>7} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'query/ev':>9}")
+    for event, row in sorted(rows.items()):
+        print(f"{event:<20} {row['count']:>7} {row['errors']:>7} {row['p50_ms']:>8.2f} "
+              f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['max_ms']:>8.2f} "
+              f"{row['queries_per_event']:>9.2f}")
+
+
+def check_thresholds(rows, args):
+    """Soglie per la CI: restituisce la lista delle violazioni"""
+    failures = []
+    for event, limit in parse_pairs(args.max_p95).items():
+        row = rows.get(event)
+        if row and row['p95_ms'] > limit:
+            failures.append(f"{event}: p95 {row['p95_ms']:.2f} ms > {limit} ms")
+    for event, limit in parse_pairs(args.max_queries).items():
+        row = rows.get(event)
+        if row and row['queries_per_event'] > limit:
+            failures.append(f"{event}: {row['queries_per_event']:.2f} query/evento > {limit}")
+    if args.max_error_rate is not None:
+        for event, row in rows.items():
+            rate = row['errors'] / row['count']
+            if rate > args.max_error_rate:
+                failures.append(f"{event}: errori {rate:.1%} > {args.max_error_rate:.1%}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rooms', type=int, default=5)
+    parser.add_argument('--players', type=int, default=6, help=f'giocatori per stanza (max {MAX_PLAYERS})')
+    parser.add_argument('--duration', type=float, default=10.0, help='secondi di carico (0 = usa --events)')
+    parser.add_argument('--events', type=int, default=0, help='eventi per giocatore (0 = fino a --duration)')
+    parser.add_argument('--rate', type=float, default=2.0, help='eventi al secondo per giocatore (0 = senza pause)')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'pesi degli eventi (default {DEFAULT_MIX})')
+    parser.add_argument('--bag', type=int, default=100000, help='token per colore nel sacchetto')
+    parser.add_argument('--flush-interval', type=float, default=2.0, help='secondi tra due flush write-behind')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help='default: SQLite in una cartella temporanea')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='scrive i risultati in questo file')
+    parser.add_argument('--max-p95', action='append', help='soglia evento=ms (ripetibile)')
+    parser.add_argument('--max-queries', action='append', help='soglia evento=query per evento (ripetibile)')
+    parser.add_argument('--max-error-rate', type=float, help='frazione massima di eventi con errore')
+    parser.add_argument('--sql-profile', action='store_true', help='profilo SQL per evento e budget')
+    parser.add_argument('--fail-on-repeated', action='store_true',
+                        help='con --sql-profile, fallisce se trova query ripetute (N+1)')
+    parser.add_argument('--verbose', action='store_true', help='mostra i log dell\'app')
+    args = parser.parse_args()
+
+    if not 1 <= args.players <= MAX_PLAYERS:
+        parser.error(f'--players deve essere tra 1 e {MAX_PLAYERS}')
+    if not args.duration and not args.events:
+        parser.error('indica --duration o --events')
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load_test.db')}"
+    app_module = load_app(database_url, quiet=not args.verbose)
+    if args.sql_profile:
+        import instrumentation
+        instrumentation.profiler.enable()
+
+    from sqlalchemy import event
+    recorder = Recorder()
+    with app_module.app.app_context():
+        event.listen(app_module.db.engine, 'before_cursor_execute', recorder.on_query)
+
+    rng = random.Random(args.seed)
+    run_id = uuid.uuid4().hex[:6]
+    output = sys.stdout if args.verbose else io.StringIO()
+    with contextlib.redirect_stdout(output):
+        rooms = setup_rooms(app_module, recorder, args, run_id)
+        total, elapsed = run_workload(app_module, recorder, rooms, args, rng)
+
+    rows = recorder.report()
+    print_report(rows, total, elapsed, args)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as out:
+            json.dump({
+                'rooms': args.rooms,
+                'players': args.players,
+                'events': total,
+                'seconds': elapsed,
+                'throughput': total / elapsed if elapsed else 0.0,
+                'per_event': rows
+            }, out, indent=2)
+
+    failures = check_thresholds(rows, args)
+    if args.sql_profile:
+        profiler = instrumentation.profiler
+        print(f"\n{profiler.report()}")
+        failures += profiler.violations
+        if args.fail_on_repeated:
+            for event, profile in profiler.profiles().items():
+                for shape in profile.repeated:
+                    failures.append(f"{event}: query ripetuta (N+1): {shape[:instrumentation.SHAPE_PREVIEW]}")
+    if failures:
+        print("\n❌ Soglie non rispettate:")
+        for failure in failures:
+            print(f"   {failure}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark di SQLite: configurazione di sviluppo contro SQLITE_MODE=production.
+
+Alcuni thread scrivono (estrazione nello storico + sacchetto della stanza,
+oppure salvataggio di una scheda, una transazione per operazione) mentre
+altri leggono (ultima pagina di storico e schede della stanza). Per ogni
+configurazione riporta operazioni al secondo, latenza p50/p95/p99 ed errori
+("database is locked").
+
+Uso:
+    python benchmarks/sqlite_mode.py --writers 4 --readers 8 --seconds 5
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, exc, select, update  # noqa: E402
+
+import sqlite_mode  # noqa: E402
+from models import db, User, Room, Character, DrawHistory  # noqa: E402
+
+ROOMS = 4
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def make_engine(mode, path):
+    if mode == 'production':
+        engine = create_engine(f'sqlite:///{path}', **sqlite_mode.engine_options())
+        sqlite_mode.configure_engine(engine)
+    else:
+        # Come il fallback di sviluppo di app.py
+        engine = create_engine(f'sqlite:///{path}?check_same_thread=False',
+                               pool_pre_ping=True, pool_recycle=300)
+    return engine
+
+
+def seed(engine, history):
+    db.metadata.create_all(engine)
+    rng = random.Random(1)
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [{'id': 1, 'username': 'bench', 'password_hash': 'x'}])
+        conn.execute(Room.__table__.insert(), [
+            {'id': i, 'room_id': f'room{i}', 'owner_id': 1, 'bag_successi': 1000, 'bag_complicazioni': 1000}
+            for i in range(1, ROOMS + 1)
+        ])
+        conn.execute(Character.__table__.insert(), [
+            {'room_id': room, 'user_id': 1, 'player_name': f'Giocatore {p}', 'name': f'Personaggio {p}',
+             'traits': [{'id': f't{t}', 'name': f'Tratto {t}'} for t in range(10)], 'notes': '', 'version': 0}
+            for room in range(1, ROOMS + 1) for p in range(6)
+        ])
+        conn.execute(DrawHistory.__table__.insert(), [
+            {'room_id': rng.randint(1, ROOMS), 'player_name': 'Giocatore 0',
+             'drawn_tokens': ['successo', 'complicazione'], 'successi': 1, 'complicazioni': 1,
+             'timestamp': datetime.utcnow()}
+            for _ in range(history)
+        ])
+
+
+def write_op(conn, rng):
+    room = rng.randint(1, ROOMS)
+    if rng.random() < 0.8:
+        drawn = [rng.choice(('successo', 'complicazione')) for _ in range(rng.randint(1, 4))]
+        successi = drawn.count('successo')
+        conn.execute(DrawHistory.__table__.insert().values(
+            room_id=room, player_name='Giocatore 1', drawn_tokens=drawn,
+            successi=successi, complicazioni=len(drawn) - successi, timestamp=datetime.utcnow()
+        ))
+        conn.execute(update(Room.__table__).where(Room.__table__.c.id == room).values(
+            bag_successi=Room.__table__.c.bag_successi - successi,
+            version=Room.__table__.c.version + 1
+        ))
+    else:
+        conn.execute(update(Character.__table__).where(
+            Character.__table__.c.room_id == room,
+            Character.__table__.c.player_name == f'Giocatore {rng.randint(0, 5)}'
+        ).values(notes='<p>' + 'x' * rng.randint(100, 2000) + '</p>',
+                 version=Character.__table__.c.version + 1))
+
+
+def read_op(conn, rng):
+    room = rng.randint(1, ROOMS)
+    history = DrawHistory.__table__
+    conn.execute(select(history).where(history.c.room_id == room)
+                 .order_by(history.c.timestamp.desc(), history.c.id.desc()).limit(50)).fetchall()
+    conn.execute(select(Character.__table__).where(Character.__table__.c.room_id == room)).fetchall()
+
+
+def worker(engine, kind, deadline, seed_value, latencies, errors):
+    rng = random.Random(seed_value)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if kind == 'write':
+                with engine.begin() as conn:
+                    write_op(conn, rng)
+            else:
+                with engine.connect() as conn:
+                    read_op(conn, rng)
+        except exc.OperationalError:
+            errors[kind] += 1
+            continue
+        latencies[kind].append(time.perf_counter() - start)
+
+
+def run(mode, args):
+    path = os.path.join(tempfile.mkdtemp(), f'{mode}.db')
+    engine = make_engine(mode, path)
+    seed(engine, args.history)
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    deadline = time.perf_counter() + args.seconds
+    threads = [threading.Thread(target=worker, args=(engine, 'write', deadline, i, latencies, errors))
+               for i in range(args.writers)]
+    threads += [threading.Thread(target=worker, args=(engine, 'read', deadline, 1000 + i, latencies, errors))
+                for i in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    for kind in ('write', 'read'):
+        values = sorted(latencies[kind])
+        print(f"{mode:<11} {kind:<6} {len(values) / args.seconds:>9.1f} "
+              f"{percentile(values, 50) * 1000:>8.2f} {percentile(values, 95) * 1000:>8.2f} "
+              f"{percentile(values, 99) * 1000:>8.2f} {errors[kind]:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--history', type=int, default=5000, help='estrazioni già presenti nello storico')
+    parser.add_argument('--mode', choices=('dev', 'production', 'both'), default='both')
+    args = parser.parse_args()
+
+    print(f"{'modalità':<11} {'op':<6} {'op/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errori':>7}")
+    for mode in ('dev', 'production'):
+        if args.mode in (mode, 'both'):
+            run(mode, args)
+
+
+if __name__ == '__main__':
+    main()
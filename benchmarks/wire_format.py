@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark del formato compatto dei messaggi.
+
+Confronta dimensione e tempo di codifica dei payload attuali in JSON (come
+li serializza python-socketio) con lo schema compatto in MessagePack di
+wire_format.py, per tokens_drawn, risk_all_result, room_joined e
+characters_loaded.
+
+Uso:
+    python benchmarks/wire_format.py --players 6 --history 20
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import draw_engine  # noqa: E402
+import wire_format  # noqa: E402
+from models import Character  # noqa: E402
+
+
+def draw_payload(player, outcome, timestamp, risk_all=False):
+    """Payload di tokens_drawn / risk_all_result come li costruisce app.py"""
+    history = {
+        'player': player,
+        'drawn': outcome.drawn,
+        'successi': outcome.successi,
+        'complicazioni': outcome.complicazioni,
+        'timestamp': timestamp.isoformat()
+    }
+    payload = {
+        'player': player,
+        'drawn': outcome.drawn,
+        'successi': outcome.successi,
+        'complicazioni': outcome.complicazioni,
+        'bag_remaining': {
+            'successi': outcome.bag_successi,
+            'complicazioni': outcome.bag_complicazioni
+        },
+        'history': history
+    }
+    if risk_all:
+        history.update(risk_all=True, total_successi=outcome.successi + 2, total_complicazioni=outcome.complicazioni)
+        payload.update(total_successi=outcome.successi + 2, total_complicazioni=outcome.complicazioni)
+    else:
+        history.update(adrenaline=False, confusion=False)
+        payload.update(adrenaline=False, confusion=False)
+    return payload
+
+
+def character(index, player):
+    traits = [{'id': 'archetype', 'name': 'Esploratrice', 'type': 'archetype'}]
+    traits += [{'id': f'q{i}', 'name': f'Qualità numero {i}', 'type': 'quality'} for i in range(4)]
+    traits += [{'id': f'a{i}', 'name': f'Abilità numero {i}', 'type': 'ability'} for i in range(6)]
+    return Character(
+        id=index, player_name=player, name=f'Personaggio {index}',
+        motivation='Ritrovare la torre perduta prima dell\'inverno',
+        archetype='Esploratrice', photo='ab' * 32, traits=traits,
+        selected_traits=['q0', 'a1'], empowered_traits=['a2'],
+        quality_counter=2, ability_counter=3,
+        misfortunes=['Ferita alla gamba', '', '', ''],
+        lessons=['Non fidarti del mercante', '', ''],
+        resources='Corda, lanterna, mappa', notes='<p>Appunti della sessione</p>' * 5,
+        visible_to_all=True, version=3
+    ).to_dict()
+
+
+def socketio_json(event, payload):
+    """Pacchetto di testo come lo codifica python-socketio"""
+    return '2' + json.dumps([event, payload], separators=(',', ':'))
+
+
+def measure(name, event, payload, compact, number):
+    json_size = len(socketio_json(event, payload).encode('utf-8'))
+    json_time = timeit.timeit(lambda: socketio_json(event, payload), number=number) / number
+
+    packed_size = len(wire_format.pack(compact(payload)))
+    packed_time = timeit.timeit(lambda: wire_format.pack(compact(payload)), number=number) / number
+
+    print(f"{name:<20} {json_size:>8} B {json_time * 1e6:>8.1f} us"
+          f" | {packed_size:>8} B {packed_time * 1e6:>8.1f} us"
+          f" | {packed_size / json_size:>6.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--players', type=int, default=6)
+    parser.add_argument('--history', type=int, default=20)
+    parser.add_argument('--number', type=int, default=5000, help='ripetizioni per la misura del tempo')
+    args = parser.parse_args()
+
+    if wire_format.msgpack is None:
+        sys.exit('msgpack non installato: pip install msgpack')
+
+    rng = random.Random(42)
+    players = [f'Giocatore {i}' for i in range(args.players)]
+    now = datetime.utcnow()
+
+    tokens_drawn = draw_payload(players[0], draw_engine.draw(12, 8, 4, rng=rng), now)
+    risk_all = draw_payload(players[1], draw_engine.draw(8, 6, 2, rng=rng), now, risk_all=True)
+
+    history = []
+    for i in range(args.history):
+        entry = draw_payload(rng.choice(players), draw_engine.draw(20, 20, rng.randint(1, 4), rng=rng),
+                             now - timedelta(minutes=i))['history']
+        history.append(entry)
+    room_joined = {
+        'room_id': 'ab12cd34',
+        'player_name': players[0],
+        'room_data': {
+            'room_id': 'ab12cd34',
+            'players': players,
+            'owner_name': players[0],
+            'bag': {'successi': 12, 'complicazioni': 8},
+            'history': history
+        }
+    }
+
+    characters_loaded = {
+        'characters': {player: character(i, player) for i, player in enumerate(players)},
+        'is_master': False
+    }
+
+    print(f"{'evento':<20} {'JSON':>10} {'codifica':>11} | {'msgpack':>10} {'codifica':>11} | {'dim.':>6}")
+    measure('tokens_drawn', 'tokens_drawn', tokens_drawn, wire_format.compact_tokens_drawn, args.number)
+    measure('risk_all_result', 'risk_all_result', risk_all, wire_format.compact_risk_all_result, args.number)
+    measure('room_joined', 'room_joined', room_joined, wire_format.compact_room_joined, args.number)
+    measure('characters_loaded', 'characters_loaded', characters_loaded,
+            wire_format.compact_characters_loaded, args.number)
+
+
+if __name__ == '__main__':
+    main()
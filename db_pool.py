@@ -0,0 +1,116 @@
+"""
+Pool di connessioni per PostgreSQL compatibile con eventlet.
+
+Con il monkey patching di eventlet i lock e le code usati da QueuePool
+diventano cooperativi, e Flask-SQLAlchemy assegna una sessione (quindi una
+connessione) a ogni contesto applicativo: ogni greenlet usa la propria
+connessione, presa dal pool e restituita alla fine dell'evento.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+try:
+    # Rende psycopg2 cooperativo con eventlet (dipendenza opzionale)
+    from psycogreen.eventlet import patch_psycopg
+except ImportError:
+    patch_psycopg = None
+
+
+class PoolMetrics:
+    """Metriche di checkout del pool di connessioni"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.connections_created = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.pool = None
+        self._lock = threading.Lock()
+
+    def record_checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_connect(self):
+        with self._lock:
+            self.connections_created += 1
+
+    def stats(self):
+        """Contatori del pool e stato corrente"""
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'connections_created': self.connections_created,
+                'wait_avg_ms': (self.wait_total / self.checkouts * 1000) if self.checkouts else 0.0,
+                'wait_max_ms': self.wait_max * 1000
+            }
+        if self.pool is not None:
+            stats['size'] = self.pool.size()
+            stats['checked_out'] = self.pool.checkedout()
+            stats['overflow'] = self.pool.overflow()
+        return stats
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool che misura l'attesa di ogni checkout"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool_metrics.pool = self
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_timeout()
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - start)
+        return conn
+
+    def _create_connection(self):
+        pool_metrics.record_connect()
+        return super()._create_connection()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool_metrics.pool = pool
+        return pool
+
+
+def postgres_engine_options():
+    """Opzioni dell'engine PostgreSQL lette dalle variabili d'ambiente.
+
+    DB_POOL=null torna a NullPool (es. dietro PgBouncer in transaction mode).
+    """
+    if patch_psycopg is not None:
+        patch_psycopg()
+
+    if os.environ.get('DB_POOL', 'queue').lower() == 'null':
+        return {'poolclass': NullPool}
+
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', '300')),
+        'pool_pre_ping': True,
+        'pool_use_lifo': True  # le connessioni inattive in eccesso scadono col recycle
+    }
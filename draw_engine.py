@@ -0,0 +1,231 @@
+"""
+Motore di estrazione dei token.
+
+Un'unica funzione gestisce estrazione normale, adrenalina, confusione e
+rischia tutto. Il numero di token bianchi estratti viene campionato in un
+solo passo con una distribuzione ipergeometrica (estrazione senza
+reinserimento), invece di estrarre un token alla volta.
+
+odds() calcola la distribuzione esatta degli stessi risultati per
+l'anteprima delle probabilità.
+"""
+import math
+import os
+import random
+from collections import namedtuple
+from fractions import Fraction
+from functools import lru_cache
+
+# Token estratti con adrenalina
+ADRENALINE_TOKENS = 4
+
+# Massimo di token in una sola estrazione (anche rischiando tutto)
+MAX_TOKENS = 5
+
+# Distribuzioni di probabilità tenute in cache
+ODDS_CACHE_SIZE = int(os.environ.get('ODDS_CACHE_SIZE', '4096'))
+
+# Token nel sacchetto oltre cui odds() rifiuta il calcolo (l'anteprima gira nel loop di eventlet)
+ODDS_MAX_BAG = int(os.environ.get('ODDS_MAX_BAG', '500'))
+
+# Modalità di odds(): rischia tutto usa la distribuzione normale
+ODDS_MODES = ('normal', 'confusion')
+
+DrawResult = namedtuple('DrawResult', [
+    'drawn',              # lista di 'successo' / 'complicazione'
+    'successi',
+    'complicazioni',
+    'bag_successi',       # sacchetto rimanente
+    'bag_complicazioni'
+])
+
+
+class NotEnoughTokens(ValueError):
+    """Il sacchetto non contiene abbastanza token per l'estrazione"""
+
+
+class InvalidDraw(ValueError):
+    """Numero di token da estrarre non valido"""
+
+
+def check_num_tokens(num_tokens):
+    """Numero di token come intero tra 1 e MAX_TOKENS; solleva InvalidDraw altrimenti"""
+    if isinstance(num_tokens, bool):
+        raise InvalidDraw('Numero di token non valido')
+    try:
+        value = int(num_tokens)
+    except (TypeError, ValueError):
+        raise InvalidDraw('Numero di token non valido')
+    if not 1 <= value <= MAX_TOKENS:
+        raise InvalidDraw(f'Si possono estrarre da 1 a {MAX_TOKENS} token')
+    return value
+
+
+def effective_num_tokens(num_tokens, adrenaline=False, risk_all=False):
+    """Token effettivamente estratti: prima l'adrenalina (4 token), poi check_num_tokens"""
+    if adrenaline and not risk_all:
+        num_tokens = ADRENALINE_TOKENS
+    return check_num_tokens(num_tokens)
+
+
+def _log_comb(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+
+def hypergeometric(good, bad, n, rng=random):
+    """Numero di token 'good' estratti prendendone n senza reinserimento.
+
+    Usa l'inversione partendo dalla moda: un solo numero casuale e un numero
+    di passi proporzionale alla deviazione standard, non ai token estratti.
+    """
+    total = good + bad
+    low = max(0, n - bad)
+    high = min(n, good)
+    if low == high:
+        return low
+
+    mode = (n + 1) * (good + 1) // (total + 2)
+    mode = min(max(mode, low), high)
+    log_p = _log_comb(good, mode) + _log_comb(bad, n - mode) - _log_comb(total, n)
+    p_mode = math.exp(log_p)
+
+    u = rng.random() - p_mode
+    if u <= 0:
+        return mode
+
+    # Cammina alternando sotto e sopra la moda usando il rapporto tra termini
+    down_k, down_p = mode, p_mode
+    up_k, up_p = mode, p_mode
+    while down_k > low or up_k < high:
+        if up_k < high:
+            up_p *= (good - up_k) * (n - up_k) / ((up_k + 1) * (bad - n + up_k + 1))
+            up_k += 1
+            u -= up_p
+            if u <= 0:
+                return up_k
+        if down_k > low:
+            down_p *= down_k * (bad - n + down_k) / ((good - down_k + 1) * (n - down_k + 1))
+            down_k -= 1
+            u -= down_p
+            if u <= 0:
+                return down_k
+
+    # Errore di arrotondamento: la moda è il risultato più probabile
+    return mode
+
+
+def binomial_half(n, rng=random):
+    """Numero di successi su n lanci di moneta, con un solo numero casuale"""
+    if n <= 0:
+        return 0
+    return bin(rng.getrandbits(n)).count('1')
+
+
+def draw(bag_successi, bag_complicazioni, num_tokens,
+         adrenaline=False, confusion=False, risk_all=False, rng=None):
+    """Estrai token dal sacchetto.
+
+    - adrenalina: si estraggono sempre 4 token
+    - confusione: i token bianchi estratti diventano casuali (50/50),
+      i neri restano neri; dal sacchetto si tolgono i token fisici estratti
+    - rischia tutto: estrazione normale, senza adrenalina né confusione
+
+    Solleva InvalidDraw se num_tokens non è tra 1 e MAX_TOKENS e
+    NotEnoughTokens se il sacchetto non basta.
+    """
+    rng = rng or random
+
+    if risk_all:
+        adrenaline = False
+        confusion = False
+    num_tokens = effective_num_tokens(num_tokens, adrenaline)
+
+    if bag_successi + bag_complicazioni < num_tokens:
+        raise NotEnoughTokens('Non ci sono abbastanza token nel sacchetto')
+
+    # Bianchi fisicamente estratti
+    whites = hypergeometric(max(0, bag_successi), max(0, bag_complicazioni), num_tokens, rng)
+    blacks = num_tokens - whites
+
+    if confusion:
+        successi = binomial_half(whites, rng)
+    else:
+        successi = whites
+    complicazioni = num_tokens - successi
+
+    drawn = ['successo'] * successi + ['complicazione'] * complicazioni
+    rng.shuffle(drawn)
+
+    return DrawResult(
+        drawn=drawn,
+        successi=successi,
+        complicazioni=complicazioni,
+        bag_successi=bag_successi - whites,
+        bag_complicazioni=bag_complicazioni - blacks
+    )
+
+
+def _hypergeometric_weights(good, bad, n):
+    """Pesi interi C(good, k) * C(bad, n - k) per k = 0..n, calcolati in un passo.
+
+    Ogni termine si ricava dal precedente con un rapporto di interi, senza
+    ricalcolare i coefficienti binomiali.
+    """
+    weights = [0] * (n + 1)
+    low = max(0, n - bad)
+    high = min(n, good)
+    if low > high:
+        return weights
+
+    weight = math.comb(good, low) * math.comb(bad, n - low)
+    weights[low] = weight
+    for k in range(low, high):
+        weight = weight * (good - k) * (n - k) // ((k + 1) * (bad - n + k + 1))
+        weights[k + 1] = weight
+    return weights
+
+
+@lru_cache(maxsize=ODDS_CACHE_SIZE)
+def _odds(bag_successi, bag_complicazioni, num_tokens, mode):
+    weights = _hypergeometric_weights(bag_successi, bag_complicazioni, num_tokens)
+    total = sum(weights)
+
+    if mode == 'confusion':
+        # Ogni bianco estratto è un successo con probabilità 1/2:
+        # P(s) = sum_k P(k) * C(k, s) / 2^k, su denominatore comune 2^n
+        mixed = [0] * (num_tokens + 1)
+        for whites, weight in enumerate(weights):
+            if not weight:
+                continue
+            scale = weight << (num_tokens - whites)
+            for s in range(whites + 1):
+                mixed[s] += scale * math.comb(whites, s)
+        weights = mixed
+        total <<= num_tokens
+
+    return tuple(float(Fraction(weight, total)) for weight in weights)
+
+
+def odds(bag_successi, bag_complicazioni, num_tokens,
+         adrenaline=False, confusion=False, risk_all=False):
+    """Distribuzione esatta dei successi per un'estrazione con le stesse regole di draw().
+
+    Restituisce (num_tokens effettivi, tupla di probabilità indicizzata per
+    numero di successi); le complicazioni sono num_tokens - successi.
+    Solleva InvalidDraw e NotEnoughTokens come draw(), e InvalidDraw se il
+    sacchetto supera ODDS_MAX_BAG token.
+    """
+    if risk_all:
+        adrenaline = False
+        confusion = False
+    num_tokens = effective_num_tokens(num_tokens, adrenaline)
+
+    bag_successi = max(0, bag_successi)
+    bag_complicazioni = max(0, bag_complicazioni)
+    if bag_successi + bag_complicazioni > ODDS_MAX_BAG:
+        raise InvalidDraw(f'Anteprima disponibile fino a {ODDS_MAX_BAG} token nel sacchetto')
+    if bag_successi + bag_complicazioni < num_tokens:
+        raise NotEnoughTokens('Non ci sono abbastanza token nel sacchetto')
+
+    mode = 'confusion' if confusion else 'normal'
+    return num_tokens, _odds(bag_successi, bag_complicazioni, num_tokens, mode)
@@ -0,0 +1,191 @@
+"""
+Statistiche delle estrazioni mantenute in modo incrementale.
+
+Per ogni stanza c'è una riga DrawStats con i totali della stanza
+(player_name == '') e una riga per giocatore; gli istogrammi sono righe
+DrawStatsBucket (stanza, giocatore, tipo, valore, conteggio). Le righe
+vengono aggiornate nella stessa transazione che scrive lo storico
+(RoomStateRegistry.flush), così leggere le statistiche costa due query
+sulle sole righe della stanza invece di un'aggregazione su tutto
+draw_history.
+
+Con più worker i contatori vengono solo incrementati, mai letti e
+riscritti: ogni flush esegue un solo upsert (INSERT ... ON CONFLICT DO
+UPDATE SET col = col + excluded.col) per tutte le righe DrawStats e uno
+per tutti i bucket, qualunque sia il numero di giocatori.
+"""
+from datetime import datetime
+from itertools import chain
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, DrawHistory, DrawStats, DrawStatsBucket
+from history_archive import iter_archived_history
+
+# player_name della riga con i totali della stanza
+ROOM_TOTAL = ''
+
+COUNTERS = (
+    'draws', 'tokens', 'successi', 'complicazioni',
+    'adrenaline', 'confusion', 'risk_all', 'risk_all_blown',
+    'bag_size_sum', 'bag_size_draws'
+)
+
+
+def _empty_delta():
+    delta = dict.fromkeys(COUNTERS, 0)
+    delta['histogram'] = {'successi': {}, 'complicazioni': {}}
+    return delta
+
+
+def _add_draw(delta, successi, complicazioni,
+              adrenaline=False, confusion=False, risk_all=False, bag_size=None):
+    """Somma un'estrazione ai contatori"""
+    successi = successi or 0
+    complicazioni = complicazioni or 0
+
+    delta['draws'] += 1
+    delta['tokens'] += successi + complicazioni
+    delta['successi'] += successi
+    delta['complicazioni'] += complicazioni
+    delta['adrenaline'] += 1 if adrenaline else 0
+    delta['confusion'] += 1 if confusion else 0
+    if risk_all:
+        delta['risk_all'] += 1
+        # Rischiare tutto "va male" quando esce almeno una complicazione
+        delta['risk_all_blown'] += 1 if complicazioni else 0
+    if bag_size is not None:
+        delta['bag_size_sum'] += bag_size
+        delta['bag_size_draws'] += 1
+
+    for key, value in (('successi', successi), ('complicazioni', complicazioni)):
+        bucket = delta['histogram'][key]
+        bucket[str(value)] = bucket.get(str(value), 0) + 1
+
+
+def _deltas(entries):
+    """Contatori da sommare per stanza e per giocatore: {player_name: delta}"""
+    deltas = {ROOM_TOTAL: _empty_delta()}
+    for entry in entries:
+        player = entry.get('player_name', entry.get('player')) or ''
+        flags = dict(
+            adrenaline=entry.get('adrenaline'),
+            confusion=entry.get('confusion'),
+            risk_all=entry.get('risk_all'),
+            bag_size=entry.get('bag_size')
+        )
+        _add_draw(deltas[ROOM_TOTAL], entry.get('successi'), entry.get('complicazioni'), **flags)
+        if player:
+            deltas.setdefault(player, _empty_delta())
+            _add_draw(deltas[player], entry.get('successi'), entry.get('complicazioni'), **flags)
+    return deltas
+
+
+def _insert(table):
+    dialect = db.session.get_bind().dialect.name
+    return (postgresql if dialect == 'postgresql' else sqlite).insert(table)
+
+
+def _write(statement, rows, key_columns, counters, rebuild, replaced=()):
+    """Un solo INSERT per tutte le righe; senza rebuild somma i contatori alle righe esistenti"""
+    if not rows:
+        return
+    if not rebuild:
+        # La ricostruzione resta un INSERT semplice: due worker che ricostruiscono
+        # la stessa stanza falliscono sulla chiave invece di contare due volte
+        values = {counter: statement.table.c[counter] + statement.excluded[counter] for counter in counters}
+        values.update({column: statement.excluded[column] for column in replaced})
+        statement = statement.on_conflict_do_update(index_elements=key_columns, set_=values)
+    db.session.execute(statement, rows)
+
+
+def _write_deltas(room_pk, deltas, rebuild=False):
+    now = datetime.utcnow()
+    stats_rows = [
+        dict(room_id=room_pk, player_name=player_name, updated_at=now,
+             **{counter: delta[counter] for counter in COUNTERS})
+        for player_name, delta in deltas.items()
+    ]
+    bucket_rows = [
+        dict(room_id=room_pk, player_name=player_name, kind=kind, value=int(value), count=count)
+        for player_name, delta in deltas.items()
+        for kind, bucket in delta['histogram'].items()
+        for value, count in bucket.items()
+    ]
+    _write(_insert(DrawStats.__table__), stats_rows,
+           ['room_id', 'player_name'], COUNTERS, rebuild, replaced=('updated_at',))
+    _write(_insert(DrawStatsBucket.__table__), bucket_rows,
+           ['room_id', 'player_name', 'kind', 'value'], ('count',), rebuild)
+
+
+def _existing_history(room_pk):
+    """Estrazioni già salvate della stanza (archivio + tabella draw_history)"""
+    yield from iter_archived_history(room_pk)
+    query = db.session.query(
+        DrawHistory.player_name, DrawHistory.successi, DrawHistory.complicazioni,
+        DrawHistory.adrenaline, DrawHistory.confusion, DrawHistory.risk_all
+    ).filter(DrawHistory.room_id == room_pk).yield_per(1000)
+    for row in query:
+        yield row._asdict()
+
+
+def _has_totals(room_pk):
+    return db.session.query(DrawStats.room_id) \
+        .filter_by(room_id=room_pk, player_name=ROOM_TOTAL) \
+        .first() is not None
+
+
+def record_draws(room_pk, entries):
+    """Aggiorna le statistiche con le estrazioni in sospeso (senza commit).
+
+    Va chiamata prima di aggiungere le stesse estrazioni alla sessione,
+    perché un'eventuale ricostruzione non le conti due volte. Se la stanza
+    non ha ancora statistiche, i contatori vengono ricostruiti dallo storico
+    già salvato (una sola volta per stanza).
+    """
+    if not entries:
+        return
+    if _has_totals(room_pk):
+        _write_deltas(room_pk, _deltas(entries))
+    else:
+        _write_deltas(room_pk, _deltas(chain(_existing_history(room_pk), entries)), rebuild=True)
+
+
+def _stats_dict(row, histogram):
+    stats = {counter: getattr(row, counter) or 0 for counter in COUNTERS}
+    stats['histogram'] = histogram
+    tokens = stats['tokens']
+    stats['success_rate'] = stats['successi'] / tokens if tokens else None
+    stats['avg_bag_size'] = stats['bag_size_sum'] / stats['bag_size_draws'] if stats['bag_size_draws'] else None
+    stats['updated_at'] = row.updated_at.isoformat() if row.updated_at else None
+    return stats
+
+
+def get_room_stats(room_pk):
+    """Statistiche della stanza: {'room': totali, 'players': {nome: statistiche}}"""
+    rows = DrawStats.query.filter_by(room_id=room_pk).all()
+    if not any(row.player_name == ROOM_TOTAL for row in rows):
+        try:
+            _write_deltas(room_pk, _deltas(_existing_history(room_pk)), rebuild=True)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        rows = DrawStats.query.filter_by(room_id=room_pk).all()
+
+    histograms = {row.player_name: {'successi': {}, 'complicazioni': {}} for row in rows}
+    buckets = db.session.query(
+        DrawStatsBucket.player_name, DrawStatsBucket.kind, DrawStatsBucket.value, DrawStatsBucket.count
+    ).filter(DrawStatsBucket.room_id == room_pk).all()
+    for player_name, kind, value, count in buckets:
+        histograms.setdefault(player_name, {'successi': {}, 'complicazioni': {}})[kind][str(value)] = count
+
+    players = {}
+    room_stats = None
+    for row in rows:
+        if row.player_name == ROOM_TOTAL:
+            room_stats = _stats_dict(row, histograms[row.player_name])
+        else:
+            players[row.player_name] = _stats_dict(row, histograms[row.player_name])
+
+    return {'room': room_stats, 'players': players}
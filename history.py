@@ -0,0 +1,66 @@
+"""
+Storico delle estrazioni paginato a cursore.
+
+Le pagine sono ordinate dalla più recente con chiave (timestamp, id) e
+usano l'indice composito (room_id, timestamp, id): il costo di una pagina
+non cresce con la lunghezza dello storico.
+"""
+import base64
+from datetime import datetime
+
+from models import db, DrawHistory
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Filtri booleani accettati da get_history_page
+FLAG_FILTERS = ('risk_all', 'adrenaline', 'confusion')
+
+
+class InvalidCursor(ValueError):
+    """Cursore di paginazione non valido"""
+
+
+def encode_cursor(entry):
+    """Cursore che punta subito dopo l'estrazione indicata"""
+    raw = f'{entry.timestamp.isoformat()}|{entry.id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Restituisce (timestamp, id) dal cursore"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, entry_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(entry_id)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor('Cursore non valido')
+
+
+def get_history_page(room_pk, cursor=None, limit=DEFAULT_PAGE_SIZE, player=None, **flags):
+    """Una pagina di storico della stanza, dalla più recente.
+
+    flags accetta risk_all, adrenaline e confusion (True/False) per filtrare.
+    Restituisce (voci, cursore_successivo); il cursore è None all'ultima pagina.
+    """
+    limit = max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+    query = DrawHistory.query.filter(DrawHistory.room_id == room_pk)
+
+    if cursor:
+        timestamp, entry_id = decode_cursor(cursor)
+        query = query.filter(db.tuple_(DrawHistory.timestamp, DrawHistory.id) < (timestamp, entry_id))
+
+    if player:
+        query = query.filter(DrawHistory.player_name == player)
+
+    for flag in FLAG_FILTERS:
+        value = flags.get(flag)
+        if value is not None:
+            query = query.filter(getattr(DrawHistory, flag).is_(bool(value)))
+
+    # Una voce in più per sapere se esiste una pagina successiva
+    rows = query.order_by(DrawHistory.timestamp.desc(), DrawHistory.id.desc()).limit(limit + 1).all()
+
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [row.to_dict() for row in rows[:limit]], next_cursor
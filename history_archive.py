@@ -0,0 +1,225 @@
+"""
+Conservazione e archiviazione dello storico delle estrazioni.
+
+Le estrazioni più vecchie di HISTORY_RETENTION_DAYS, o oltre le ultime
+HISTORY_MAX_ROWS_PER_ROOM di una stanza, vengono spostate dalla tabella
+draw_history in segmenti NDJSON compressi (gzip), con contatori riassuntivi
+per stanza. La tabella "calda" resta piccola; lo storico archiviato si può
+rileggere come flusso.
+
+Con più worker ogni segmento viene archiviato sotto un lock della stanza
+(advisory lock di transazione su PostgreSQL): un worker che trova la
+stanza occupata la salta. In ogni caso la transazione fallisce se le righe
+da eliminare non sono più tutte in draw_history, così lo stesso storico
+non finisce mai in due segmenti.
+"""
+import gzip
+import io
+import json
+import os
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from models import db, DrawHistory, HistoryArchiveSegment, HistoryArchiveSummary
+from room_snapshot import HISTORY_LIMIT
+
+# Età massima (giorni) delle estrazioni nella tabella draw_history
+RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', '30'))
+
+# Estrazioni più recenti mantenute per stanza (mai meno di quelle mostrate al join)
+MAX_ROWS_PER_ROOM = max(int(os.environ.get('HISTORY_MAX_ROWS_PER_ROOM', '500')), HISTORY_LIMIT)
+
+# Estrazioni per segmento archiviato
+SEGMENT_SIZE = int(os.environ.get('HISTORY_ARCHIVE_SEGMENT_SIZE', '1000'))
+
+# Intervallo (secondi) tra due passaggi di archiviazione; 0 disattiva
+ARCHIVE_INTERVAL = float(os.environ.get('HISTORY_ARCHIVE_INTERVAL', '3600'))
+
+# Prima chiave degli advisory lock PostgreSQL dell'archiviazione (la seconda è la stanza)
+ADVISORY_LOCK_CLASS = 4191_2212
+
+
+def _lock_room(room_pk):
+    """Lock della stanza fino alla fine della transazione; False se è già di un altro worker"""
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return True
+    return db.session.execute(
+        sa.text("SELECT pg_try_advisory_xact_lock(:lock_class, :room_pk)"),
+        {'lock_class': ADVISORY_LOCK_CLASS, 'room_pk': room_pk}
+    ).scalar()
+
+
+def _boundary(room_pk, offset):
+    """Chiave (timestamp, id) della estrazione in posizione offset dalla più recente"""
+    return db.session.query(DrawHistory.timestamp, DrawHistory.id) \
+        .filter(DrawHistory.room_id == room_pk) \
+        .order_by(DrawHistory.timestamp.desc(), DrawHistory.id.desc()) \
+        .offset(offset) \
+        .limit(1) \
+        .first()
+
+
+def _archive_condition(room_pk, now):
+    """Condizione SQL delle estrazioni da archiviare per una stanza.
+
+    Le ultime HISTORY_LIMIT estrazioni (quelle mostrate al join) non vengono
+    mai archiviate, nemmeno se più vecchie di RETENTION_DAYS.
+    """
+    keep = _boundary(room_pk, HISTORY_LIMIT - 1)
+    if keep is None:
+        return db.false()
+
+    condition = DrawHistory.timestamp < now - timedelta(days=RETENTION_DAYS)
+    # Chiave della più vecchia estrazione da mantenere per numero di righe
+    boundary = _boundary(room_pk, MAX_ROWS_PER_ROOM - 1)
+    if boundary:
+        condition = db.or_(
+            condition,
+            db.tuple_(DrawHistory.timestamp, DrawHistory.id) < tuple(boundary)
+        )
+    return db.and_(condition, db.tuple_(DrawHistory.timestamp, DrawHistory.id) < tuple(keep))
+
+
+def _encode_segment(rows):
+    """NDJSON compresso delle estrazioni"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as out:
+        for row in rows:
+            entry = row.to_dict()
+            entry['id'] = row.id
+            out.write(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+            out.write(b'\n')
+    return buffer.getvalue()
+
+
+def archive_room(room_pk, now=None):
+    """Archivia lo storico vecchio di una stanza; restituisce le righe spostate.
+
+    Ogni segmento viene letto, scritto, contato ed eliminato da draw_history
+    nella stessa transazione, sotto il lock della stanza.
+    """
+    now = now or datetime.utcnow()
+    archived = 0
+
+    while True:
+        try:
+            if not _lock_room(room_pk):
+                # Un altro worker sta archiviando questa stanza
+                db.session.rollback()
+                break
+
+            rows = DrawHistory.query \
+                .filter(DrawHistory.room_id == room_pk, _archive_condition(room_pk, now)) \
+                .order_by(DrawHistory.timestamp, DrawHistory.id) \
+                .limit(SEGMENT_SIZE) \
+                .all()
+            if not rows:
+                db.session.rollback()
+                break
+
+            db.session.add(HistoryArchiveSegment(
+                room_id=room_pk,
+                first_timestamp=rows[0].timestamp,
+                last_timestamp=rows[-1].timestamp,
+                row_count=len(rows),
+                codec='gzip',
+                data=_encode_segment(rows)
+            ))
+
+            summary = db.session.get(HistoryArchiveSummary, room_pk)
+            if summary is None:
+                summary = HistoryArchiveSummary(
+                    room_id=room_pk, segments=0, draws=0, successi=0, complicazioni=0,
+                    adrenaline=0, confusion=0, risk_all=0
+                )
+                db.session.add(summary)
+
+            summary.segments += 1
+            summary.draws += len(rows)
+            summary.successi += sum(row.successi or 0 for row in rows)
+            summary.complicazioni += sum(row.complicazioni or 0 for row in rows)
+            summary.adrenaline += sum(1 for row in rows if row.adrenaline)
+            summary.confusion += sum(1 for row in rows if row.confusion)
+            summary.risk_all += sum(1 for row in rows if row.risk_all)
+            if summary.first_timestamp is None:
+                summary.first_timestamp = rows[0].timestamp
+            summary.last_timestamp = rows[-1].timestamp
+
+            deleted = DrawHistory.query.filter(DrawHistory.id.in_([row.id for row in rows])) \
+                .delete(synchronize_session=False)
+            if deleted != len(rows):
+                # Righe già archiviate da un altro worker nel frattempo
+                db.session.rollback()
+                print(f"⚠️  Archiviazione della stanza {room_pk} già in corso altrove, salto")
+                break
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        archived += len(rows)
+        if len(rows) < SEGMENT_SIZE:
+            break
+
+    return archived
+
+
+def archive_all(now=None):
+    """Archivia lo storico vecchio di tutte le stanze che ne hanno bisogno"""
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=RETENTION_DAYS)
+
+    rooms = db.session.query(DrawHistory.room_id) \
+        .group_by(DrawHistory.room_id) \
+        .having(db.or_(
+            db.func.count(DrawHistory.id) > MAX_ROWS_PER_ROOM,
+            db.and_(
+                db.func.min(DrawHistory.timestamp) < cutoff,
+                db.func.count(DrawHistory.id) > HISTORY_LIMIT
+            )
+        )) \
+        .all()
+
+    archived = 0
+    for (room_pk,) in rooms:
+        archived += archive_room(room_pk, now)
+    return archived
+
+
+def iter_archived_history(room_pk):
+    """Estrazioni archiviate della stanza, in ordine cronologico.
+
+    I segmenti vengono caricati e decompressi uno alla volta.
+    """
+    segment_ids = db.session.query(HistoryArchiveSegment.id) \
+        .filter(HistoryArchiveSegment.room_id == room_pk) \
+        .order_by(HistoryArchiveSegment.first_timestamp, HistoryArchiveSegment.id) \
+        .all()
+
+    for (segment_id,) in segment_ids:
+        data = db.session.query(HistoryArchiveSegment.data) \
+            .filter(HistoryArchiveSegment.id == segment_id) \
+            .scalar()
+        with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as segment:
+            for line in segment:
+                yield json.loads(line)
+
+
+def init_app(app, socketio):
+    """Avvia l'archiviazione periodica in background"""
+    if ARCHIVE_INTERVAL <= 0:
+        return
+
+    def archive_loop():
+        while True:
+            socketio.sleep(ARCHIVE_INTERVAL)
+            try:
+                with app.app_context():
+                    archived = archive_all()
+                if archived:
+                    print(f"🗃️  {archived} estrazioni archiviate")
+            except Exception as e:
+                print(f"⚠️  Errore durante l'archiviazione dello storico: {e}")
+
+    socketio.start_background_task(archive_loop)
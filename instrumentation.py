@@ -0,0 +1,490 @@
+"""
+Metriche degli eventi Socket.IO in formato Prometheus.
+
+init_app avvolge ogni handler registrato su socketio e misura, per evento:
+chiamate, errori, istogramma della latenza, byte ricevuti e inviati e
+numero di statement SQL eseguiti. Le metriche sono esposte su /metrics
+(testo Prometheus), protetto da METRICS_TOKEN se impostato.
+
+Un evento conta come errore se l'handler solleva un'eccezione o se invia
+al client un evento 'error'.
+
+Profilo SQL: ogni statement viene attribuito alla chiamata in corso e, se
+il profilo o i budget sono attivi, ridotto alla sua forma senza i valori
+letterali. Se la stessa forma si ripete almeno SQL_REPEAT_THRESHOLD volte
+nella stessa chiamata è probabilmente una query in un ciclo (N+1) e viene
+segnalata.
+
+- SQL_PROFILE=1 attiva il profilo e stampa un resoconto per ogni evento
+- SQL_QUERY_BUDGETS="join_room=6,save_character=4" imposta il numero
+  massimo di statement per chiamata; i superamenti vengono contati per
+  evento (profiler.violations li riassume, assert_budgets() li fa fallire)
+- query_budget(n) è un context manager per i test: fallisce se il blocco
+  esegue più di n statement, anche con il profilo disattivato
+"""
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, request, abort
+from sqlalchemy import event as sa_event
+
+# Limiti superiori (secondi) dei bucket dell'istogramma della latenza
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Token richiesto per leggere /metrics (header Authorization: Bearer ...)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Profilo SQL attivo (resoconto stampato dopo ogni evento)
+SQL_PROFILE = os.environ.get('SQL_PROFILE', '').lower() in ('1', 'true', 'yes')
+
+# Ripetizioni della stessa forma di statement oltre cui si segnala un N+1
+REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', '3'))
+
+# Caratteri di uno statement mostrati nei messaggi
+SHAPE_PREVIEW = 160
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_POSTCOMPILE = re.compile(r'\(\s*__\[POSTCOMPILE_\w+\]\s*\)')
+_SPACES = re.compile(r'\s+')
+
+# Evento (o blocco di query_budget) in corso nel greenlet corrente
+_current = contextvars.ContextVar('socketio_event', default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Un evento o un blocco ha eseguito più statement del previsto"""
+
+
+def normalize(statement):
+    """Forma di uno statement: letterali e liste IN sostituiti da ?"""
+    shape = _STRING.sub('?', statement)
+    shape = _NUMBER.sub('?', shape)
+    shape = _POSTCOMPILE.sub('(?)', shape)
+    shape = _IN_LIST.sub('IN (?)', shape)
+    return _SPACES.sub(' ', shape).strip()
+
+
+def _parse_budgets(value):
+    budgets = {}
+    for item in value.split(','):
+        if '=' in item:
+            name, limit = item.split('=', 1)
+            budgets[name.strip()] = int(limit)
+    return budgets
+
+
+class EventStats:
+    """Contatori di un evento"""
+
+    __slots__ = ('calls', 'errors', 'latency_sum', 'buckets', 'bytes_in', 'bytes_out', 'sql_statements')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # ultimo = +Inf
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.sql_statements = 0
+
+
+class _Call:
+    """Dati raccolti durante una singola chiamata di un handler (o un blocco di query_budget)"""
+
+    __slots__ = ('event', 'sql_statements', 'bytes_out', 'error', 'shapes', 'parent')
+
+    def __init__(self, event, shapes=False, parent=None):
+        self.event = event
+        self.sql_statements = 0
+        self.bytes_out = 0
+        self.error = False
+        # Forme degli statement, solo se servono (profilo, budget, query_budget)
+        self.shapes = Counter() if shapes or (parent is not None and parent.shapes is not None) else None
+        # Blocco di query_budget che contiene la chiamata
+        self.parent = parent
+
+    def add_statement(self, statement):
+        call = self
+        while call is not None:
+            call.sql_statements += 1
+            if call.shapes is not None:
+                call.shapes[normalize(statement)] += 1
+            call = call.parent
+
+    def repeated(self, threshold=None):
+        """Forme ripetute almeno threshold volte: [(forma, volte)]"""
+        threshold = threshold or REPEAT_THRESHOLD
+        return [(shape, n) for shape, n in (self.shapes or Counter()).most_common() if n >= threshold]
+
+    def describe(self):
+        lines = [f"{self.event}: {self.sql_statements} statement"]
+        for shape, n in (self.shapes or Counter()).most_common():
+            lines.append(f"   {n}× {shape[:SHAPE_PREVIEW]}")
+        return '\n'.join(lines)
+
+
+class EventMetrics:
+    """Registro delle metriche per evento"""
+
+    def __init__(self):
+        self._events = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def record(self, call, latency, bytes_in):
+        with self._lock:
+            stats = self._events.get(call.event)
+            if stats is None:
+                stats = self._events[call.event] = EventStats()
+            stats.calls += 1
+            stats.errors += 1 if call.error else 0
+            stats.latency_sum += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.buckets[i] += 1
+                    break
+            else:
+                stats.buckets[-1] += 1
+            stats.bytes_in += bytes_in
+            stats.bytes_out += call.bytes_out
+            stats.sql_statements += call.sql_statements
+
+    def register_collector(self, name, stats):
+        """Esporta come gauge i valori numerici restituiti da stats()"""
+        self._collectors[name] = stats
+
+    def snapshot(self):
+        """Copia delle metriche per evento"""
+        with self._lock:
+            result = {}
+            for name, stats in self._events.items():
+                copy = EventStats()
+                for field in EventStats.__slots__:
+                    value = getattr(stats, field)
+                    setattr(copy, field, list(value) if isinstance(value, list) else value)
+                result[name] = copy
+            return result
+
+    def render(self):
+        """Metriche in formato testo Prometheus"""
+        events = self.snapshot()
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        family('socketio_event_calls_total', 'counter', 'Eventi Socket.IO gestiti')
+        for name, stats in sorted(events.items()):
+            lines.append(f'socketio_event_calls_total{{event="{_label(name)}"}} {stats.calls}')
+
+        family('socketio_event_errors_total', 'counter', 'Eventi terminati con eccezione o evento error')
+        for name, stats in sorted(events.items()):
+            lines.append(f'socketio_event_errors_total{{event="{_label(name)}"}} {stats.errors}')
+
+        family('socketio_event_duration_seconds', 'histogram', 'Latenza degli handler')
+        for name, stats in sorted(events.items()):
+            label = _label(name)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                cumulative += count
+                lines.append(f'socketio_event_duration_seconds_bucket{{event="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'socketio_event_duration_seconds_bucket{{event="{label}",le="+Inf"}} {stats.calls}')
+            lines.append(f'socketio_event_duration_seconds_sum{{event="{label}"}} {stats.latency_sum:.6f}')
+            lines.append(f'socketio_event_duration_seconds_count{{event="{label}"}} {stats.calls}')
+
+        family('socketio_event_received_bytes_total', 'counter', 'Byte (JSON) ricevuti con gli eventi')
+        for name, stats in sorted(events.items()):
+            lines.append(f'socketio_event_received_bytes_total{{event="{_label(name)}"}} {stats.bytes_in}')
+
+        family('socketio_event_sent_bytes_total', 'counter', 'Byte inviati durante la gestione degli eventi')
+        for name, stats in sorted(events.items()):
+            lines.append(f'socketio_event_sent_bytes_total{{event="{_label(name)}"}} {stats.bytes_out}')
+
+        family('socketio_event_sql_statements_total', 'counter', 'Statement SQL eseguiti dagli handler')
+        for name, stats in sorted(events.items()):
+            lines.append(f'socketio_event_sql_statements_total{{event="{_label(name)}"}} {stats.sql_statements}')
+
+        for collector, stats in sorted(self._collectors.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                print(f"⚠️  Errore nelle metriche {collector}: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f'nte_{collector}_{key}'
+                family(name, 'gauge', f'{collector}: {key}')
+                lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+event_metrics = EventMetrics()
+
+
+class EventProfile:
+    """Statement per evento, cumulati su tutte le chiamate"""
+
+    __slots__ = ('calls', 'statements', 'max_statements', 'repeated', 'over_budget', 'max_over_budget')
+
+    def __init__(self):
+        self.calls = 0
+        self.statements = 0
+        self.max_statements = 0
+        self.repeated = Counter()  # forma -> chiamate in cui si è ripetuta
+        self.over_budget = 0  # chiamate oltre il budget
+        self.max_over_budget = 0  # statement della peggiore
+
+
+class SQLProfiler:
+    """Profili SQL per evento e budget di statement"""
+
+    def __init__(self, enabled=SQL_PROFILE, repeat_threshold=REPEAT_THRESHOLD):
+        self.enabled = enabled
+        self.log = enabled
+        self.repeat_threshold = repeat_threshold
+        self.budgets = _parse_budgets(os.environ.get('SQL_QUERY_BUDGETS', ''))
+        self._events = {}
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        """True se le chiamate vanno profilate"""
+        return self.enabled or bool(self.budgets)
+
+    def enable(self, log=False):
+        """Attiva il profilo (log=True stampa il resoconto di ogni evento)"""
+        self.enabled = True
+        self.log = log
+
+    def disable(self):
+        self.enabled = False
+        self.log = False
+
+    def reset(self):
+        """Azzera profili e violazioni (i budget restano)"""
+        with self._lock:
+            self._events.clear()
+
+    def set_budget(self, event, max_statements):
+        """Numero massimo di statement per una chiamata dell'evento"""
+        self.budgets[event] = max_statements
+
+    def record(self, call):
+        """Registra una chiamata e controlla budget e ripetizioni"""
+        repeated = call.repeated(self.repeat_threshold)
+        budget = self.budgets.get(call.event)
+        over_budget = budget is not None and call.sql_statements > budget
+
+        with self._lock:
+            profile = self._events.get(call.event)
+            if profile is None:
+                profile = self._events[call.event] = EventProfile()
+            profile.calls += 1
+            profile.statements += call.sql_statements
+            profile.max_statements = max(profile.max_statements, call.sql_statements)
+            for shape, _ in repeated:
+                profile.repeated[shape] += 1
+            if over_budget:
+                profile.over_budget += 1
+                profile.max_over_budget = max(profile.max_over_budget, call.sql_statements)
+
+        if self.log:
+            print(f"🔎 SQL {call.describe()}")
+        if self.log or over_budget:
+            for shape, n in repeated:
+                print(f"⚠️  Possibile N+1 in {call.event}: {n}× {shape[:SHAPE_PREVIEW]}")
+        if over_budget:
+            print(f"⚠️  Budget SQL superato in {call.event}: {call.sql_statements} statement (max {budget})")
+
+    def profiles(self):
+        """Copia dei profili per evento"""
+        with self._lock:
+            result = {}
+            for name, profile in self._events.items():
+                copy = EventProfile()
+                copy.calls = profile.calls
+                copy.statements = profile.statements
+                copy.max_statements = profile.max_statements
+                copy.repeated = Counter(profile.repeated)
+                copy.over_budget = profile.over_budget
+                copy.max_over_budget = profile.max_over_budget
+                result[name] = copy
+            return result
+
+    def report(self):
+        """Resoconto testuale: statement per evento e forme ripetute"""
+        lines = [f"{'evento':<28} {'chiamate':>9} {'stmt/ch.':>9} {'max':>5} {'N+1':>5}"]
+        for name, profile in sorted(self.profiles().items()):
+            average = profile.statements / profile.calls if profile.calls else 0.0
+            lines.append(f"{name:<28} {profile.calls:>9} {average:>9.2f} "
+                         f"{profile.max_statements:>5} {len(profile.repeated):>5}")
+            for shape, calls in profile.repeated.most_common():
+                lines.append(f"   ↳ ripetuta in {calls} chiamate: {shape[:SHAPE_PREVIEW]}")
+        return '\n'.join(lines)
+
+    @property
+    def violations(self):
+        """Eventi che hanno superato il budget, una riga per evento"""
+        return [
+            f"{name}: {profile.over_budget} chiamate oltre il budget {self.budgets.get(name)} "
+            f"(max {profile.max_over_budget} statement)"
+            for name, profile in sorted(self.profiles().items()) if profile.over_budget
+        ]
+
+    def assert_budgets(self):
+        """Fallisce se qualche chiamata ha superato il suo budget"""
+        violations = self.violations
+        if violations:
+            raise QueryBudgetExceeded('Budget SQL superati:\n' + '\n'.join(violations))
+
+    def stats(self):
+        """Valori per le metriche"""
+        with self._lock:
+            return {
+                'enabled': int(self.enabled),
+                'budget_violations': sum(p.over_budget for p in self._events.values()),
+                'repeated_shapes': sum(len(p.repeated) for p in self._events.values())
+            }
+
+
+profiler = SQLProfiler()
+
+
+@contextmanager
+def query_budget(max_statements, label='blocco'):
+    """Fallisce con QueryBudgetExceeded se il blocco esegue più di max_statements statement.
+
+        with query_budget(3):
+            client.emit('toggle_character_visibility', {...})
+    """
+    block = _Call(label, shapes=True, parent=_current.get())
+    token = _current.set(block)
+    try:
+        yield block
+    finally:
+        _current.reset(token)
+    if block.sql_statements > max_statements:
+        raise QueryBudgetExceeded(f"Budget SQL superato (max {max_statements})\n{block.describe()}")
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _payload_size(args):
+    size = 0
+    for arg in args:
+        if isinstance(arg, (bytes, bytearray)):
+            size += len(arg)
+        elif arg is not None:
+            try:
+                size += len(json.dumps(arg, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+            except (TypeError, ValueError):
+                pass
+    return size
+
+
+def _record_sent(data):
+    call = _current.get()
+    if call is None:
+        return
+    if isinstance(data, str):
+        call.bytes_out += len(data.encode('utf-8'))
+    elif isinstance(data, (bytes, bytearray)):
+        call.bytes_out += len(data)
+
+
+def instrument_handler(event, handler):
+    """Avvolge un handler di python-socketio (sid, *args) con le metriche"""
+    @wraps(handler)
+    def wrapper(sid, *args):
+        # Dentro query_budget gli statement contano anche per il blocco
+        call = _Call(event, shapes=profiler.active, parent=_current.get())
+        token = _current.set(call)
+        start = time.perf_counter()
+        try:
+            return handler(sid, *args)
+        except Exception:
+            call.error = True
+            print(f"❌ Errore non gestito in {event}:")
+            traceback.print_exc()
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            _current.reset(token)
+            # connect riceve l'environ WSGI, non un payload
+            bytes_in = _payload_size(args) if event not in ('connect', 'disconnect') else 0
+            event_metrics.record(call, latency, bytes_in)
+            if profiler.active:
+                profiler.record(call)
+    return wrapper
+
+
+def init_app(app, socketio, db):
+    """Strumenta gli handler già registrati ed espone /metrics.
+
+    Va chiamata dopo aver registrato tutti gli handler di socketio.
+    """
+    server = socketio.server
+    for namespace, handlers in server.handlers.items():
+        for event, handler in list(handlers.items()):
+            handlers[event] = instrument_handler(event, handler)
+
+    # Eventi 'error' inviati ai client durante un handler
+    server_emit = server.emit
+
+    def emit(event, *args, **kwargs):
+        if event == 'error':
+            call = _current.get()
+            if call is not None:
+                call.error = True
+        return server_emit(event, *args, **kwargs)
+
+    server.emit = emit
+
+    # Byte inviati ai client durante un handler
+    eio = server.eio
+    eio_send, eio_send_packet = eio.send, eio.send_packet
+
+    def send(sid, data, *args, **kwargs):
+        _record_sent(data)
+        return eio_send(sid, data, *args, **kwargs)
+
+    def send_packet(sid, pkt, *args, **kwargs):
+        _record_sent(pkt.data)
+        return eio_send_packet(sid, pkt, *args, **kwargs)
+
+    eio.send, eio.send_packet = send, send_packet
+
+    # Statement SQL eseguiti durante un handler
+    def count_statement(conn, cursor, statement, *args):
+        call = _current.get()
+        if call is not None:
+            call.add_statement(statement)
+
+    with app.app_context():
+        sa_event.listen(db.engine, 'before_cursor_execute', count_statement)
+
+    event_metrics.register_collector('sql_profile', profiler.stats)
+    if profiler.enabled:
+        print(f"🔎 Profilo SQL attivo (N+1 da {profiler.repeat_threshold} ripetizioni)")
+
+    @app.route('/metrics')
+    def metrics():
+        """Metriche in formato Prometheus"""
+        if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            abort(401)
+        return Response(event_metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
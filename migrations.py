@@ -0,0 +1,276 @@
+"""
+Migrazioni versionate dello schema (SQLite e PostgreSQL).
+
+Le migrazioni si applicano esplicitamente, una volta per rilascio, con
+`flask --app app migrate` o `python migrate_db.py`, non all'avvio dei
+worker. Le versioni applicate sono registrate nella tabella
+schema_migrations; un lock (advisory lock su PostgreSQL, lock su file
+per SQLite) garantisce che un solo processo migri alla volta.
+
+Ogni migrazione deve essere idempotente: su un database nuovo la prima
+(create_all) crea già le tabelle con lo schema attuale, e quelle
+successive devono accorgersene e non fare nulla.
+
+Per aggiungere una migrazione: scrivi una funzione fn(conn) e aggiungila
+in fondo a MIGRATIONS con la versione successiva.
+"""
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from models import db
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Chiave dell'advisory lock PostgreSQL delle migrazioni
+ADVISORY_LOCK_KEY = 4191_2201
+
+schema_migrations = sa.Table(
+    'schema_migrations', sa.MetaData(),
+    sa.Column('version', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('name', sa.String(200), nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False)
+)
+
+
+def _columns(conn, table):
+    return {column['name']: column for column in sa.inspect(conn).get_columns(table)}
+
+
+def _add_column(conn, table, column, ddl):
+    if column in _columns(conn, table):
+        return False
+    print(f"🔄 Aggiunta colonna {table}.{column}...")
+    conn.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return True
+
+
+def create_tables(conn):
+    """Tabelle mancanti, con lo schema attuale dei modelli"""
+    db.metadata.create_all(conn)
+
+
+def add_room_players_is_master(conn):
+    if _add_column(conn, 'room_players', 'is_master', 'BOOLEAN DEFAULT FALSE'):
+        # Il primo giocatore di ogni stanza diventa master
+        conn.execute(sa.text("""
+            UPDATE room_players
+            SET is_master = TRUE
+            WHERE id IN (
+                SELECT MIN(id) FROM room_players GROUP BY room_id
+            )
+        """))
+
+
+def add_characters_visible_to_all(conn):
+    _add_column(conn, 'characters', 'visible_to_all', 'BOOLEAN DEFAULT FALSE')
+
+
+def add_characters_version(conn):
+    _add_column(conn, 'characters', 'version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def add_rooms_version(conn):
+    _add_column(conn, 'rooms', 'version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def convert_json_columns(conn):
+    """Colonne JSON salvate come testo: JSONB su PostgreSQL, NULL al posto di '' su SQLite"""
+    json_columns = [
+        ('characters', 'traits'),
+        ('characters', 'selected_traits'),
+        ('characters', 'empowered_traits'),
+        ('characters', 'misfortunes'),
+        ('characters', 'lessons'),
+        ('draw_history', 'drawn_tokens')
+    ]
+    postgres = conn.dialect.name == 'postgresql'
+    for table, column in json_columns:
+        if postgres:
+            data_type = conn.execute(sa.text("""
+                SELECT data_type
+                FROM information_schema.columns
+                WHERE table_name=:table AND column_name=:column
+            """), {'table': table, 'column': column}).scalar()
+            if data_type == 'text':
+                print(f"🔄 Conversione {table}.{column} in JSONB...")
+                conn.execute(sa.text(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE JSONB "
+                    f"USING NULLIF({column}, '')::jsonb"
+                ))
+        else:
+            # Su SQLite restano testo, ma una stringa vuota non è JSON valido
+            conn.execute(sa.text(f"UPDATE {table} SET {column} = NULL WHERE {column} = ''"))
+
+
+def add_history_index(conn):
+    """Indice per la paginazione dello storico"""
+    conn.execute(sa.text("""
+        CREATE INDEX IF NOT EXISTS ix_draw_history_room_timestamp_id
+        ON draw_history (room_id, timestamp, id)
+    """))
+
+
+def move_legacy_photos(conn):
+    """Foto in base64 nelle schede -> archivio foto"""
+    import photo_store
+    migrated = photo_store.migrate_legacy_photos(conn)
+    if migrated:
+        print(f"✅ {migrated} foto spostate nell'archivio")
+
+
+def add_sessions_indexes(conn):
+    """Indici per la pulizia delle sessioni scadute e il limite per utente"""
+    conn.execute(sa.text("CREATE INDEX IF NOT EXISTS ix_sessions_expires_at ON sessions (expires_at)"))
+    conn.execute(sa.text("CREATE INDEX IF NOT EXISTS ix_sessions_user_id ON sessions (user_id)"))
+
+
+def move_draw_stats_histograms(conn):
+    """Istogrammi JSON di draw_stats -> righe di draw_stats_buckets"""
+    from models import DrawStatsBucket
+    DrawStatsBucket.__table__.create(conn, checkfirst=True)
+    if 'histogram' not in _columns(conn, 'draw_stats'):
+        return
+
+    rows = conn.execute(sa.text(
+        "SELECT room_id, player_name, histogram FROM draw_stats WHERE histogram IS NOT NULL"
+    )).all()
+    buckets = []
+    for room_id, player_name, histogram in rows:
+        if isinstance(histogram, str):
+            histogram = json.loads(histogram) if histogram else {}
+        for kind, bucket in (histogram or {}).items():
+            for value, count in (bucket or {}).items():
+                buckets.append({'room_id': room_id, 'player_name': player_name,
+                                'kind': kind, 'value': int(value), 'count': count})
+    if buckets:
+        print(f"🔄 {len(buckets)} righe di istogramma spostate in draw_stats_buckets...")
+        conn.execute(DrawStatsBucket.__table__.insert(), buckets)
+    conn.execute(sa.text("UPDATE draw_stats SET histogram = NULL WHERE histogram IS NOT NULL"))
+
+
+# (versione, funzione): le versioni non vanno mai riusate né riordinate
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_room_players_is_master),
+    (3, add_characters_visible_to_all),
+    (4, add_characters_version),
+    (5, add_rooms_version),
+    (6, convert_json_columns),
+    (7, add_history_index),
+    (8, move_legacy_photos),
+    (9, add_sessions_indexes),
+    (10, move_draw_stats_histograms),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, 'a+') as handle:
+        if fcntl:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+            else:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def migration_lock(engine):
+    """Un solo processo alla volta applica le migrazioni"""
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            conn.execute(sa.text("SELECT pg_advisory_lock(:key)"), {'key': ADVISORY_LOCK_KEY})
+            conn.commit()
+            try:
+                yield
+            finally:
+                conn.execute(sa.text("SELECT pg_advisory_unlock(:key)"), {'key': ADVISORY_LOCK_KEY})
+                conn.commit()
+    elif engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        with _file_lock(f"{engine.url.database}.migrate.lock"):
+            yield
+    else:
+        yield
+
+
+def applied_versions(conn):
+    """Versioni già applicate"""
+    if not sa.inspect(conn).has_table('schema_migrations'):
+        return set()
+    return set(conn.execute(sa.select(schema_migrations.c.version)).scalars())
+
+
+def upgrade(app):
+    """Applica le migrazioni mancanti; restituisce le versioni applicate"""
+    with app.app_context():
+        engine = db.engine
+        with migration_lock(engine):
+            with engine.begin() as conn:
+                schema_migrations.create(conn, checkfirst=True)
+                done = applied_versions(conn)
+
+            applied = []
+            for version, migration in MIGRATIONS:
+                if version in done:
+                    continue
+                print(f"🔄 Migrazione {version}: {migration.__name__}")
+                with engine.begin() as conn:
+                    migration(conn)
+                    conn.execute(schema_migrations.insert().values(
+                        version=version,
+                        name=migration.__name__,
+                        applied_at=datetime.utcnow()
+                    ))
+                applied.append(version)
+
+    if applied:
+        print(f"✅ Schema aggiornato alla versione {LATEST_VERSION}")
+    else:
+        print(f"✅ Schema già alla versione {LATEST_VERSION}")
+    return applied
+
+
+def pending(app):
+    """Versioni non ancora applicate (controllo leggero per l'avvio)"""
+    with app.app_context():
+        with db.engine.connect() as conn:
+            done = applied_versions(conn)
+    return [version for version, _ in MIGRATIONS if version not in done]
+
+
+def init_app(app):
+    """Registra il comando `flask migrate`"""
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Applica le migrazioni dello schema del database"""
+        upgrade(app)
+
+
+def check_schema(app):
+    """Segnala uno schema non aggiornato (all'avvio del server, vedi app.start_services)"""
+    if os.environ.get('MIGRATIONS_CHECK', '1').lower() in ('0', 'false', 'no'):
+        return
+    try:
+        missing = pending(app)
+    except Exception as e:
+        print(f"⚠️  Impossibile verificare lo schema del database: {e}")
+        return
+    if missing:
+        print(f"⚠️  Schema del database non aggiornato ({len(missing)} migrazioni da applicare): "
+                   f"esegui `flask --app app migrate` o `python migrate_db.py`")
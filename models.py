@@ -1,9 +1,22 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import JSONB
 from datetime import datetime
-import json
 
 db = SQLAlchemy()
 
+# JSON nativo: JSONB su PostgreSQL, testo JSON su SQLite
+JSONType = db.JSON().with_variant(JSONB(), 'postgresql')
+
+# Prefisso delle URL delle foto servite dal blob store (vedi photo_store.py)
+PHOTO_URL_PREFIX = '/photos/'
+
+
+def photo_url(photo):
+    """URL della foto: hash nel blob store, oppure data URL dei dati legacy"""
+    if not photo or photo.startswith('data:'):
+        return photo
+    return PHOTO_URL_PREFIX + photo
+
 
 class User(db.Model):
     """Modello Utente"""
@@ -30,9 +43,9 @@ class Session(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.String(100), unique=True, nullable=False, index=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, index=True)  # Pulizia delle sessioni scadute
 
     def __repr__(self):
         return f'<Session {self.session_id}>'
@@ -52,10 +65,16 @@ class Room(db.Model):
     bag_successi = db.Column(db.Integer, default=0)
     bag_complicazioni = db.Column(db.Integer, default=0)
 
+    # Versione del sacchetto: le scritture sono condizionate (vedi room_state.py)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # Relazioni
     players = db.relationship('RoomPlayer', backref='room', lazy='dynamic', cascade='all, delete-orphan')
     characters = db.relationship('Character', backref='room', lazy='dynamic', cascade='all, delete-orphan')
     history = db.relationship('DrawHistory', backref='room', lazy='dynamic', cascade='all, delete-orphan')
+    archive_segments = db.relationship('HistoryArchiveSegment', backref='room', lazy='dynamic', cascade='all, delete-orphan')
+    archive_summary = db.relationship('HistoryArchiveSummary', backref='room', uselist=False, cascade='all, delete-orphan')
+    draw_stats = db.relationship('DrawStats', backref='room', lazy='dynamic', cascade='all, delete-orphan')
 
     def __repr__(self):
         return f'<Room {self.room_id}>'
@@ -102,20 +121,20 @@ class Character(db.Model):
     name = db.Column(db.String(200))
     motivation = db.Column(db.Text)
     archetype = db.Column(db.String(200))
-    photo = db.Column(db.Text)  # Base64 della foto
+    photo = db.Column(db.Text)  # Hash della foto nel blob store (Photo)
 
-    # Tratti (stored as JSON)
-    traits = db.Column(db.Text)  # JSON array di tratti
-    selected_traits = db.Column(db.Text)  # JSON array di ID selezionati
-    empowered_traits = db.Column(db.Text)  # JSON array di ID potenziati
+    # Tratti (JSON nativo)
+    traits = db.Column(JSONType)  # Array di tratti
+    selected_traits = db.Column(JSONType)  # Array di ID selezionati
+    empowered_traits = db.Column(JSONType)  # Array di ID potenziati
 
     # Contatori
     quality_counter = db.Column(db.Integer, default=0)
     ability_counter = db.Column(db.Integer, default=0)
 
-    # Sventure e Lezioni (JSON)
-    misfortunes = db.Column(db.Text)  # JSON array
-    lessons = db.Column(db.Text)  # JSON array
+    # Sventure e Lezioni (JSON nativo)
+    misfortunes = db.Column(JSONType)  # Array
+    lessons = db.Column(JSONType)  # Array
 
     # Risorse e Note
     resources = db.Column(db.Text)
@@ -124,6 +143,9 @@ class Character(db.Model):
     # Visibilità scheda - solo il master può vederla per default
     visible_to_all = db.Column(db.Boolean, default=False)
 
+    # Versione della scheda, incrementata a ogni salvataggio (concorrenza ottimistica)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -138,30 +160,35 @@ class Character(db.Model):
             'name': self.name,
             'motivation': self.motivation,
             'archetype': self.archetype,
-            'photo': self.photo,
-            'traits': json.loads(self.traits) if self.traits else [],
-            'selected_traits': json.loads(self.selected_traits) if self.selected_traits else [],
-            'empowered_traits': json.loads(self.empowered_traits) if self.empowered_traits else [],
+            'photo': photo_url(self.photo),
+            'traits': self.traits or [],
+            'selected_traits': self.selected_traits or [],
+            'empowered_traits': self.empowered_traits or [],
             'quality_counter': self.quality_counter,
             'ability_counter': self.ability_counter,
-            'misfortunes': json.loads(self.misfortunes) if self.misfortunes else [],
-            'lessons': json.loads(self.lessons) if self.lessons else [],
+            'misfortunes': self.misfortunes or [],
+            'lessons': self.lessons or [],
             'resources': self.resources,
             'notes': self.notes,
-            'visible_to_all': self.visible_to_all
+            'visible_to_all': self.visible_to_all,
+            'version': self.version or 0
         }
 
 
 class DrawHistory(db.Model):
     """Modello Storico Estrazioni"""
     __tablename__ = 'draw_history'
+    __table_args__ = (
+        # Paginazione a cursore dello storico di una stanza
+        db.Index('ix_draw_history_room_timestamp_id', 'room_id', 'timestamp', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), nullable=False)
     player_name = db.Column(db.String(100), nullable=False)
 
-    # Risultato estrazione (JSON)
-    drawn_tokens = db.Column(db.Text, nullable=False)  # JSON array di token estratti
+    # Risultato estrazione (JSON nativo)
+    drawn_tokens = db.Column(JSONType, nullable=False)  # Array di token estratti
     successi = db.Column(db.Integer, default=0)
     complicazioni = db.Column(db.Integer, default=0)
 
@@ -179,7 +206,7 @@ class DrawHistory(db.Model):
         """Converti storico in dizionario"""
         return {
             'player': self.player_name,
-            'drawn': json.loads(self.drawn_tokens),
+            'drawn': self.drawn_tokens or [],
             'successi': self.successi,
             'complicazioni': self.complicazioni,
             'timestamp': self.timestamp.isoformat(),
@@ -187,3 +214,115 @@ class DrawHistory(db.Model):
             'confusion': self.confusion,
             'risk_all': self.risk_all
         }
+
+
+class Photo(db.Model):
+    """Modello Foto (blob indirizzato per contenuto)"""
+    __tablename__ = 'photos'
+
+    hash = db.Column(db.String(64), primary_key=True)  # SHA-256 del contenuto
+    mime_type = db.Column(db.String(50), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Photo {self.hash[:12]}>'
+
+
+class HistoryArchiveSegment(db.Model):
+    """Modello Segmento di storico archiviato (NDJSON compresso)"""
+    __tablename__ = 'history_archive_segments'
+
+    id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), nullable=False, index=True)
+
+    # Intervallo di estrazioni contenute, in ordine cronologico
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+
+    codec = db.Column(db.String(10), nullable=False, default='gzip')
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<HistoryArchiveSegment {self.room_id} - {self.row_count} righe>'
+
+
+class HistoryArchiveSummary(db.Model):
+    """Modello Contatori dello storico archiviato di una stanza"""
+    __tablename__ = 'history_archive_summaries'
+
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), primary_key=True)
+
+    segments = db.Column(db.Integer, nullable=False, default=0)
+    draws = db.Column(db.Integer, nullable=False, default=0)
+    successi = db.Column(db.Integer, nullable=False, default=0)
+    complicazioni = db.Column(db.Integer, nullable=False, default=0)
+    adrenaline = db.Column(db.Integer, nullable=False, default=0)
+    confusion = db.Column(db.Integer, nullable=False, default=0)
+    risk_all = db.Column(db.Integer, nullable=False, default=0)
+
+    first_timestamp = db.Column(db.DateTime)
+    last_timestamp = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<HistoryArchiveSummary {self.room_id} - {self.draws} estrazioni>'
+
+    def to_dict(self):
+        """Converti contatori in dizionario"""
+        return {
+            'segments': self.segments,
+            'draws': self.draws,
+            'successi': self.successi,
+            'complicazioni': self.complicazioni,
+            'adrenaline': self.adrenaline,
+            'confusion': self.confusion,
+            'risk_all': self.risk_all,
+            'first_timestamp': self.first_timestamp.isoformat() if self.first_timestamp else None,
+            'last_timestamp': self.last_timestamp.isoformat() if self.last_timestamp else None
+        }
+
+
+class DrawStats(db.Model):
+    """Modello Statistiche Estrazioni (per stanza e per giocatore)"""
+    __tablename__ = 'draw_stats'
+
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), primary_key=True)
+    player_name = db.Column(db.String(100), primary_key=True)  # '' = totali della stanza
+
+    draws = db.Column(db.Integer, nullable=False, default=0)
+    tokens = db.Column(db.Integer, nullable=False, default=0)
+    successi = db.Column(db.Integer, nullable=False, default=0)
+    complicazioni = db.Column(db.Integer, nullable=False, default=0)
+    adrenaline = db.Column(db.Integer, nullable=False, default=0)
+    confusion = db.Column(db.Integer, nullable=False, default=0)
+    risk_all = db.Column(db.Integer, nullable=False, default=0)
+    risk_all_blown = db.Column(db.Integer, nullable=False, default=0)  # rischia tutto con complicazioni
+
+    # Dimensione del sacchetto prima dell'estrazione (solo estrazioni che la registrano)
+    bag_size_sum = db.Column(db.Integer, nullable=False, default=0)
+    bag_size_draws = db.Column(db.Integer, nullable=False, default=0)
+
+    # Istogrammi in JSON delle versioni precedenti: ora in DrawStatsBucket (migrazione 10)
+    histogram = db.Column(JSONType)
+
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DrawStats {self.room_id} {self.player_name or "*"} - {self.draws} estrazioni>'
+
+
+class DrawStatsBucket(db.Model):
+    """Modello Istogramma Estrazioni: estrazioni con `value` successi o complicazioni"""
+    __tablename__ = 'draw_stats_buckets'
+
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), primary_key=True)
+    player_name = db.Column(db.String(100), primary_key=True)  # '' = totali della stanza
+    kind = db.Column(db.String(20), primary_key=True)  # 'successi' o 'complicazioni'
+    value = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DrawStatsBucket {self.room_id} {self.player_name or "*"} {self.kind}={self.value}: {self.count}>'
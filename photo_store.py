@@ -0,0 +1,140 @@
+"""
+Archivio delle foto dei personaggi indirizzato per contenuto.
+
+Le foto vengono ridimensionate e ricodificate lato server, salvate nella
+tabella Photo con chiave SHA-256 del contenuto e servite via HTTP con ETag
+forte e cache immutabile. Le schede contengono solo l'hash della foto.
+"""
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+
+import sqlalchemy as sa
+
+from models import db, Photo, Character, PHOTO_URL_PREFIX
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow opzionale: senza, le foto vengono salvate così come sono
+    Image = None
+
+# Lato massimo (pixel) della foto salvata
+PHOTO_MAX_SIZE = int(os.environ.get('PHOTO_MAX_SIZE', '512'))
+
+# Dimensione massima accettata per una foto caricata
+PHOTO_MAX_BYTES = int(os.environ.get('PHOTO_MAX_BYTES', str(5 * 1024 * 1024)))
+
+ALLOWED_MIME_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+
+_DATA_URL_RE = re.compile(r'^data:(?P<mime>[\w/+.-]+);base64,(?P<data>.*)$', re.DOTALL)
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class InvalidPhoto(ValueError):
+    """Foto non valida o troppo grande"""
+
+
+def _reencode(raw):
+    """Ridimensiona e ricodifica la foto in JPEG; restituisce (bytes, mime)"""
+    try:
+        image = Image.open(io.BytesIO(raw))
+        image.load()
+    except Exception:
+        raise InvalidPhoto('Formato immagine non supportato')
+
+    image.thumbnail((PHOTO_MAX_SIZE, PHOTO_MAX_SIZE))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=85, optimize=True)
+    return out.getvalue(), 'image/jpeg'
+
+
+def prepare_photo(raw, mime_type):
+    """Controlla e ricodifica una foto; restituisce (hash, bytes, mime)"""
+    if len(raw) > PHOTO_MAX_BYTES:
+        raise InvalidPhoto('Foto troppo grande')
+    if mime_type not in ALLOWED_MIME_TYPES:
+        raise InvalidPhoto('Formato immagine non supportato')
+
+    if Image is not None:
+        raw, mime_type = _reencode(raw)
+    return hashlib.sha256(raw).hexdigest(), raw, mime_type
+
+
+def decode_data_url(data_url):
+    """Contenuto di un data URL base64: (bytes, mime)"""
+    match = _DATA_URL_RE.match(data_url)
+    if not match:
+        raise InvalidPhoto('Foto non valida')
+    try:
+        raw = base64.b64decode(match.group('data'), validate=False)
+    except (binascii.Error, ValueError):
+        raise InvalidPhoto('Foto non valida')
+    return raw, match.group('mime')
+
+
+def store_photo(raw, mime_type):
+    """Salva una foto e ne restituisce l'hash (senza commit)"""
+    photo_hash, raw, mime_type = prepare_photo(raw, mime_type)
+    if db.session.get(Photo, photo_hash) is None:
+        db.session.add(Photo(hash=photo_hash, mime_type=mime_type, data=raw))
+    return photo_hash
+
+
+def store_data_url(data_url):
+    """Salva una foto ricevuta come data URL base64 e ne restituisce l'hash"""
+    return store_photo(*decode_data_url(data_url))
+
+
+def photo_ref_from_client(value):
+    """Converte la foto inviata dal client nel valore da salvare sulla scheda.
+
+    Accetta l'URL di una foto già caricata, un hash o (client vecchi) un
+    data URL base64, che viene salvato nell'archivio.
+    """
+    if not value:
+        return ''
+    if value.startswith('data:'):
+        return store_data_url(value)
+    if value.startswith(PHOTO_URL_PREFIX):
+        value = value[len(PHOTO_URL_PREFIX):]
+    if not _HASH_RE.match(value):
+        raise InvalidPhoto('Foto non valida')
+    return value
+
+
+def get_photo(photo_hash):
+    """Foto dall'archivio, o None"""
+    if not _HASH_RE.match(photo_hash or ''):
+        return None
+    return db.session.get(Photo, photo_hash)
+
+
+def migrate_legacy_photos(conn):
+    """Sposta nell'archivio le foto salvate come data URL nelle schede.
+
+    Lavora solo sulla connessione ricevuta (nella transazione della
+    migrazione): niente db.session e niente commit.
+    """
+    characters = Character.__table__
+    photos = Photo.__table__
+    rows = conn.execute(
+        sa.select(characters.c.id, characters.c.photo).where(characters.c.photo.like('data:%'))
+    ).all()
+
+    for character_id, data_url in rows:
+        try:
+            photo_hash, raw, mime_type = prepare_photo(*decode_data_url(data_url))
+        except InvalidPhoto:
+            photo_hash = ''
+        else:
+            exists = conn.execute(sa.select(photos.c.hash).where(photos.c.hash == photo_hash)).first()
+            if exists is None:
+                conn.execute(photos.insert().values(hash=photo_hash, mime_type=mime_type, data=raw))
+        conn.execute(characters.update().where(characters.c.id == character_id).values(photo=photo_hash))
+    return len(rows)
@@ -0,0 +1,48 @@
+"""
+Elenco delle stanze di un utente (proprie e condivise) per login e refresh.
+
+Usa sempre due query, indipendentemente dal numero di stanze: una per le
+stanze e una per tutti i giocatori di quelle stanze.
+"""
+from models import db, Room, RoomPlayer
+
+
+def get_user_rooms(user_id):
+    """Restituisce (stanze_proprie, stanze_condivise) come liste di dizionari"""
+    shared_ids = db.session.query(RoomPlayer.room_id).filter(RoomPlayer.user_id == user_id)
+
+    rooms = Room.query.filter(
+        Room.is_active.is_(True),
+        db.or_(Room.owner_id == user_id, Room.id.in_(shared_ids))
+    ).order_by(Room.id).all()
+
+    if not rooms:
+        return [], []
+
+    players = RoomPlayer.query.filter(
+        RoomPlayer.room_id.in_([room.id for room in rooms])
+    ).order_by(RoomPlayer.room_id, RoomPlayer.id).all()
+
+    # Raggruppa i giocatori per stanza
+    players_by_room = {}
+    my_player_by_room = {}
+    for player in players:
+        players_by_room.setdefault(player.room_id, []).append(player.player_name)
+        if player.user_id == user_id and player.room_id not in my_player_by_room:
+            my_player_by_room[player.room_id] = player.player_name
+
+    owned_rooms = []
+    shared_rooms = []
+    for room in rooms:
+        details = {
+            'id': room.room_id,
+            'players': players_by_room.get(room.id, []),
+            'created_at': room.created_at.isoformat(),
+            'my_player_name': my_player_by_room.get(room.id)
+        }
+        if room.owner_id == user_id:
+            owned_rooms.append(details)
+        else:
+            shared_rooms.append(details)
+
+    return owned_rooms, shared_rooms
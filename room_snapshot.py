@@ -0,0 +1,70 @@
+"""
+Snapshot versionato dei dati inviati a chi entra in una stanza.
+
+Giocatori, proprietario, ultime 20 estrazioni e schede personaggio vengono
+costruiti una sola volta per versione della stanza: i join e le
+riconnessioni successive riusano lo snapshot finché nessun handler modifica
+la stanza (RoomState.bump).
+"""
+from models import RoomPlayer, Character, DrawHistory
+
+HISTORY_LIMIT = 20
+
+
+def build_room_snapshot(state):
+    """Costruisce i dati della stanza leggendoli dal database"""
+    players = RoomPlayer.query.filter_by(room_id=state.room_pk).order_by(RoomPlayer.id).all()
+
+    owner_name = 'Sconosciuto'
+    for player in players:
+        if player.user_id == state.owner_id:
+            owner_name = player.player_name
+            break
+
+    history = DrawHistory.query.filter_by(room_id=state.room_pk) \
+        .order_by(DrawHistory.timestamp.desc()) \
+        .limit(HISTORY_LIMIT) \
+        .all()
+
+    characters = Character.query.filter_by(room_id=state.room_pk).order_by(Character.id).all()
+
+    characters_dict = {}
+    characters_by_user = {}
+    for character in characters:
+        char_dict = character.to_dict()
+        characters_dict[character.player_name] = char_dict
+        characters_by_user.setdefault(character.user_id, char_dict)
+
+    return {
+        'players': [(p.player_name, p.user_id) for p in players],
+        'players_list': [p.player_name for p in players],
+        'owner_name': owner_name,
+        'history': [h.to_dict() for h in history],
+        'characters': characters_dict,
+        'characters_by_user': characters_by_user
+    }
+
+
+def get_room_snapshot(state, registry):
+    """Snapshot aggiornato della stanza, ricostruito solo se la versione è cambiata.
+
+    Un solo greenlet alla volta ricostruisce lo snapshot: gli altri join
+    della stessa stanza aspettano e riusano il risultato.
+    """
+    cached = state.snapshot
+    if cached is not None and cached[0] == state.version:
+        return cached[1]
+
+    with state.snapshot_lock:
+        cached = state.snapshot
+        if cached is not None and cached[0] == state.version:
+            return cached[1]
+
+        version = state.version
+
+        # Lo storico in sospeso deve essere sul database prima di leggerlo
+        registry.flush(state.room_id)
+
+        data = build_room_snapshot(state)
+        state.snapshot = (version, data)
+        return data
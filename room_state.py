@@ -0,0 +1,424 @@
+"""
+Stato in memoria delle stanze attive.
+
+Durante il gioco il sacchetto (successi/complicazioni), l'adrenalina e la
+confusione vivono nel backend di stato (vedi state_backend.py: in processo
+o su Redis per più worker): le estrazioni non toccano il database.
+Il sacchetto e lo storico delle estrazioni vengono scritti sul database in
+modo asincrono (write-behind) a intervalli regolari e allo spegnimento.
+
+Sacchetto e storico sono scritti in transazioni separate: una voce di
+storico che il database rifiuta non blocca il salvataggio del sacchetto, e
+dopo HISTORY_MAX_FLUSH_ATTEMPTS tentativi falliti le voci vengono scritte
+una alla volta, scartando (con un log) quelle non valide.
+
+Durabilità: rischia tutto e i cambi di scena (configurazione e reset del
+sacchetto) vengono salvati subito con flush_now(). Le estrazioni normali e
+le modifiche minori al sacchetto restano in memoria fino al flush
+successivo: un arresto brusco del processo (kill -9, crash della macchina)
+ne perde al massimo BAG_FLUSH_INTERVAL secondi, anche se i client le hanno
+già viste. Uno spegnimento ordinato le salva (atexit).
+
+Le modifiche al sacchetto sono ottimistiche: si legge il sacchetto con la
+sua versione, si calcola il nuovo valore e lo si scrive con un
+compare-and-set; se nel frattempo un altro giocatore l'ha modificato si
+rilegge e si riprova (al massimo BAG_MAX_RETRIES volte). Anche la scrittura
+sul database è condizionata a Room.version, così un flush in ritardo non
+sovrascrive un sacchetto più recente.
+"""
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+
+from models import db, Room, DrawHistory
+import draw_stats
+from state_backend import MemoryStateBackend, RoomNotLoaded, create_backend
+
+# Intervallo (secondi) tra due scritture del sacchetto sul database
+FLUSH_INTERVAL = float(os.environ.get('BAG_FLUSH_INTERVAL', '2'))
+
+# Dopo quanti secondi di inattività una stanza già salvata esce dalla memoria
+IDLE_TTL = float(os.environ.get('ROOM_STATE_IDLE_TTL', '3600'))
+
+# Tentativi di compare-and-set prima di rinunciare a una modifica del sacchetto
+BAG_MAX_RETRIES = int(os.environ.get('BAG_MAX_RETRIES', '8'))
+
+# Flush falliti dello storico prima di scrivere le voci una alla volta
+HISTORY_MAX_FLUSH_ATTEMPTS = int(os.environ.get('HISTORY_MAX_FLUSH_ATTEMPTS', '3'))
+
+# Lunghezza massima del nome giocatore nello storico (colonna draw_history.player_name)
+PLAYER_NAME_MAX = DrawHistory.__table__.c.player_name.type.length
+
+
+class BagConflict(Exception):
+    """Il sacchetto è cambiato a ogni tentativo di modificarlo"""
+
+
+class BagMetrics:
+    """Contatori delle modifiche ottimistiche al sacchetto"""
+
+    def __init__(self):
+        self.commits = 0
+        self.retries = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def record(self, retries, committed=True):
+        with self._lock:
+            self.retries += retries
+            if committed:
+                self.commits += 1
+            else:
+                self.failures += 1
+
+    def stats(self):
+        """Modifiche riuscite, tentativi ripetuti e modifiche fallite"""
+        with self._lock:
+            attempts = self.commits + self.failures
+            return {
+                'commits': self.commits,
+                'retries': self.retries,
+                'failures': self.failures,
+                'retry_rate': self.retries / attempts if attempts else 0.0
+            }
+
+
+bag_metrics = BagMetrics()
+
+
+def clean_player_name(player_name):
+    """Nome giocatore valido per lo storico (mai vuoto, al massimo PLAYER_NAME_MAX caratteri)"""
+    name = str(player_name).strip() if player_name is not None else ''
+    return name[:PLAYER_NAME_MAX] or 'Giocatore'
+
+
+class RoomState:
+    """Stato autoritativo di una stanza durante il gioco"""
+
+    def __init__(self, room_pk, room_id, owner_id, bag_successi=0, bag_complicazioni=0,
+                 bag_version=0, backend=None):
+        self.room_pk = room_pk  # Room.id
+        self.room_id = room_id  # Room.room_id (stringa pubblica)
+        self.owner_id = owner_id
+
+        # Sacchetto, versione e stati temporanei dei giocatori (condivisi)
+        self.backend = backend or MemoryStateBackend()
+        self.backend.init_room(room_id, bag_successi or 0, bag_complicazioni or 0, bag_version or 0)
+
+        # Estrazioni di questo processo non ancora scritte su DrawHistory
+        self.pending_history = []
+        self.history_lock = threading.Lock()
+
+        # Lo snapshot usato da join_room è valido finché la versione della
+        # stanza non cambia (vedi room_snapshot.py)
+        self.snapshot = None  # (versione, dati)
+        self.snapshot_lock = threading.Lock()
+
+        self.dirty = False
+        self.history_failures = 0
+        self.last_access = time.monotonic()
+
+        # flush_lock serializza le scritture della stanza da questo processo
+        self.flush_lock = threading.Lock()
+
+    def _backend(self, method, *args):
+        """Chiama il backend; se la stanza ne è uscita (evizione, TTL di Redis) la ricarica dal database"""
+        try:
+            return getattr(self.backend, method)(self.room_id, *args)
+        except RoomNotLoaded:
+            self._reload()
+            return getattr(self.backend, method)(self.room_id, *args)
+
+    def _reload(self):
+        # Dopo l'evizione il database ha l'ultimo sacchetto: si esce dalla memoria solo già salvati
+        row = db.session.query(Room.bag_successi, Room.bag_complicazioni, Room.version) \
+            .filter(Room.id == self.room_pk) \
+            .first()
+        if row is None:
+            raise RoomNotLoaded(self.room_id)
+        print(f"🔄 Stanza {self.room_id} ricaricata dal database")
+        self.backend.init_room(self.room_id, row.bag_successi or 0, row.bag_complicazioni or 0, row.version or 0)
+
+    @property
+    def version(self):
+        """Versione crescente dello stato: ogni modifica la incrementa"""
+        return self._backend('get_version')
+
+    @property
+    def bag_successi(self):
+        return self._backend('get_bag')[0]
+
+    @property
+    def bag_complicazioni(self):
+        return self._backend('get_bag')[1]
+
+    @property
+    def adrenaline(self):
+        """Adrenalina dei giocatori (non persistita)"""
+        return self._backend('get_player_states', 'adrenaline')
+
+    @property
+    def confusion(self):
+        """Confusione dei giocatori (non persistita)"""
+        return self._backend('get_player_states', 'confusion')
+
+    def set_player_state(self, kind, player_name, value):
+        """Imposta adrenalina o confusione di un giocatore"""
+        self._backend('set_player_state', kind, player_name, value)
+
+    def bag(self):
+        """Sacchetto corrente come dizionario"""
+        successi, complicazioni, _ = self._backend('get_bag')
+        return {
+            'successi': successi,
+            'complicazioni': complicazioni
+        }
+
+    def bump(self):
+        """Segnala una modifica della stanza (invalida lo snapshot)"""
+        self._backend('incr_version')
+
+    def update_bag(self, mutate, retries=None):
+        """Modifica il sacchetto con compare-and-set, senza lock della stanza.
+
+        mutate(successi, complicazioni) restituisce (successi, complicazioni,
+        risultato) e può essere chiamata più volte: deve dipendere solo dai
+        valori ricevuti. Restituisce il risultato dell'ultima chiamata;
+        solleva BagConflict se il sacchetto cambia a ogni tentativo.
+        """
+        retries = retries or BAG_MAX_RETRIES
+        for attempt in range(retries):
+            successi, complicazioni, bag_version = self._backend('get_bag')
+            new_successi, new_complicazioni, result = mutate(successi, complicazioni)
+            if self._backend('compare_and_set_bag', bag_version, new_successi, new_complicazioni):
+                self.dirty = True
+                bag_metrics.record(attempt)
+                return result
+
+        bag_metrics.record(retries, committed=False)
+        raise BagConflict('Il sacchetto è stato modificato da altri giocatori, riprova')
+
+    def set_bag(self, successi, complicazioni):
+        """Imposta il sacchetto e segna la stanza da salvare"""
+        self.update_bag(lambda *_: (successi, complicazioni, None))
+
+    def record_draw(self, player_name, drawn, successi, complicazioni,
+                    adrenaline=False, confusion=False, risk_all=False, bag_size=None):
+        """Accoda un'estrazione per lo storico e restituisce il timestamp.
+
+        bag_size è il numero di token nel sacchetto prima dell'estrazione
+        (usato solo per le statistiche).
+        """
+        timestamp = datetime.utcnow()
+        entry = {
+            'player_name': clean_player_name(player_name),
+            'drawn_tokens': [str(token) for token in drawn],
+            'successi': int(successi),
+            'complicazioni': int(complicazioni),
+            'adrenaline': bool(adrenaline),
+            'confusion': bool(confusion),
+            'risk_all': bool(risk_all),
+            'timestamp': timestamp,
+            'bag_size': bag_size
+        }
+        with self.history_lock:
+            self.pending_history.append(entry)
+        self.dirty = True
+        self.bump()
+        return timestamp
+
+
+class RoomStateRegistry:
+    """Registro delle stanze attive con persistenza write-behind"""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, idle_ttl=IDLE_TTL, backend=None):
+        self.backend = backend or create_backend()
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+        self._states = {}
+        self._lock = threading.Lock()
+        self._app = None
+        self._socketio = None
+        self._flusher_started = False
+
+    def init_app(self, app, socketio):
+        """Collega il registro all'app Flask e avvia il salvataggio allo spegnimento"""
+        self._app = app
+        self._socketio = socketio
+        atexit.register(self.shutdown)
+
+    def __contains__(self, room_id):
+        return room_id in self._states
+
+    def register(self, room):
+        """Registra (o restituisce) lo stato di una stanza già caricata dal database"""
+        with self._lock:
+            state = self._states.get(room.room_id)
+            if state is None:
+                state = RoomState(
+                    room_pk=room.id,
+                    room_id=room.room_id,
+                    owner_id=room.owner_id,
+                    bag_successi=room.bag_successi,
+                    bag_complicazioni=room.bag_complicazioni,
+                    bag_version=room.version,
+                    backend=self.backend
+                )
+                self._states[room.room_id] = state
+        state.last_access = time.monotonic()
+        self._ensure_flusher()
+        return state
+
+    def get(self, room_id):
+        """Stato della stanza; la carica dal database solo al primo accesso"""
+        state = self._states.get(room_id)
+        if state is not None:
+            state.last_access = time.monotonic()
+            return state
+
+        room = Room.query.filter_by(room_id=room_id, is_active=True).first()
+        if not room:
+            return None
+        return self.register(room)
+
+    def bump(self, room_id):
+        """Segnala la modifica di una stanza, se è caricata in memoria"""
+        state = self._states.get(room_id)
+        if state is not None:
+            state.bump()
+
+    def flush(self, room_id=None):
+        """Scrive sul database i sacchetti e lo storico in sospeso.
+
+        Per ogni stanza il sacchetto viene scritto in una transazione e
+        storico e statistiche in un'altra: se una fallisce, le sue modifiche
+        tornano in coda e vengono ritentate al giro successivo.
+        """
+        if room_id is not None:
+            state = self._states.get(room_id)
+            states = [state] if state is not None else []
+        else:
+            states = list(self._states.values())
+
+        error = None
+        for state in states:
+            if not state.dirty:
+                continue
+            with state.flush_lock:
+                if not state.dirty:
+                    continue
+                # dirty va azzerato prima di leggere: le modifiche successive
+                # lo reimpostano dopo aver scritto sacchetto o storico
+                state.dirty = False
+                error = self._flush_bag(state) or error
+                error = self._flush_history(state) or error
+
+        if error is not None:
+            raise error
+
+    def flush_now(self, room_id):
+        """Salva subito una stanza (rischia tutto, cambi di scena).
+
+        Un errore non interrompe l'evento: le modifiche restano in coda per
+        il flush periodico.
+        """
+        try:
+            self.flush(room_id)
+        except Exception as e:
+            print(f"⚠️  Salvataggio immediato della stanza {room_id} fallito, verrà ritentato: {e}")
+
+    def _flush_bag(self, state):
+        successi, complicazioni, bag_version = state._backend('get_bag')
+        try:
+            # Scrittura condizionata: un sacchetto più recente
+            # (di un altro worker) non viene sovrascritto
+            Room.query.filter(
+                Room.id == state.room_pk,
+                Room.version < bag_version
+            ).update({
+                'bag_successi': successi,
+                'bag_complicazioni': complicazioni,
+                'version': bag_version
+            }, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            state.dirty = True
+            return e
+        return None
+
+    def _flush_history(self, state):
+        with state.history_lock:
+            history = state.pending_history
+            state.pending_history = []
+        if not history:
+            return None
+
+        try:
+            self._write_history(state.room_pk, history)
+            state.history_failures = 0
+            return None
+        except Exception as e:
+            db.session.rollback()
+            state.history_failures += 1
+            if state.history_failures < HISTORY_MAX_FLUSH_ATTEMPTS:
+                with state.history_lock:
+                    state.pending_history[:0] = history
+                state.dirty = True
+                return e
+
+        # Troppi tentativi falliti: una voce alla volta, scartando quelle rifiutate
+        state.history_failures = 0
+        for entry in history:
+            try:
+                self._write_history(state.room_pk, [entry])
+            except Exception as e:
+                db.session.rollback()
+                print(f"❌ Estrazione scartata dallo storico della stanza {state.room_id}: {entry!r} ({e})")
+        return None
+
+    def _write_history(self, room_pk, history):
+        draw_stats.record_draws(room_pk, history)
+        # Un solo INSERT per tutte le estrazioni (l'ORM le inserirebbe una alla volta)
+        db.session.execute(DrawHistory.__table__.insert(), [
+            dict(room_id=room_pk, **{key: value for key, value in entry.items() if key != 'bag_size'})
+            for entry in history
+        ])
+        db.session.commit()
+
+    def evict_idle(self):
+        """Rimuove dalla memoria le stanze inattive già salvate"""
+        now = time.monotonic()
+        with self._lock:
+            for room_id, state in list(self._states.items()):
+                if not state.dirty and now - state.last_access > self.idle_ttl:
+                    del self._states[room_id]
+                    self.backend.discard(room_id)
+
+    def shutdown(self):
+        """Salvataggio finale allo spegnimento del processo"""
+        if self._app is None:
+            return
+        try:
+            with self._app.app_context():
+                self.flush()
+        except Exception as e:
+            print(f"❌ Errore nel salvataggio finale delle stanze: {e}")
+
+    def _ensure_flusher(self):
+        if self._flusher_started or self._socketio is None:
+            return
+        self._flusher_started = True
+        self._socketio.start_background_task(self._flush_loop)
+
+    def _flush_loop(self):
+        while True:
+            self._socketio.sleep(self.flush_interval)
+            try:
+                with self._app.app_context():
+                    self.flush()
+                self.evict_idle()
+            except Exception as e:
+                print(f"⚠️  Errore nel salvataggio delle stanze: {e}")
@@ -0,0 +1,63 @@
+"""
+Pulizia periodica delle sessioni scadute.
+
+Le sessioni scadute vengono eliminate in lotti di SESSION_SWEEP_BATCH righe,
+un commit per lotto e una pausa cooperativa tra un lotto e l'altro, così la
+pulizia non tiene a lungo lock sulla tabella né blocca gli altri greenlet.
+Insieme al limite di sessioni per utente (SESSION_MAX_PER_USER in auth.py)
+la tabella sessions resta proporzionale agli utenti attivi.
+"""
+import os
+from datetime import datetime
+
+from models import db, Session
+
+# Intervallo (secondi) tra due passaggi di pulizia; 0 disattiva
+SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '3600'))
+
+# Sessioni eliminate per lotto
+SWEEP_BATCH = int(os.environ.get('SESSION_SWEEP_BATCH', '500'))
+
+
+def sweep_expired(now=None, batch_size=SWEEP_BATCH, pause=None):
+    """Elimina le sessioni scadute a lotti; restituisce quante ne ha eliminate.
+
+    pause() viene chiamata tra un lotto e l'altro (es. socketio.sleep).
+    """
+    now = now or datetime.utcnow()
+    deleted = 0
+    while True:
+        ids = [session_id for (session_id,) in db.session.query(Session.id)
+               .filter(Session.expires_at < now)
+               .order_by(Session.expires_at)
+               .limit(batch_size)
+               .all()]
+        if not ids:
+            break
+        Session.query.filter(Session.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            break
+        if pause:
+            pause()
+    return deleted
+
+
+def init_app(app, socketio):
+    """Avvia la pulizia periodica in background"""
+    if SWEEP_INTERVAL <= 0:
+        return
+
+    def sweep_loop():
+        while True:
+            socketio.sleep(SWEEP_INTERVAL)
+            try:
+                with app.app_context():
+                    deleted = sweep_expired(pause=lambda: socketio.sleep(0))
+                if deleted:
+                    print(f"🧹 {deleted} sessioni scadute eliminate")
+            except Exception as e:
+                print(f"⚠️  Errore durante la pulizia delle sessioni: {e}")
+
+    socketio.start_background_task(sweep_loop)
@@ -0,0 +1,216 @@
+"""
+Sessioni senza stato: token firmati con HMAC (SESSION_MODE=token).
+
+Il token contiene id utente, username, emissione, scadenza e un id casuale
+(jti), firmati con HMAC-SHA256 a partire dal SECRET_KEY dell'app:
+
+    v1.<payload base64url>.<firma base64url>
+
+La verifica è solo calcolo: nessuna query al database. La revoca passa da
+una denylist (in memoria, o su Redis con più worker tramite
+SESSION_DENYLIST=redis://...): al logout si registra l'ora dell'ultimo
+logout dell'utente e il jti del token. Il jti viene cercato nella denylist
+solo per i token emessi prima dell'ultimo logout del loro utente.
+
+L'ora dell'ultimo logout resta registrata per SESSION_LIFETIME dopo il
+logout, non fino alla scadenza del token usato per uscire: un token più
+vecchio può scadere prima di altri token revocati dello stesso utente, e
+senza l'ultimo logout i loro jti non verrebbero più controllati.
+
+Con le sessioni sul database la denylist condivisa (Redis) registra anche
+gli id delle sessioni chiuse (logout o limite per utente): gli altri
+worker li controllano prima di fidarsi della propria cache delle sessioni
+(vedi auth.verify_session).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+
+try:
+    import redis
+except ImportError:  # redis opzionale: serve solo con più worker
+    redis = None
+
+# 'db' (sessioni sul database, default) o 'token'
+SESSION_MODE = os.environ.get('SESSION_MODE', 'db').lower()
+
+TOKEN_PREFIX = 'v1.'
+
+# Durata di una sessione (sul database o token)
+SESSION_LIFETIME = timedelta(days=7)
+
+
+class InvalidToken(Exception):
+    """Token malformato, con firma non valida o scaduto"""
+
+
+def is_token(session_id):
+    return isinstance(session_id, str) and session_id.startswith(TOKEN_PREFIX)
+
+
+@lru_cache(maxsize=4)
+def _signing_key(secret_key):
+    # Chiave dedicata ai token, derivata dal SECRET_KEY dell'app
+    return hmac.new(secret_key.encode('utf-8'), b'not-the-end-session-token', hashlib.sha256).digest()
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signature(secret_key, payload):
+    return hmac.new(_signing_key(secret_key), payload.encode('ascii'), hashlib.sha256).digest()
+
+
+def issue_token(secret_key, user_id, username, expires_at):
+    """Token firmato per l'utente; expires_at è un timestamp UNIX"""
+    claims = {
+        'u': user_id,
+        'n': username,
+        'iat': time.time(),
+        'exp': expires_at,
+        'jti': secrets.token_urlsafe(9)
+    }
+    payload = _b64encode(json.dumps(claims, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+    return f"{TOKEN_PREFIX}{payload}.{_b64encode(_signature(secret_key, payload))}"
+
+
+def decode_token(secret_key, token, now=None):
+    """Dati del token dopo aver verificato firma e scadenza"""
+    try:
+        payload, signature = token[len(TOKEN_PREFIX):].split('.')
+        valid = hmac.compare_digest(_b64decode(signature), _signature(secret_key, payload))
+    except (ValueError, TypeError):
+        raise InvalidToken('Sessione non valida')
+    if not valid:
+        raise InvalidToken('Sessione non valida')
+
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        raise InvalidToken('Sessione non valida')
+    if claims['exp'] < (now or time.time()):
+        raise InvalidToken('Sessione scaduta')
+    return claims
+
+
+class MemoryDenylist:
+    """Denylist nel processo corrente"""
+
+    shared = False
+
+    def __init__(self):
+        self._last_logout = {}  # user_id -> (timestamp, scadenza)
+        self._revoked = {}  # jti -> scadenza del token
+        self._sessions = {}  # id sessione sul database -> scadenza
+        self._lock = threading.Lock()
+
+    def revoke(self, user_id, jti, expires_at):
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            # Ogni token emesso prima di adesso scade entro SESSION_LIFETIME
+            keep_until = now + SESSION_LIFETIME.total_seconds()
+            previous = self._last_logout.get(user_id)
+            if previous is not None:
+                keep_until = max(keep_until, previous[1])
+            self._last_logout[user_id] = (now, keep_until)
+            self._revoked[jti] = expires_at
+
+    def revoke_session(self, session_id, expires_at):
+        """Sessione sul database chiusa (logout o limite per utente)"""
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            self._sessions[session_id] = expires_at
+
+    def is_session_revoked(self, session_id):
+        return session_id in self._sessions
+
+    def last_logout(self, user_id):
+        entry = self._last_logout.get(user_id)
+        return entry[0] if entry else None
+
+    def is_revoked(self, jti):
+        return jti in self._revoked
+
+    def _prune(self, now):
+        # Le voci servono solo finché i token a cui si riferiscono non scadono
+        for jti in [jti for jti, expires_at in self._revoked.items() if expires_at < now]:
+            del self._revoked[jti]
+        for user_id in [u for u, (_, expires_at) in self._last_logout.items() if expires_at < now]:
+            del self._last_logout[user_id]
+        for session_id in [s for s, expires_at in self._sessions.items() if expires_at < now]:
+            del self._sessions[session_id]
+
+    def stats(self):
+        return {'revoked': len(self._revoked), 'users': len(self._last_logout), 'sessions': len(self._sessions)}
+
+
+class RedisDenylist:
+    """Denylist su Redis, condivisa tra i worker"""
+
+    shared = True
+
+    def __init__(self, url, prefix='nte'):
+        if redis is None:
+            raise RuntimeError('La denylist Redis richiede il pacchetto redis')
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    def revoke(self, user_id, jti, expires_at):
+        now = time.time()
+        pipe = self._client.pipeline()
+        # Il logout più recente vince e riparte da SESSION_LIFETIME: il TTL
+        # non viene mai accorciato dal logout con un token prossimo alla scadenza
+        pipe.set(f'{self._prefix}:logout:{user_id}', now,
+                 ex=int(SESSION_LIFETIME.total_seconds()) + 1)
+        pipe.set(f'{self._prefix}:revoked:{jti}', 1, ex=max(1, int(expires_at - now) + 1))
+        pipe.execute()
+
+    def revoke_session(self, session_id, expires_at):
+        ttl = max(1, int(expires_at - time.time()) + 1)
+        self._client.set(f'{self._prefix}:session:{session_id}', 1, ex=ttl)
+
+    def is_session_revoked(self, session_id):
+        return bool(self._client.exists(f'{self._prefix}:session:{session_id}'))
+
+    def last_logout(self, user_id):
+        value = self._client.get(f'{self._prefix}:logout:{user_id}')
+        return float(value) if value is not None else None
+
+    def is_revoked(self, jti):
+        return bool(self._client.exists(f'{self._prefix}:revoked:{jti}'))
+
+    def stats(self):
+        return {}
+
+
+def create_denylist(url=None):
+    """Denylist indicata da SESSION_DENYLIST ('memory' o URL redis://)"""
+    url = url or os.environ.get('SESSION_DENYLIST', 'memory')
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisDenylist(url)
+    return MemoryDenylist()
+
+
+denylist = create_denylist()
+
+
+def is_revoked(claims):
+    """True se il token è stato revocato con un logout"""
+    last_logout = denylist.last_logout(claims['u'])
+    if last_logout is None or claims['iat'] > last_logout:
+        return False
+    return denylist.is_revoked(claims['jti'])
@@ -0,0 +1,192 @@
+"""
+Profilo SQLite per installazioni su un solo server (SQLITE_MODE=production).
+
+Con le impostazioni di default di SQLite (journal in modalità DELETE,
+synchronous=FULL) ogni scrittura blocca anche le letture, e i greenlet che
+scrivono insieme si contendono il lock del database fino al "database is
+locked". In modalità production:
+
+- ogni connessione usa journal WAL (le letture non aspettano le scritture),
+  synchronous=NORMAL, busy_timeout, mmap_size e cache_size
+- le scritture passano da una coda con un solo writer alla volta
+  (WriterGate): chi scrive aspetta il proprio turno in modo cooperativo,
+  invece di bloccare il processo nel busy handler di SQLite
+- le letture usano le altre connessioni del pool e non entrano mai nella
+  coda, quindi procedono in parallelo al writer
+
+Il turno di scrittura appartiene a una connessione, non al greenlet: se lo
+stesso greenlet prova a scrivere con una seconda connessione mentre la
+prima ha una transazione di scrittura aperta, la seconda aspetterebbe un
+lock di SQLite che solo lui può liberare. Invece di restare bloccato fino
+al busy_timeout, WriterGate.acquire fallisce subito con un errore esplicito.
+
+SQLITE_MODE=dev (default) mantiene la configurazione di sviluppo.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import event as sa_event
+
+from db_pool import MeteredQueuePool
+
+SQLITE_MODE = os.environ.get('SQLITE_MODE', 'dev').lower()
+
+# Pragma applicati a ogni connessione
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', '32768'))
+
+# Connessioni del pool (un writer alla volta, le altre in lettura)
+POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', '8'))
+
+# Attesa massima (secondi) del proprio turno di scrittura
+WRITER_TIMEOUT = float(os.environ.get('SQLITE_WRITER_TIMEOUT', '10'))
+
+# Statement che scrivono (e quindi entrano nella coda del writer)
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'ALTER', 'DROP')
+
+
+def is_production():
+    return SQLITE_MODE == 'production'
+
+
+class WriterGate:
+    """Coda delle scritture: un solo writer alla volta, gli altri in attesa"""
+
+    def __init__(self, timeout=WRITER_TIMEOUT):
+        self.timeout = timeout
+        # Non rientrante: il turno passa da una connessione all'altra
+        self._lock = threading.Lock()
+        self._owner = None  # greenlet (o thread) che ha il turno
+        self._stats_lock = threading.Lock()
+        self.waiting = 0
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def acquire(self):
+        if self._owner == threading.get_ident():
+            raise sqlite3.OperationalError(
+                'Scrittura da una seconda connessione mentre la prima ha il turno di scrittura '
+                '(stesso greenlet): si bloccherebbe sul lock di SQLite')
+        start = time.perf_counter()
+        with self._stats_lock:
+            self.waiting += 1
+        acquired = self._lock.acquire(timeout=self.timeout)
+        wait = time.perf_counter() - start
+        with self._stats_lock:
+            self.waiting -= 1
+            if acquired:
+                self.acquisitions += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            else:
+                self.timeouts += 1
+        if not acquired:
+            raise sqlite3.OperationalError(f'Attesa del turno di scrittura oltre {self.timeout}s')
+        self._owner = threading.get_ident()
+
+    def release(self):
+        self._owner = None
+        self._lock.release()
+
+    def stats(self):
+        """Scritture servite, in attesa e tempi di attesa"""
+        with self._stats_lock:
+            return {
+                'writers_waiting': self.waiting,
+                'acquisitions': self.acquisitions,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': (self.wait_total / self.acquisitions * 1000) if self.acquisitions else 0.0,
+                'wait_max_ms': self.wait_max * 1000
+            }
+
+
+writer_gate = WriterGate()
+
+
+class GatedConnection(sqlite3.Connection):
+    """Connessione sqlite3 che lascia la coda del writer dopo commit/rollback"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gate = writer_gate
+        self.holds_gate = False
+
+    def enter_writer_queue(self):
+        if not self.holds_gate:
+            self.gate.acquire()
+            self.holds_gate = True
+
+    def _leave_writer_queue(self):
+        if self.holds_gate:
+            self.holds_gate = False
+            self.gate.release()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._leave_writer_queue()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._leave_writer_queue()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._leave_writer_queue()
+
+
+def engine_options():
+    """Opzioni dell'engine SQLite in modalità production"""
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': POOL_SIZE,
+        'max_overflow': 0,
+        'pool_timeout': WRITER_TIMEOUT,
+        'connect_args': {
+            'factory': GatedConnection,
+            'check_same_thread': False,
+            'timeout': BUSY_TIMEOUT_MS / 1000
+        }
+    }
+
+
+def apply_pragmas(dbapi_connection, connection_record=None):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+
+def _enter_writer_queue(conn, cursor, statement, *args):
+    if statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+        dbapi_connection = cursor.connection
+        if isinstance(dbapi_connection, GatedConnection):
+            dbapi_connection.enter_writer_queue()
+
+
+def configure_engine(engine):
+    """Pragma su ogni nuova connessione e coda del writer sulle scritture"""
+    sa_event.listen(engine, 'connect', apply_pragmas)
+    sa_event.listen(engine, 'before_cursor_execute', _enter_writer_queue)
+
+
+def init_app(app, db):
+    """Configura l'engine dell'app (prima di aprire qualsiasi connessione)"""
+    with app.app_context():
+        configure_engine(db.engine)
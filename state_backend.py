@@ -0,0 +1,200 @@
+"""
+Backend dello stato condiviso delle stanze.
+
+Sacchetto, versione e stati temporanei dei giocatori (adrenalina,
+confusione) vivono in un backend intercambiabile:
+
+- MemoryStateBackend: nel solo processo corrente (default, un worker)
+- RedisStateBackend: su Redis, condiviso tra più worker/nodi
+
+Con più worker va usato Redis sia qui (ROOM_STATE_BACKEND) sia come coda
+messaggi di Socket.IO (SOCKETIO_MESSAGE_QUEUE), così i broadcast
+raggiungono i client collegati agli altri processi.
+
+Il sacchetto si modifica solo con compare-and-set sulla sua versione
+(bag_version): nessun lock della stanza, chi perde la corsa rilegge e
+riprova (vedi RoomState.update_bag).
+"""
+import os
+import threading
+
+try:
+    import redis
+except ImportError:  # redis opzionale: serve solo con più worker
+    redis = None
+
+# Stati temporanei dei giocatori
+PLAYER_STATES = ('adrenaline', 'confusion')
+
+
+class RoomNotLoaded(KeyError):
+    """La stanza non è (più) nel backend: va ricaricata dal database"""
+
+
+def _new_room(successi=0, complicazioni=0, bag_version=0):
+    return {
+        'successi': successi,
+        'complicazioni': complicazioni,
+        'bag_version': bag_version,
+        'version': 0,
+        'adrenaline': {},
+        'confusion': {},
+        # Sezione critica di pochi confronti, mai tenuta durante un'estrazione
+        'cas_lock': threading.Lock()
+    }
+
+
+class MemoryStateBackend:
+    """Stato delle stanze nel processo corrente"""
+
+    shared = False
+
+    def __init__(self):
+        self._rooms = {}
+        self._lock = threading.Lock()  # solo per creare/rimuovere stanze
+
+    def _room(self, room_id):
+        room = self._rooms.get(room_id)
+        if room is None:
+            # Mai un sacchetto vuoto al posto di una stanza uscita dalla memoria
+            raise RoomNotLoaded(room_id)
+        return room
+
+    def init_room(self, room_id, successi, complicazioni, bag_version=0):
+        """Inizializza il sacchetto se la stanza non è già presente"""
+        with self._lock:
+            if room_id not in self._rooms:
+                self._rooms[room_id] = _new_room(successi, complicazioni, bag_version)
+
+    def get_bag(self, room_id):
+        """(successi, complicazioni, bag_version) letti insieme"""
+        room = self._room(room_id)
+        with room['cas_lock']:
+            return room['successi'], room['complicazioni'], room['bag_version']
+
+    def compare_and_set_bag(self, room_id, bag_version, successi, complicazioni):
+        """Imposta il sacchetto solo se la versione è ancora bag_version"""
+        room = self._room(room_id)
+        with room['cas_lock']:
+            if room['bag_version'] != bag_version:
+                return False
+            room['successi'] = successi
+            room['complicazioni'] = complicazioni
+            room['bag_version'] += 1
+            room['version'] += 1
+            return True
+
+    def get_version(self, room_id):
+        return self._room(room_id)['version']
+
+    def incr_version(self, room_id):
+        room = self._room(room_id)
+        with room['cas_lock']:
+            room['version'] += 1
+            return room['version']
+
+    def set_player_state(self, room_id, kind, player_name, value):
+        self._room(room_id)[kind][player_name] = value
+
+    def get_player_states(self, room_id, kind):
+        return dict(self._room(room_id)[kind])
+
+    def discard(self, room_id):
+        """Rimuove la stanza (uscita dalla memoria)"""
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+
+# Compare-and-set atomico del sacchetto su Redis
+_CAS_BAG_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'bag_version')
+if not current then
+    return -1
+end
+if current ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'successi', ARGV[2], 'complicazioni', ARGV[3])
+redis.call('HINCRBY', KEYS[1], 'bag_version', 1)
+redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class RedisStateBackend:
+    """Stato delle stanze su Redis, condiviso tra i worker"""
+
+    shared = True
+
+    def __init__(self, url, prefix='nte', ttl=None):
+        if redis is None:
+            raise RuntimeError('Il backend Redis richiede il pacchetto redis')
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        # Le stanze non toccate per ttl secondi spariscono da Redis
+        # (il sacchetto è comunque salvato sul database)
+        self._ttl = int(ttl or os.environ.get('ROOM_STATE_REDIS_TTL', '86400'))
+        self._cas_bag = self._client.register_script(_CAS_BAG_SCRIPT)
+
+    def _key(self, room_id, suffix=''):
+        return f'{self._prefix}:room:{room_id}{suffix}'
+
+    def init_room(self, room_id, successi, complicazioni, bag_version=0):
+        key = self._key(room_id)
+        pipe = self._client.pipeline()
+        pipe.hsetnx(key, 'successi', successi)
+        pipe.hsetnx(key, 'complicazioni', complicazioni)
+        pipe.hsetnx(key, 'bag_version', bag_version)
+        pipe.hsetnx(key, 'version', 0)
+        pipe.expire(key, self._ttl)
+        pipe.execute()
+
+    def get_bag(self, room_id):
+        successi, complicazioni, bag_version = self._client.hmget(
+            self._key(room_id), 'successi', 'complicazioni', 'bag_version'
+        )
+        if bag_version is None:
+            # Scaduta su Redis (ROOM_STATE_REDIS_TTL)
+            raise RoomNotLoaded(room_id)
+        return int(successi or 0), int(complicazioni or 0), int(bag_version)
+
+    def compare_and_set_bag(self, room_id, bag_version, successi, complicazioni):
+        result = self._cas_bag(
+            keys=[self._key(room_id)],
+            args=[bag_version, successi, complicazioni, self._ttl]
+        )
+        if result == -1:
+            raise RoomNotLoaded(room_id)
+        return bool(result)
+
+    def get_version(self, room_id):
+        return int(self._client.hget(self._key(room_id), 'version') or 0)
+
+    def incr_version(self, room_id):
+        return self._client.hincrby(self._key(room_id), 'version', 1)
+
+    def set_player_state(self, room_id, kind, player_name, value):
+        key = self._key(room_id, f':{kind}')
+        pipe = self._client.pipeline()
+        pipe.hset(key, player_name, value)
+        pipe.expire(key, self._ttl)
+        pipe.execute()
+
+    def get_player_states(self, room_id, kind):
+        return {
+            player_name: int(value)
+            for player_name, value in self._client.hgetall(self._key(room_id, f':{kind}')).items()
+        }
+
+    def discard(self, room_id):
+        # Lo stato resta su Redis per gli altri worker
+        pass
+
+
+def create_backend(url=None):
+    """Backend indicato da ROOM_STATE_BACKEND ('memory' o URL redis://)"""
+    url = url or os.environ.get('ROOM_STATE_BACKEND', 'memory')
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateBackend(url)
+    return MemoryStateBackend()
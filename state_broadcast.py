@@ -0,0 +1,71 @@
+"""
+Broadcast raggruppati degli stati temporanei dei giocatori.
+
+Adrenalina e confusione cambiano molte volte al secondo mentre si muove uno
+slider: invece di un evento per modifica, gli aggiornamenti di una stanza
+vengono raccolti per STATE_COALESCE_WINDOW secondi e inviati con un solo
+evento 'states_updated' che contiene l'ultimo valore di ogni giocatore.
+"""
+import os
+import threading
+
+from state_backend import PLAYER_STATES
+
+# Finestra (secondi) in cui gli aggiornamenti di una stanza vengono uniti
+COALESCE_WINDOW = float(os.environ.get('STATE_COALESCE_WINDOW', '0.05'))
+
+
+class StateBroadcaster:
+    """Buffer per stanza degli aggiornamenti di adrenalina e confusione"""
+
+    def __init__(self, socketio, window=COALESCE_WINDOW):
+        self._socketio = socketio
+        self.window = window
+        self._pending = {}  # room_id -> {kind: {player_name: valore}}
+        self._lock = threading.Lock()
+        self.updates = 0
+        self.broadcasts = 0
+
+    def push(self, room_id, kind, player_name, value):
+        """Accoda un aggiornamento; il primo della finestra programma l'invio"""
+        with self._lock:
+            self.updates += 1
+            pending = self._pending.get(room_id)
+            schedule = pending is None
+            if schedule:
+                pending = self._pending[room_id] = {}
+            pending.setdefault(kind, {})[player_name] = value
+
+        if not schedule:
+            return
+        if self.window > 0:
+            self._socketio.start_background_task(self._flush_later, room_id)
+        else:
+            self.flush(room_id)
+
+    def _flush_later(self, room_id):
+        self._socketio.sleep(self.window)
+        self.flush(room_id)
+
+    def flush(self, room_id):
+        """Invia subito gli aggiornamenti in attesa della stanza"""
+        with self._lock:
+            pending = self._pending.pop(room_id, None)
+            if pending:
+                self.broadcasts += 1
+        if not pending:
+            return
+
+        payload = {'room_id': room_id}
+        for kind in PLAYER_STATES:
+            payload[kind] = pending.get(kind, {})
+        self._socketio.emit('states_updated', payload, room=room_id)
+
+    def stats(self):
+        """Aggiornamenti ricevuti e broadcast inviati"""
+        with self._lock:
+            return {
+                'updates': self.updates,
+                'broadcasts': self.broadcasts,
+                'pending_rooms': len(self._pending)
+            }
@@ -28,6 +28,15 @@ let characterSheet = {
     notes: ''
 };
 
+// Campi della scheda inviati al server come differenze (save_character_delta)
+const CHARACTER_FIELDS = [
+    'name', 'motivation', 'archetype', 'photo', 'traits',
+    'selected_traits', 'empowered_traits', 'quality_counter', 'ability_counter',
+    'misfortunes', 'lessons', 'resources', 'notes'
+];
+let savedCharacterSheet = {}; // Ultima versione della scheda nota al server
+let characterVersion = 0; // Versione della scheda su cui si basano le modifiche
+
 let selectedTraits = new Set(); // ID dei tratti selezionati
 let empoweredTraits = new Set(); // ID dei tratti potenziati
 let qualityCounter = 0; // Contatore qualità
@@ -164,7 +173,13 @@ loginBtn.addEventListener('click', () => {
 // Logout
 logoutBtn.addEventListener('click', () => {
     if (confirm('Sei sicuro di voler uscire?')) {
-        location.reload();
+        if (!sessionId) {
+            location.reload();
+            return;
+        }
+        // Elimina la sessione (o revoca il token) prima di ricaricare
+        socket.emit('logout', { session_id: sessionId }, () => location.reload());
+        setTimeout(() => location.reload(), 2000);
     }
 });
 
@@ -417,12 +432,22 @@ document.getElementById('uploadPhotoBtn').addEventListener('click', () => {
 document.getElementById('photoUpload').addEventListener('change', (e) => {
     const file = e.target.files[0];
     if (file) {
-        const reader = new FileReader();
-        reader.onload = (event) => {
-            document.getElementById('characterPhoto').src = event.target.result;
-            characterSheet.photo = event.target.result;
-        };
-        reader.readAsDataURL(file);
+        // Carica la foto sul server: la scheda conserva solo la sua URL
+        const formData = new FormData();
+        formData.append('photo', file);
+        formData.append('session_id', sessionId);
+
+        fetch('/photos', { method: 'POST', body: formData })
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) {
+                    showLog(`❌ ${data.error}`, 'error');
+                    return;
+                }
+                document.getElementById('characterPhoto').src = data.url;
+                characterSheet.photo = data.url;
+            })
+            .catch(() => showLog('❌ Errore nel caricamento della foto', 'error'));
     }
 });
 
@@ -648,6 +673,31 @@ socket.on('character_saved', (data) => {
     loadVisibleCharacters();
 });
 
+socket.on('character_updated', (data) => {
+    if (data.player_name === currentPlayerName) {
+        characterVersion = Math.max(characterVersion, data.version);
+        return;
+    }
+
+    showLog(`💾 ${data.player_name} ha aggiornato la scheda`, 'success');
+
+    // Applica le modifiche alla scheda già caricata, altrimenti ricarica la lista
+    const char = visibleCharacters[data.player_name];
+    if (char) {
+        Object.assign(char, data.changes, { version: data.version });
+        displayOtherCharacters(Object.values(visibleCharacters));
+    } else {
+        loadVisibleCharacters();
+    }
+});
+
+socket.on('character_conflict', (data) => {
+    showLog('⚠️ La scheda è stata modificata altrove: ricaricata la versione più recente', 'error');
+    if (data.character) {
+        loadMyCharacter(data.character);
+    }
+});
+
 socket.on('my_character_loaded', (data) => {
     if (data.character) {
         loadMyCharacter(data.character);
@@ -1297,14 +1347,36 @@ function saveCharacterSheet() {
     characterSheet.quality_counter = qualityCounter;
     characterSheet.ability_counter = abilityCounter;
 
-    // Invia al server
-    socket.emit('save_character', {
+    // Invia al server solo i campi modificati
+    sendCharacterChanges();
+
+    showLog('💾 Scheda salvata!', 'success');
+}
+
+// Invia al server i campi cambiati rispetto all'ultima versione salvata
+function sendCharacterChanges() {
+    const changes = {};
+    CHARACTER_FIELDS.forEach(field => {
+        const value = characterSheet[field];
+        if (value === undefined) return;
+        if (JSON.stringify(value) !== JSON.stringify(savedCharacterSheet[field])) {
+            changes[field] = value;
+        }
+    });
+
+    if (Object.keys(changes).length === 0) return false;
+
+    socket.emit('save_character_delta', {
         room_id: currentRoomId,
         player_name: currentPlayerName,
-        character: characterSheet
+        base_version: characterVersion,
+        changes: changes
     });
 
-    showLog('💾 Scheda salvata!', 'success');
+    // Aggiornamento ottimistico: un conflitto ricarica la scheda dal server
+    Object.assign(savedCharacterSheet, JSON.parse(JSON.stringify(changes)));
+    characterVersion++;
+    return true;
 }
 
 function loadMyCharacter(character) {
@@ -1383,6 +1455,8 @@ function loadMyCharacter(character) {
     document.getElementById('resources').value = character.resources || '';
 
     characterSheet = character;
+    savedCharacterSheet = JSON.parse(JSON.stringify(character));
+    characterVersion = character.version || 0;
     
     updateTraitsSummary();
 }
@@ -1428,6 +1502,7 @@ function requestCharactersOnJoin() {
 
 let isMaster = false;
 let allCharactersData = [];
+let visibleCharacters = {}; // Schede visibili degli altri giocatori, per nome giocatore
 
 // Elementi DOM
 const masterControls = document.getElementById('masterControls');
@@ -1527,6 +1602,11 @@ socket.on('characters_loaded', (data) => {
     const characters = data.characters;
     const otherCharacters = Object.values(characters).filter(char => char.player_name !== currentPlayerName);
 
+    visibleCharacters = {};
+    otherCharacters.forEach(char => {
+        visibleCharacters[char.player_name] = char;
+    });
+
     displayOtherCharacters(otherCharacters);
 
     // Se sono il master, carica anche i controlli
@@ -1739,12 +1819,8 @@ saveNotesBtn.addEventListener('click', () => {
     // Aggiungi gli appunti alla scheda corrente
     characterSheet.notes = notesHTML;
 
-    // Salva tutta la scheda con gli appunti aggiornati
-    socket.emit('save_character', {
-        room_id: currentRoomId,
-        player_name: currentPlayerName,
-        character: characterSheet
-    });
+    // Salva solo gli appunti (e gli altri campi eventualmente cambiati)
+    sendCharacterChanges();
 
     showLog('📝 Appunti salvati!', 'success');
 });
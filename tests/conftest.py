@@ -0,0 +1,91 @@
+"""
+Fixture comuni: app su un database SQLite temporaneo, client Socket.IO e
+utenti registrati.
+
+L'ambiente va impostato prima di importare app.py: i moduli leggono la
+configurazione all'import. I task in background (flush periodico,
+archiviazione, pulizia sessioni) sono disattivati o rallentati, così i test
+decidono quando salvare.
+"""
+import os
+import sys
+import tempfile
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_db_dir = tempfile.mkdtemp(prefix='nte-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}?check_same_thread=False"
+os.environ.setdefault('BAG_FLUSH_INTERVAL', '3600')
+os.environ.setdefault('HISTORY_ARCHIVE_INTERVAL', '0')
+os.environ.setdefault('SESSION_SWEEP_INTERVAL', '0')
+os.environ.setdefault('STATE_COALESCE_WINDOW', '0')
+os.environ.setdefault('MIGRATIONS_CHECK', '0')
+
+import pytest  # noqa: E402
+
+from app import app as flask_app, socketio, active_rooms_cache  # noqa: E402
+import migrations  # noqa: E402
+from models import db  # noqa: E402
+
+migrations.upgrade(flask_app)
+
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def socket_client(app):
+    clients = []
+
+    def connect():
+        client = socketio.test_client(app)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        if client.is_connected():
+            client.disconnect()
+
+
+def received(client, name):
+    """Payload degli eventi `name` ricevuti dal client"""
+    return [message['args'][0] for message in client.get_received() if message['name'] == name]
+
+
+@pytest.fixture
+def login(socket_client):
+    """Registra e fa il login di un nuovo utente; restituisce (client, login_success)"""
+    def login_new_user(prefix='utente'):
+        client = socket_client()
+        username = f'{prefix}-{uuid.uuid4().hex[:8]}'
+        client.emit('register', {'username': username, 'password': 'password'})
+        client.emit('login', {'username': username, 'password': 'password'})
+        (session,) = received(client, 'login_success')
+        return client, session
+
+    return login_new_user
+
+
+@pytest.fixture
+def room(login):
+    """Stanza con un sacchetto configurato; restituisce (client, session, room_id)"""
+    def create_room(successi=5, complicazioni=5):
+        client, session = login('master')
+        client.emit('create_room', {'user_id': session['user_id'], 'player_name': 'Master'})
+        (created,) = received(client, 'room_created')
+        room_id = created['room_id']
+        client.emit('configure_bag', {
+            'room_id': room_id, 'successi': successi, 'complicazioni': complicazioni
+        })
+        client.get_received()
+        return client, session, room_id
+
+    yield create_room
+    active_rooms_cache.flush()
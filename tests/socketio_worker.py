@@ -0,0 +1,23 @@
+"""
+Worker dell'app in un processo separato, per i test con più worker.
+
+Uso: python tests/socketio_worker.py <porta>
+
+Come un worker gunicorn con eventlet: monkey patching, migrazioni (serializzate
+dal lock delle migrazioni) e server Socket.IO su 127.0.0.1. L'ambiente
+(DATABASE_URL, SOCKETIO_MESSAGE_QUEUE, ROOM_STATE_BACKEND) viene dal test.
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import os  # noqa: E402
+import sys  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, socketio  # noqa: E402
+import migrations  # noqa: E402
+
+if __name__ == '__main__':
+    migrations.upgrade(app)
+    socketio.run(app, host='127.0.0.1', port=int(sys.argv[1]), log_output=False)
@@ -0,0 +1,102 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import auth
+import session_tokens
+from auth import SessionCache, verify_session, logout_user
+from models import db, Session
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Orologio monotono della cache spostabile a mano"""
+    class Clock:
+        now = 1000.0
+
+    monkeypatch.setattr(auth.time, 'monotonic', lambda: Clock.now)
+    return Clock
+
+
+def test_cache_hit_and_miss(clock):
+    cache = SessionCache(ttl=60)
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    assert cache.get('s') is None
+
+    cache.put('s', 1, 'anna', expires_at)
+
+    assert cache.get('s') == (1, 'anna', expires_at)
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_cache_entries_expire(clock):
+    cache = SessionCache(ttl=60)
+    cache.put('s', 1, 'anna', datetime.utcnow() + timedelta(days=1))
+
+    clock.now += 61
+
+    assert cache.get('s') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_cache_never_outlives_the_session():
+    cache = SessionCache(ttl=60)
+    cache.put('scaduta', 1, 'anna', datetime.utcnow() - timedelta(seconds=1))
+    assert cache.get('scaduta') is None
+
+
+def test_cache_is_bounded():
+    cache = SessionCache(max_size=2, ttl=60)
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    for session_id in ('a', 'b', 'c'):
+        cache.put(session_id, 1, 'anna', expires_at)
+
+    assert cache.get('a') is None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_logout_invalidates_the_cache_right_away(app, login):
+    _, session = login()
+    session_id = session['session_id']
+    assert verify_session(session_id)[0] is not None  # ora in cache
+
+    assert logout_user(session_id)
+
+    user, error = verify_session(session_id)
+    assert user is None and error
+
+
+@pytest.fixture
+def shared_denylist(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    monkeypatch.setattr(session_tokens.redis, 'Redis', fakeredis.FakeRedis)
+    url = f'redis://fake-{uuid.uuid4().hex[:8]}:6379/0'
+    monkeypatch.setattr(session_tokens, 'denylist', session_tokens.RedisDenylist(url))
+    return url
+
+
+def test_logout_on_another_worker_reaches_this_cache(app, login, shared_denylist):
+    _, session = login()
+    session_id = session['session_id']
+    assert verify_session(session_id)[0] is not None  # ora in cache
+
+    # Logout su un altro worker: riga eliminata e sessione nella denylist condivisa
+    Session.query.filter_by(session_id=session_id).delete()
+    db.session.commit()
+    other_worker = session_tokens.RedisDenylist(shared_denylist)
+    other_worker.revoke_session(session_id, time.time() + auth.session_cache.ttl)
+
+    user, error = verify_session(session_id)
+    assert user is None
+    assert error == 'Sessione non trovata'
+
+
+def test_logout_publishes_to_the_shared_denylist(app, login, shared_denylist):
+    _, session = login()
+    session_id = session['session_id']
+
+    assert logout_user(session_id)
+
+    assert session_tokens.RedisDenylist(shared_denylist).is_session_revoked(session_id)
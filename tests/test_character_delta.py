@@ -0,0 +1,92 @@
+import pytest
+
+from conftest import received
+from models import db, Character, Room, RoomPlayer
+
+
+@pytest.fixture
+def table(room, login):
+    """Stanza con il master e una giocatrice; restituisce (master, giocatrice, room_id)"""
+    master, _, room_id = room()
+    player, session = login('giocatrice')
+    player.emit('join_room', {'room_id': room_id, 'player_name': 'Anna', 'user_id': session['user_id']})
+    player.get_received()
+    master.get_received()
+    return master, player, room_id
+
+
+def save_delta(client, room_id, base_version, **changes):
+    client.emit('save_character_delta', {
+        'room_id': room_id, 'player_name': 'Anna', 'base_version': base_version, 'changes': changes
+    })
+
+
+def stored_character(room_id):
+    db.session.expire_all()
+    room = Room.query.filter_by(room_id=room_id).one()
+    player = RoomPlayer.query.filter_by(room_id=room.id, player_name='Anna').one()
+    return Character.query.filter_by(room_id=room.id, user_id=player.user_id).one()
+
+
+def test_delta_with_the_current_version_is_applied(table):
+    master, player, room_id = table
+    save_delta(player, room_id, 0, name='Lia', notes='<p>prima</p>')
+    player.get_received()
+
+    save_delta(player, room_id, 1, notes='<p>dopo</p>')
+
+    (updated,) = received(player, 'character_updated')
+    assert updated['version'] == 2
+    character = stored_character(room_id)
+    assert (character.version, character.name, character.notes) == (2, 'Lia', '<p>dopo</p>')
+
+
+def test_stale_delta_returns_the_server_copy(table):
+    master, player, room_id = table
+    save_delta(player, room_id, 0, notes='<p>originale</p>')
+    save_delta(player, room_id, 1, notes='<p>dal portatile</p>')
+    player.get_received()
+    master.get_received()
+
+    # Modifica fatta partendo dalla versione 1, ma il server è già alla 2
+    save_delta(player, room_id, 1, notes='<p>dal telefono</p>')
+
+    messages = player.get_received()
+    assert [m['name'] for m in messages] == ['character_conflict']
+    conflict = messages[0]['args'][0]
+    assert conflict['player_name'] == 'Anna'
+    assert conflict['character']['version'] == 2
+    assert conflict['character']['notes'] == '<p>dal portatile</p>'
+    # Nessuna scrittura e nessuna notifica alla stanza
+    assert stored_character(room_id).notes == '<p>dal portatile</p>'
+    assert received(master, 'character_updated') == []
+
+
+def test_first_delta_needs_version_zero(table):
+    _, player, room_id = table
+
+    save_delta(player, room_id, 3, name='Lia')
+
+    (conflict,) = received(player, 'character_conflict')
+    assert conflict['character'] is None
+
+
+def test_delta_broadcast_carries_only_the_changes(table):
+    master, player, room_id = table
+    save_delta(player, room_id, 0, name='Lia', traits=[{'id': 'q1', 'name': 'Coraggiosa'}])
+
+    (updated,) = received(master, 'character_updated')
+    assert updated == {
+        'player_name': 'Anna',
+        'version': 1,
+        'changes': {'name': 'Lia', 'traits': [{'id': 'q1', 'name': 'Coraggiosa'}]}
+    }
+
+
+def test_delta_rejects_unknown_fields(table):
+    _, player, room_id = table
+
+    save_delta(player, room_id, 0, version=99)
+
+    (error,) = received(player, 'error')
+    assert 'version' in error['message']
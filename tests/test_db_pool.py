@@ -0,0 +1,55 @@
+import eventlet
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from app import app as flask_app
+from db_pool import MeteredQueuePool, pool_metrics, postgres_engine_options
+from models import db
+
+
+@pytest.fixture
+def pooled_app(monkeypatch):
+    """App sullo stesso database con il pool di produzione (MeteredQueuePool)"""
+    monkeypatch.setattr(pool_metrics, 'pool', pool_metrics.pool)
+    monkeypatch.setenv('DB_POOL_SIZE', '2')
+    monkeypatch.setenv('DB_MAX_OVERFLOW', '8')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = flask_app.config['SQLALCHEMY_DATABASE_URI']
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = postgres_engine_options()
+    db.init_app(app)
+    with app.app_context():
+        assert isinstance(db.engine.pool, MeteredQueuePool)
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+def test_concurrent_greenlets_do_not_share_a_connection(pooled_app):
+    greenlets = 6
+    seen = {}
+
+    def handle_event(index):
+        # Come un handler Socket.IO: un contesto applicativo per evento
+        with pooled_app.app_context():
+            db.session.execute(text('SELECT 1'))
+            before = id(db.session.connection().connection.dbapi_connection)
+            # Cede il controllo mentre tiene la connessione
+            eventlet.sleep(0.01)
+            db.session.execute(text('SELECT 1'))
+            after = id(db.session.connection().connection.dbapi_connection)
+            db.session.remove()
+        seen[index] = (before, after)
+
+    pool = eventlet.GreenPool(greenlets)
+    for index in range(greenlets):
+        pool.spawn(handle_event, index)
+    pool.waitall()
+
+    assert len(seen) == greenlets
+    # Ogni greenlet tiene la propria connessione per tutto l'evento...
+    assert all(before == after for before, after in seen.values())
+    # ...e nessuna è condivisa tra greenlet attivi nello stesso momento
+    assert len({before for before, _ in seen.values()}) == greenlets
+    # Tutte restituite al pool alla fine dell'evento
+    assert pool_metrics.stats()['checked_out'] == 0
@@ -0,0 +1,117 @@
+import random
+from collections import Counter
+
+import pytest
+
+import draw_engine
+from conftest import received
+
+
+@pytest.mark.parametrize('num_tokens', [-1, 0, draw_engine.MAX_TOKENS + 1, None, 'tre', True])
+def test_draw_rejects_invalid_num_tokens(num_tokens):
+    with pytest.raises(draw_engine.InvalidDraw):
+        draw_engine.draw(3, 3, num_tokens)
+    with pytest.raises(draw_engine.InvalidDraw):
+        draw_engine.odds(3, 3, num_tokens)
+
+
+def test_draw_not_enough_tokens():
+    with pytest.raises(draw_engine.NotEnoughTokens):
+        draw_engine.draw(1, 1, 3)
+
+
+def test_draw_keeps_bag_consistent():
+    rng = random.Random(7)
+    for _ in range(500):
+        outcome = draw_engine.draw(4, 3, 3, confusion=rng.random() < 0.5, rng=rng)
+        assert len(outcome.drawn) == 3
+        assert outcome.drawn.count('successo') == outcome.successi
+        assert outcome.successi + outcome.complicazioni == 3
+        assert outcome.bag_successi + outcome.bag_complicazioni == 4
+        assert outcome.bag_successi >= 0 and outcome.bag_complicazioni >= 0
+
+
+@pytest.mark.parametrize('bag,num_tokens,flags', [
+    ((6, 4), 3, {}),
+    ((2, 9), 4, {}),
+    ((5, 5), 2, {'adrenaline': True}),
+    ((7, 3), 3, {'confusion': True}),
+    ((4, 4), 5, {'risk_all': True, 'confusion': True}),
+])
+def test_draw_matches_odds(bag, num_tokens, flags):
+    samples = 20000
+    rng = random.Random(42)
+    effective, probabilities = draw_engine.odds(*bag, num_tokens, **flags)
+    counts = Counter(draw_engine.draw(*bag, num_tokens, rng=rng, **flags).successi for _ in range(samples))
+
+    assert set(counts) <= set(range(effective + 1))
+    for successi, probability in enumerate(probabilities):
+        # Entro 5 deviazioni standard della frequenza attesa
+        tolerance = 5 * (probability * (1 - probability) / samples) ** 0.5 + 1e-9
+        assert abs(counts[successi] / samples - probability) <= tolerance
+
+
+def test_draw_tokens_rejects_negative_num_tokens(app, room):
+    client, _, room_id = room(successi=3, complicazioni=3)
+
+    client.emit('draw_tokens', {'room_id': room_id, 'num_tokens': -1, 'player_name': 'Anna'})
+
+    (error,) = received(client, 'error')
+    assert 'token' in error['message']
+
+
+def test_odds_rejects_huge_bags():
+    with pytest.raises(draw_engine.InvalidDraw):
+        draw_engine.odds(draw_engine.ODDS_MAX_BAG, 1, 3)
+    assert draw_engine.odds(draw_engine.ODDS_MAX_BAG - 1, 1, 3)[0] == 3
+
+
+@pytest.mark.parametrize('payload', [
+    {'successi': 10 ** 9, 'complicazioni': 10 ** 9, 'num_tokens': 4},
+    {'successi': 10, 'complicazioni': 10, 'num_tokens': 10 ** 6},
+])
+def test_preview_odds_is_bounded(app, room, payload):
+    client, _, room_id = room()
+
+    client.emit('preview_odds', dict(payload, room_id=room_id))
+
+    messages = client.get_received()
+    assert [message['name'] for message in messages] == ['error']
+    assert 'token' in messages[0]['args'][0]['message']
+
+
+@pytest.mark.parametrize('num_tokens, adrenaline, accepted', [
+    (99, True, True),     # l'adrenalina forza 4 token prima del controllo
+    (0, True, True),
+    (99, False, False),
+    (0, False, False),
+    (3, False, True),
+])
+def test_preview_accepts_exactly_what_draw_accepts(app, room, num_tokens, adrenaline, accepted):
+    client, _, room_id = room(successi=10, complicazioni=10)
+    payload = {'room_id': room_id, 'num_tokens': num_tokens, 'adrenaline': adrenaline, 'player_name': 'Anna'}
+
+    client.emit('preview_odds', payload)
+    preview = client.get_received()
+    client.emit('draw_tokens', payload)
+    drawn = client.get_received()
+
+    assert (received_names(preview) == ['odds_preview']) is accepted
+    assert ('tokens_drawn' in received_names(drawn)) is accepted
+    if accepted:
+        expected = 4 if adrenaline else num_tokens
+        assert preview[0]['args'][0]['num_tokens'] == expected
+
+
+def received_names(messages):
+    return [message['name'] for message in messages]
+
+
+def test_preview_odds(app, room):
+    client, _, room_id = room(successi=3, complicazioni=1)
+
+    client.emit('preview_odds', {'room_id': room_id, 'num_tokens': 2})
+
+    (preview,) = received(client, 'odds_preview')
+    assert preview['num_tokens'] == 2
+    assert [row['probability'] for row in preview['distribution']] == pytest.approx([0, 0.5, 0.5])
@@ -0,0 +1,93 @@
+import uuid
+
+import pytest
+
+import draw_stats
+from instrumentation import query_budget
+from models import db, User, Room, DrawStats, DrawStatsBucket
+
+
+@pytest.fixture
+def room_pk(app):
+    user = User(username=f'statistiche-{uuid.uuid4().hex[:8]}', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    room = Room(room_id=uuid.uuid4().hex[:8], owner_id=user.id)
+    db.session.add(room)
+    db.session.commit()
+    return room.id
+
+
+def entry(player_name='Anna', successi=1, complicazioni=0):
+    return {'player_name': player_name, 'successi': successi, 'complicazioni': complicazioni}
+
+
+def test_record_draws_counts_and_histogram(room_pk):
+    draw_stats.record_draws(room_pk, [entry(), entry(successi=2, complicazioni=1), entry('Bruno', 0, 1)])
+    db.session.commit()
+    draw_stats.record_draws(room_pk, [entry()])
+    db.session.commit()
+
+    stats = draw_stats.get_room_stats(room_pk)
+    assert stats['room']['draws'] == 4
+    assert stats['room']['successi'] == 4
+    assert stats['room']['histogram']['successi'] == {'0': 1, '1': 2, '2': 1}
+    assert stats['players']['Anna']['draws'] == 3
+    assert stats['players']['Bruno']['complicazioni'] == 1
+
+
+def test_record_draws_keeps_concurrent_increments(room_pk):
+    draw_stats.record_draws(room_pk, [entry()])
+    db.session.commit()
+    # Righe già caricate nella sessione di questo worker
+    rows = DrawStats.query.filter_by(room_id=room_pk).all()
+    assert rows
+
+    # Un altro worker salva 5 estrazioni nel frattempo
+    other = DrawStats.__table__
+    buckets = DrawStatsBucket.__table__
+    with db.engine.begin() as conn:
+        conn.execute(other.update().where(other.c.room_id == room_pk).values(
+            draws=other.c.draws + 5, successi=other.c.successi + 5
+        ))
+        conn.execute(buckets.update().where(buckets.c.room_id == room_pk).values(
+            count=buckets.c.count + 5
+        ))
+
+    draw_stats.record_draws(room_pk, [entry()])
+    db.session.commit()
+
+    stats = draw_stats.get_room_stats(room_pk)
+    assert stats['room']['draws'] == 7
+    assert stats['room']['successi'] == 7
+    assert stats['room']['histogram']['successi'] == {'1': 7}
+
+
+def test_flush_cost_does_not_grow_with_players(room_pk):
+    draw_stats.record_draws(room_pk, [entry()])
+    db.session.commit()
+
+    # Controllo delle righe totali, un upsert dei contatori e uno dei bucket
+    with query_budget(3):
+        draw_stats.record_draws(room_pk, [entry(f'Giocatore {i}', i % 3, 1) for i in range(12)])
+    db.session.commit()
+
+    assert draw_stats.get_room_stats(room_pk)['room']['draws'] == 13
+
+
+def test_migration_moves_json_histograms(room_pk):
+    import migrations
+
+    stats = DrawStats.__table__
+    with db.engine.begin() as conn:
+        conn.execute(stats.insert().values(
+            room_id=room_pk, player_name='', draws=3, tokens=4, successi=3, complicazioni=1,
+            histogram={'successi': {'1': 2, '2': 1}, 'complicazioni': {'0': 2, '1': 1}}
+        ))
+        migrations.move_draw_stats_histograms(conn)
+        # Una seconda esecuzione non trova più nulla da spostare
+        migrations.move_draw_stats_histograms(conn)
+
+    room = draw_stats.get_room_stats(room_pk)['room']
+    assert room['histogram'] == {'successi': {'1': 2, '2': 1}, 'complicazioni': {'0': 2, '1': 1}}
+    assert db.session.get(DrawStats, (room_pk, '')).histogram is None
@@ -0,0 +1,76 @@
+import base64
+from datetime import datetime
+
+import pytest
+
+from conftest import received
+from models import db, DrawHistory, Room
+
+
+@pytest.fixture
+def same_second_history(room):
+    """Stanza con 7 estrazioni tutte con lo stesso timestamp; restituisce (client, room_id)"""
+    client, _, room_id = room()
+    room_pk = Room.query.filter_by(room_id=room_id).one().id
+    timestamp = datetime(2026, 1, 1, 21, 0, 0)
+    db.session.add_all([
+        DrawHistory(room_id=room_pk, player_name=f'G{i}', drawn_tokens=['successo'],
+                    successi=1, complicazioni=0, timestamp=timestamp)
+        for i in range(7)
+    ])
+    db.session.commit()
+    return client, room_id
+
+
+def get_page(client, room_id, cursor=None, limit=3):
+    client.emit('get_history', {'room_id': room_id, 'cursor': cursor, 'limit': limit})
+    (page,) = received(client, 'history_page')
+    return page
+
+
+def test_pages_are_continuous_with_equal_timestamps(same_second_history):
+    client, room_id = same_second_history
+
+    players, cursor, pages = [], None, 0
+    while True:
+        page = get_page(client, room_id, cursor)
+        players += [entry['player'] for entry in page['entries']]
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+    # Stesso timestamp: l'id decide l'ordine, nessuna voce saltata o ripetuta
+    assert players == [f'G{i}' for i in range(6, -1, -1)]
+    assert pages == 3
+
+
+def test_last_page_has_no_cursor(same_second_history):
+    client, room_id = same_second_history
+
+    page = get_page(client, room_id, limit=7)
+    assert len(page['entries']) == 7
+    assert page['next_cursor'] is None
+
+    # Con una voce in meno del totale c'è ancora una pagina
+    page = get_page(client, room_id, limit=6)
+    assert page['next_cursor'] is not None
+    last = get_page(client, room_id, page['next_cursor'], limit=6)
+    assert [entry['player'] for entry in last['entries']] == ['G0']
+    assert last['next_cursor'] is None
+
+
+@pytest.mark.parametrize('cursor', [
+    'non-un-cursore',
+    base64.urlsafe_b64encode(b'2026-01-01T21:00:00').decode('ascii'),
+    base64.urlsafe_b64encode(b'ieri|3').decode('ascii'),
+    base64.urlsafe_b64encode(b'2026-01-01T21:00:00|tre').decode('ascii'),
+])
+def test_invalid_cursor_is_an_error(same_second_history, cursor):
+    client, room_id = same_second_history
+
+    client.emit('get_history', {'room_id': room_id, 'cursor': cursor})
+
+    messages = client.get_received()
+    assert [m['name'] for m in messages] == ['error']
+    assert messages[0]['args'][0]['message'] == 'Cursore non valido'
@@ -0,0 +1,73 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import history_archive
+from room_snapshot import HISTORY_LIMIT
+from models import db, User, Room, DrawHistory, HistoryArchiveSegment, HistoryArchiveSummary
+
+
+@pytest.fixture
+def old_history(app, monkeypatch):
+    """Stanza con HISTORY_LIMIT + 25 estrazioni più vecchie del periodo di conservazione"""
+    monkeypatch.setattr(history_archive, 'SEGMENT_SIZE', 10)
+    user = User(username=f'archivio-{uuid.uuid4().hex[:8]}', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    room = Room(room_id=uuid.uuid4().hex[:8], owner_id=user.id)
+    db.session.add(room)
+    db.session.flush()
+    start = datetime.utcnow() - timedelta(days=history_archive.RETENTION_DAYS + 10)
+    db.session.add_all([
+        DrawHistory(room_id=room.id, player_name='Anna', drawn_tokens=['successo'],
+                    successi=1, complicazioni=0, timestamp=start + timedelta(minutes=i))
+        for i in range(HISTORY_LIMIT + 25)
+    ])
+    db.session.commit()
+    return room.id
+
+
+def segments_of(room_pk):
+    return HistoryArchiveSegment.query.filter_by(room_id=room_pk).all()
+
+
+def test_archive_room_moves_old_history(old_history):
+    assert history_archive.archive_room(old_history) == 25
+    # Un secondo passaggio non trova più nulla da archiviare
+    assert history_archive.archive_room(old_history) == 0
+
+    assert [segment.row_count for segment in segments_of(old_history)] == [10, 10, 5]
+    # Le ultime HISTORY_LIMIT, mostrate al join, restano nella tabella anche se vecchie
+    hot = DrawHistory.query.filter_by(room_id=old_history) \
+        .order_by(DrawHistory.timestamp, DrawHistory.id).all()
+    assert len(hot) == HISTORY_LIMIT
+    archived = list(history_archive.iter_archived_history(old_history))
+    assert max(entry['id'] for entry in archived) < hot[0].id
+    assert db.session.get(HistoryArchiveSummary, old_history).draws == 25
+    assert len(archived) == 25
+
+
+def test_archive_room_backs_off_when_rows_were_archived_elsewhere(old_history, monkeypatch):
+    encode = history_archive._encode_segment
+
+    def concurrent_encode(rows):
+        # Un altro worker elimina (archivia) una delle righe mentre questo scrive il segmento
+        with db.engine.begin() as conn:
+            conn.execute(DrawHistory.__table__.delete().where(DrawHistory.__table__.c.id == rows[0].id))
+        return encode(rows)
+
+    monkeypatch.setattr(history_archive, '_encode_segment', concurrent_encode)
+
+    assert history_archive.archive_room(old_history) == 0
+    db.session.expire_all()
+    assert segments_of(old_history) == []
+    assert db.session.get(HistoryArchiveSummary, old_history) is None
+    assert DrawHistory.query.filter_by(room_id=old_history).count() == HISTORY_LIMIT + 24
+
+
+def test_archive_all_leaves_idle_rooms_with_only_the_join_history(old_history):
+    history_archive.archive_all()
+
+    assert history_archive.archive_all() == 0
+    assert DrawHistory.query.filter_by(room_id=old_history).count() == HISTORY_LIMIT
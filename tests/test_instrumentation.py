@@ -0,0 +1,87 @@
+import pytest
+from sqlalchemy import text
+
+import instrumentation
+from instrumentation import QueryBudgetExceeded, normalize, profiler, query_budget
+from conftest import received
+from models import db
+
+
+@pytest.fixture
+def sql_profiler():
+    """Profilo attivo per il test, poi lo stato di prima"""
+    enabled, log, budgets = profiler.enabled, profiler.log, dict(profiler.budgets)
+    profiler.reset()
+    profiler.enable()
+    yield profiler
+    profiler.enabled, profiler.log, profiler.budgets = enabled, log, budgets
+    profiler.reset()
+
+
+def test_normalize_strips_literals():
+    assert normalize("SELECT * FROM rooms WHERE room_id = 'abc' AND id = 42") == \
+        normalize("SELECT * FROM rooms  WHERE room_id = 'x''y' AND id = 7")
+    assert normalize("SELECT 1 WHERE id IN (?, ?, ?)") == 'SELECT ? WHERE id IN (?)'
+
+
+def test_query_budget_raises_over_budget(app):
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget(1):
+            db.session.execute(text('SELECT 1'))
+            db.session.execute(text('SELECT 2'))
+
+
+def test_query_budget_counts_statements_of_handlers(app, room):
+    client, _, room_id = room()
+
+    with query_budget(100) as block:
+        client.emit('get_history', {'room_id': room_id})
+
+    assert received(client, 'history_page')
+    assert block.sql_statements > 0
+
+
+def test_repeated_shape_is_flagged(app):
+    with query_budget(10) as block:
+        for room_id in range(instrumentation.REPEAT_THRESHOLD):
+            db.session.execute(text(f'SELECT * FROM rooms WHERE id = {room_id}'))
+
+    ((shape, count),) = block.repeated()
+    assert shape == 'SELECT * FROM rooms WHERE id = ?'
+    assert count == instrumentation.REPEAT_THRESHOLD
+
+
+def test_event_over_budget_is_recorded(app, room, sql_profiler):
+    client, _, room_id = room()
+    sql_profiler.set_budget('get_history', 0)
+
+    client.emit('get_history', {'room_id': room_id})
+
+    assert sql_profiler.profiles()['get_history'].calls == 1
+    assert [v.split(':')[0] for v in sql_profiler.violations] == ['get_history']
+    with pytest.raises(QueryBudgetExceeded):
+        sql_profiler.assert_budgets()
+    assert sql_profiler.stats()['budget_violations'] == 1
+
+
+def test_violations_are_counted_not_stored(app, room, sql_profiler):
+    client, _, room_id = room()
+    sql_profiler.set_budget('get_history', 0)
+
+    for _ in range(5):
+        client.emit('get_history', {'room_id': room_id})
+
+    # Una riga per evento, qualunque sia il numero di chiamate oltre il budget
+    (violation,) = sql_profiler.violations
+    assert violation.startswith('get_history: 5 chiamate oltre il budget 0')
+    assert sql_profiler.stats()['budget_violations'] == 5
+
+
+def test_event_within_budget_passes(app, room, sql_profiler):
+    client, _, room_id = room()
+    sql_profiler.set_budget('preview_odds', 50)
+
+    client.emit('preview_odds', {'room_id': room_id, 'num_tokens': 2})
+
+    assert sql_profiler.profiles()['preview_odds'].calls == 1
+    sql_profiler.assert_budgets()
@@ -0,0 +1,110 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import sqlalchemy as sa
+from flask import Flask
+
+import migrations
+from conftest import ROOT
+from models import db
+
+
+@pytest.fixture
+def empty_app(tmp_path):
+    """App Flask minima su un database SQLite vuoto"""
+    app = Flask('migrations-test')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'vuoto.db'}"
+    db.init_app(app)
+    return app
+
+
+def recorded(app):
+    with app.app_context():
+        with db.engine.connect() as conn:
+            return conn.execute(
+                sa.select(migrations.schema_migrations.c.version, migrations.schema_migrations.c.name)
+                .order_by(migrations.schema_migrations.c.version)
+            ).all()
+
+
+def test_upgrade_applies_every_migration_once(empty_app):
+    versions = [version for version, _ in migrations.MIGRATIONS]
+
+    assert migrations.upgrade(empty_app) == versions
+    assert recorded(empty_app) == [(version, fn.__name__) for version, fn in migrations.MIGRATIONS]
+
+    # Seconda esecuzione: nulla da fare
+    assert migrations.upgrade(empty_app) == []
+    assert migrations.pending(empty_app) == []
+    assert len(recorded(empty_app)) == len(versions)
+
+
+def test_pending_migrations_run_in_order(empty_app, monkeypatch):
+    migrations.upgrade(empty_app)
+    calls = []
+
+    def add_a(conn):
+        calls.append('a')
+
+    def add_b(conn):
+        calls.append('b')
+
+    latest = migrations.LATEST_VERSION
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + [(latest + 1, add_a), (latest + 2, add_b)])
+
+    assert migrations.pending(empty_app) == [latest + 1, latest + 2]
+    assert migrations.upgrade(empty_app) == [latest + 1, latest + 2]
+    assert calls == ['a', 'b']
+    assert recorded(empty_app)[-2:] == [(latest + 1, 'add_a'), (latest + 2, 'add_b')]
+
+
+def test_failed_migration_is_not_recorded(empty_app, monkeypatch):
+    migrations.upgrade(empty_app)
+    latest = migrations.LATEST_VERSION
+
+    def add_table(conn):
+        conn.execute(sa.text('CREATE TABLE provvisoria (id INTEGER PRIMARY KEY)'))
+
+    def broken(conn):
+        raise RuntimeError('migrazione rotta')
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + [(latest + 1, add_table), (latest + 2, broken)])
+
+    with pytest.raises(RuntimeError):
+        migrations.upgrade(empty_app)
+
+    # La migrazione precedente resta applicata, quella fallita no
+    assert migrations.pending(empty_app) == [latest + 2]
+
+
+def test_importing_the_app_has_no_side_effects(tmp_path):
+    # Database senza schema: il controllo all'import lo segnalerebbe
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'nuovo.db'}")
+    env.pop('MIGRATIONS_CHECK', None)
+    env.pop('HISTORY_ARCHIVE_INTERVAL', None)
+    env.pop('SESSION_SWEEP_INTERVAL', None)
+    script = (
+        "import flask_socketio\n"
+        "started = []\n"
+        "flask_socketio.SocketIO.start_background_task = lambda self, target, *a, **k: started.append(target)\n"
+        "import app\n"
+        "print('servizi', app._services_started, len(started))\n"
+    )
+
+    result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env,
+                            capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    assert 'servizi False 0' in result.stdout
+    assert 'Schema del database non aggiornato' not in result.stdout
+    assert not os.path.exists(tmp_path / 'nuovo.db') or os.path.getsize(tmp_path / 'nuovo.db') == 0
+
+
+def test_first_connection_starts_the_services(socket_client):
+    import app as app_module
+
+    socket_client()
+
+    assert app_module._services_started
@@ -0,0 +1,145 @@
+"""Due worker in processi separati, collegati da un Redis finto (coda messaggi e stato)"""
+import os
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import pytest
+
+import state_backend
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+redis = pytest.importorskip('redis')
+socketio_client = pytest.importorskip('socketio')
+pytest.importorskip('requests')
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socketio_worker.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Il worker sulla porta {port} è terminato')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'Il worker sulla porta {port} non risponde')
+
+
+class Player:
+    """Client Socket.IO reale che registra gli eventi ricevuti"""
+
+    def __init__(self, port):
+        self.events = queue.Queue()
+        self.client = socketio_client.Client()
+        self.client.on('*', lambda event, *args: self.events.put((event, args[0] if args else None)))
+        self.client.connect(f'http://127.0.0.1:{port}', wait_timeout=10)
+
+    def emit(self, event, data):
+        self.client.emit(event, data)
+
+    def wait_for(self, name, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            event, data = self.events.get(timeout=max(0.01, deadline - time.monotonic()))
+            assert event != 'error', data
+            if event == name:
+                return data
+
+
+@pytest.fixture
+def redis_server():
+    port = free_port()
+    server = fakeredis.TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # Il server TCP di fakeredis chiude la connessione su NOSCRIPT invece di
+    # lasciare che il client ricarichi lo script: lo carichiamo prima
+    redis.Redis(host='127.0.0.1', port=port).script_load(state_backend._CAS_BAG_SCRIPT)
+    yield f'redis://127.0.0.1:{port}/0'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def workers(redis_server):
+    """Porte di due worker che condividono database, stato e coda messaggi"""
+    workdir = tempfile.mkdtemp(prefix='nte-workers-')
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'workers.db')}?check_same_thread=False",
+        'SOCKETIO_MESSAGE_QUEUE': redis_server,
+        'ROOM_STATE_BACKEND': redis_server,
+        'MIGRATIONS_CHECK': '0',
+    })
+
+    processes, logs, ports = [], [], []
+    try:
+        for index in range(2):
+            port = free_port()
+            log = open(os.path.join(workdir, f'worker{index}.log'), 'w+')
+            processes.append(subprocess.Popen([sys.executable, WORKER, str(port)], env=env,
+                                              stdout=log, stderr=subprocess.STDOUT))
+            logs.append(log)
+            ports.append(port)
+        for port, process in zip(ports, processes):
+            wait_for_port(port, process)
+        yield ports
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for log in logs:
+            log.close()
+
+
+def test_broadcast_reaches_clients_on_another_worker(workers):
+    port_a, port_b = workers
+    master, player = Player(port_a), Player(port_b)
+    try:
+        username = f'master-{uuid.uuid4().hex[:8]}'
+        master.emit('register', {'username': username, 'password': 'password'})
+        master.wait_for('register_success')
+        master.emit('login', {'username': username, 'password': 'password'})
+        user_id = master.wait_for('login_success')['user_id']
+        master.emit('create_room', {'user_id': user_id, 'player_name': 'Master'})
+        room_id = master.wait_for('room_created')['room_id']
+        master.emit('configure_bag', {'room_id': room_id, 'successi': 5, 'complicazioni': 0})
+        master.wait_for('bag_configured')
+
+        # Il giocatore è collegato all'altro worker
+        player.emit('join_room', {'room_id': room_id, 'player_name': 'Anna'})
+        joined = player.wait_for('room_joined')
+        assert joined['room_data']['bag'] == {'successi': 5, 'complicazioni': 0}
+        master.wait_for('player_joined')
+
+        player.emit('draw_tokens', {'room_id': room_id, 'num_tokens': 2, 'player_name': 'Anna'})
+
+        # Il broadcast arriva al master attraverso la coda messaggi...
+        drawn = master.wait_for('tokens_drawn')
+        assert drawn['player'] == 'Anna'
+        # ...e il sacchetto è quello condiviso, configurato dal primo worker
+        assert drawn['bag_remaining'] == {'successi': 3, 'complicazioni': 0}
+        assert player.wait_for('tokens_drawn') == drawn
+    finally:
+        master.client.disconnect()
+        player.client.disconnect()
@@ -0,0 +1,110 @@
+import base64
+import io
+import uuid
+
+import pytest
+
+import photo_store
+from models import db, Photo, User, Room, Character
+
+PIL = pytest.importorskip('PIL.Image')
+
+
+def png_bytes(color=(200, 30, 30)):
+    out = io.BytesIO()
+    PIL.new('RGB', (8, 8), color).save(out, format='PNG')
+    return out.getvalue()
+
+
+def upload(app, data, session_id=None, headers=None):
+    form = {'photo': (io.BytesIO(data), 'foto.png', 'image/png')}
+    if session_id:
+        form['session_id'] = session_id
+    return app.test_client().post('/photos', data=form, headers=headers or {},
+                                  content_type='multipart/form-data')
+
+
+def test_upload_requires_a_session(app):
+    assert upload(app, png_bytes()).status_code == 401
+    assert upload(app, png_bytes(), session_id='sessione-inventata').status_code == 401
+
+
+def test_upload_with_session(app, login):
+    _, session = login()
+
+    response = upload(app, png_bytes(), session_id=session['session_id'])
+    assert response.status_code == 200
+    photo_hash = response.get_json()['id']
+    assert db.session.get(Photo, photo_hash) is not None
+
+    # Anche con l'header al posto del campo del form
+    response = upload(app, png_bytes(), headers={'X-Session-Id': session['session_id']})
+    assert response.get_json()['id'] == photo_hash
+
+
+def test_concurrent_upload_of_the_same_photo(app, login, monkeypatch):
+    _, session = login()
+    data = png_bytes((10, 120, 240))
+    photo_hash = upload(app, data, session_id=session['session_id']).get_json()['id']
+
+    # Un'altra richiesta ha salvato la foto dopo il controllo di esistenza
+    get = db.session.get
+    checks = []
+
+    def racing_get(model, key, *args, **kwargs):
+        if model is Photo and not checks:
+            checks.append(key)
+            return None
+        return get(model, key, *args, **kwargs)
+
+    monkeypatch.setattr(db.session, 'get', racing_get)
+    response = upload(app, data, session_id=session['session_id'])
+
+    assert checks == [photo_hash]
+    assert response.status_code == 200
+    assert response.get_json()['id'] == photo_hash
+
+
+def data_url(data):
+    return 'data:image/png;base64,' + base64.b64encode(data).decode('ascii')
+
+
+def make_legacy_characters(photos):
+    """Schede con le foto ancora salvate come data URL; restituisce gli id"""
+    user = User(username=f'utente-{uuid.uuid4().hex[:8]}', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    room = Room(room_id=uuid.uuid4().hex[:8], owner_id=user.id)
+    db.session.add(room)
+    db.session.flush()
+    characters = [Character(room_id=room.id, user_id=user.id, player_name=f'Giocatore {i}', photo=photo)
+                  for i, photo in enumerate(photos)]
+    db.session.add_all(characters)
+    db.session.commit()
+    return [character.id for character in characters]
+
+
+def test_migrate_legacy_photos_on_the_connection(app):
+    legacy = data_url(png_bytes((1, 2, 3)))
+    ids = make_legacy_characters([legacy, legacy, 'data:image/png;base64,!!!'])
+
+    with db.engine.begin() as conn:
+        assert photo_store.migrate_legacy_photos(conn) == 3
+
+    db.session.expire_all()
+    first, second, broken = (db.session.get(Character, i).photo for i in ids)
+    assert first == second
+    assert db.session.get(Photo, first) is not None
+    assert broken == ''
+
+
+def test_migrate_legacy_photos_rolls_back_with_the_connection(app):
+    ids = make_legacy_characters([data_url(png_bytes((4, 5, 6)))])
+
+    with db.engine.connect() as conn:
+        transaction = conn.begin()
+        photo_store.migrate_legacy_photos(conn)
+        transaction.rollback()
+
+    db.session.expire_all()
+    assert db.session.get(Character, ids[0]).photo.startswith('data:')
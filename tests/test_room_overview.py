@@ -0,0 +1,50 @@
+import uuid
+
+import pytest
+
+from models import db, User, Room, RoomPlayer
+from room_overview import get_user_rooms
+from instrumentation import query_budget
+
+
+def make_user():
+    user = User(username=f'utente-{uuid.uuid4().hex[:8]}', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+
+def make_rooms(owner, count, guest=None):
+    for index in range(count):
+        room = Room(room_id=uuid.uuid4().hex[:8], owner_id=owner.id)
+        room.players.append(RoomPlayer(player_name=f'Master {index}', user_id=owner.id, is_master=True))
+        if guest is not None:
+            room.players.append(RoomPlayer(player_name=f'Ospite {index}', user_id=guest.id))
+        db.session.add(room)
+
+
+@pytest.mark.parametrize('rooms', [1, 5, 25])
+def test_get_user_rooms_uses_two_queries(app, rooms):
+    user, other = make_user(), make_user()
+    make_rooms(user, rooms, guest=other)
+    make_rooms(other, rooms, guest=user)
+    db.session.commit()
+    user_id = user.id
+    db.session.expire_all()
+
+    # Una query per le stanze e una per i loro giocatori, per qualsiasi numero di stanze
+    with query_budget(2) as trace:
+        owned, shared = get_user_rooms(user_id)
+
+    assert trace.sql_statements == 2
+    assert len(owned) == len(shared) == rooms
+    assert all(len(room['players']) == 2 for room in owned + shared)
+    assert {room['my_player_name'] for room in shared} == {f'Ospite {i}' for i in range(rooms)}
+
+
+def test_get_user_rooms_without_rooms_uses_one_query(app):
+    user_id = make_user().id
+    db.session.commit()
+
+    with query_budget(1):
+        assert get_user_rooms(user_id) == ([], [])
@@ -0,0 +1,90 @@
+from conftest import received
+
+import room_state
+from app import active_rooms_cache
+from models import db, Room, DrawHistory
+
+
+def history_of(room_id):
+    room = Room.query.filter_by(room_id=room_id).one()
+    db.session.expire_all()
+    return DrawHistory.query.filter_by(room_id=room.id).order_by(DrawHistory.id).all()
+
+
+def test_record_draw_coerces_player_name(app, room):
+    _, _, room_id = room()
+    state = active_rooms_cache.get(room_id)
+
+    state.record_draw(None, ['successo'], 1, 0)
+    state.record_draw('x' * 300, ['successo'], '1', 0)
+    active_rooms_cache.flush(room_id)
+
+    names = [entry.player_name for entry in history_of(room_id)]
+    assert names == ['Giocatore', 'x' * room_state.PLAYER_NAME_MAX]
+
+
+def test_null_player_name_from_client_is_saved(app, room):
+    client, _, room_id = room()
+
+    client.emit('draw_tokens', {'room_id': room_id, 'num_tokens': 2, 'player_name': None})
+    assert received(client, 'tokens_drawn')
+    active_rooms_cache.flush(room_id)
+
+    assert [entry.player_name for entry in history_of(room_id)] == ['Giocatore']
+
+
+def test_rejected_history_does_not_block_bag(app, room, monkeypatch):
+    monkeypatch.setattr(room_state, 'HISTORY_MAX_FLUSH_ATTEMPTS', 2)
+    _, _, room_id = room(successi=5, complicazioni=5)
+    state = active_rooms_cache.get(room_id)
+
+    state.record_draw('Anna', ['successo'], 1, 0)
+    # Voce che il database rifiuta (drawn_tokens non serializzabile in JSON)
+    with state.history_lock:
+        state.pending_history.append(dict(state.pending_history[0], drawn_tokens=[object()]))
+    state.set_bag(3, 2)
+
+    try:
+        active_rooms_cache.flush(room_id)
+    except Exception:
+        pass
+    # Il sacchetto è salvato anche se lo storico no
+    db.session.expire_all()
+    room = Room.query.filter_by(room_id=room_id).one()
+    assert (room.bag_successi, room.bag_complicazioni) == (3, 2)
+    assert history_of(room_id) == []
+    assert state.dirty
+
+    # Al secondo fallimento le voci vengono scritte una alla volta
+    active_rooms_cache.flush(room_id)
+    assert [entry.player_name for entry in history_of(room_id)] == ['Anna']
+    assert state.pending_history == []
+    assert not state.dirty
+
+
+def test_risk_all_is_saved_immediately(app, room):
+    client, _, room_id = room(successi=5, complicazioni=0)
+
+    client.emit('risk_all', {'room_id': room_id, 'num_tokens': 1, 'player_name': 'Anna'})
+    assert received(client, 'risk_all_result')
+
+    entries = history_of(room_id)
+    assert [(entry.player_name, entry.risk_all) for entry in entries] == [('Anna', True)]
+    assert Room.query.filter_by(room_id=room_id).one().bag_successi == 4
+
+
+def test_player_states_after_eviction(app, room, monkeypatch):
+    client, _, room_id = room()
+    # La stanza esce dalla memoria (inattiva e già salvata)
+    active_rooms_cache.flush(room_id)
+    monkeypatch.setattr(active_rooms_cache, 'idle_ttl', 0)
+    active_rooms_cache.evict_idle()
+    assert room_id not in active_rooms_cache
+
+    client.emit('update_adrenaline', {'room_id': room_id, 'player_name': 'Anna', 'adrenaline': 1})
+    client.emit('update_confusion', {'room_id': room_id, 'player_name': 'Anna', 'confusion': 1})
+
+    messages = client.get_received()
+    assert 'error' not in [message['name'] for message in messages]
+    assert active_rooms_cache.get(room_id).adrenaline == {'Anna': 1}
+    assert active_rooms_cache.get(room_id).confusion == {'Anna': 1}
@@ -0,0 +1,55 @@
+import uuid
+from datetime import datetime, timedelta
+
+import auth
+import session_sweeper
+from auth import login_user, verify_session
+from models import db, User, Session
+
+
+def make_sessions(user_id, expires_at, count):
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    db.session.add_all([Session(session_id=session_id, user_id=user_id, expires_at=expires_at) for session_id in ids])
+    db.session.commit()
+    return ids
+
+
+def test_sweep_deletes_expired_sessions_in_batches(app, login):
+    _, session = login()
+    user_id = session['user_id']
+    now = datetime.utcnow()
+    # Solo le sessioni di questo test (il database è condiviso con gli altri)
+    Session.query.filter(Session.expires_at < now).delete()
+    expired = make_sessions(user_id, now - timedelta(hours=1), 7)
+    alive = make_sessions(user_id, now + timedelta(hours=1), 3)
+    pauses = []
+
+    deleted = session_sweeper.sweep_expired(now=now, batch_size=3, pause=lambda: pauses.append(1))
+
+    assert deleted == 7
+    assert len(pauses) == 2  # lotti da 3, 3 e 1
+    remaining = {row.session_id for row in Session.query.filter_by(user_id=user_id)}
+    assert remaining.isdisjoint(expired)
+    assert set(alive) <= remaining
+    assert session['session_id'] in remaining
+
+
+def test_login_past_the_cap_evicts_the_oldest_session(app, login, monkeypatch):
+    monkeypatch.setattr(auth, 'SESSION_MAX_PER_USER', 2)
+    client, first = login()
+    user = db.session.get(User, first['user_id'])
+    oldest = first['session_id']
+    assert verify_session(oldest)[0] is not None  # ora anche in cache
+
+    # Le sessioni successive vengono create dopo questa
+    Session.query.filter_by(session_id=oldest).one().created_at = datetime.utcnow() - timedelta(minutes=10)
+    db.session.commit()
+    _, second, _ = login_user(user.username, 'password')
+    _, third, _ = login_user(user.username, 'password')
+
+    sessions = {row.session_id for row in Session.query.filter_by(user_id=user.id)}
+    assert sessions == {second, third}
+    # La sessione eliminata non vale più, nemmeno dalla cache
+    user_found, error = verify_session(oldest)
+    assert user_found is None and error
+    assert verify_session(third)[0] is not None
@@ -0,0 +1,84 @@
+import uuid
+
+import pytest
+
+import session_tokens
+from session_tokens import MemoryDenylist, RedisDenylist, SESSION_LIFETIME
+
+SECRET = 'segreto-di-prova'
+DAY = 24 * 3600
+LIFETIME = SESSION_LIFETIME.total_seconds()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Orologio di session_tokens spostabile a mano"""
+    class Clock:
+        now = 1_800_000_000.0
+
+    monkeypatch.setattr(session_tokens.time, 'time', lambda: Clock.now)
+    return Clock
+
+
+def claims_issued(clock, user_id=1):
+    token = session_tokens.issue_token(SECRET, user_id, 'anna', clock.now + LIFETIME)
+    return session_tokens.decode_token(SECRET, token, now=clock.now)
+
+
+def logout(claims):
+    session_tokens.denylist.revoke(claims['u'], claims['jti'], claims['exp'])
+
+
+def test_logout_with_an_older_token_keeps_newer_ones_revoked(clock, monkeypatch):
+    monkeypatch.setattr(session_tokens, 'denylist', MemoryDenylist())
+    start = clock.now
+    older = claims_issued(clock)
+    clock.now = start + 3 * DAY
+    newer = claims_issued(clock)
+
+    clock.now = start + 4 * DAY
+    logout(newer)
+    clock.now = start + 5 * DAY
+    logout(older)
+
+    # Il token più vecchio è scaduto, quello più recente no
+    clock.now = older['exp'] + DAY
+    session_tokens.denylist.revoke(2, 'altro', clock.now + LIFETIME)  # fa scattare la pulizia
+    assert clock.now < newer['exp']
+    assert session_tokens.is_revoked(newer)
+
+    # Passata la durata di una sessione dall'ultimo logout non serve più nulla
+    clock.now = start + 5 * DAY + LIFETIME + 1
+    session_tokens.denylist.revoke(2, 'altro-ancora', clock.now + LIFETIME)
+    assert session_tokens.denylist.stats() == {'revoked': 2, 'users': 1, 'sessions': 0}
+
+
+def test_last_logout_is_never_shortened_in_memory(clock):
+    denylist = MemoryDenylist()
+    denylist.revoke(1, 'b', clock.now + LIFETIME)
+    clock.now += DAY
+    denylist.revoke(1, 'a', clock.now + 60)
+
+    assert denylist.last_logout(1) == clock.now
+    assert denylist._last_logout[1][1] == clock.now + LIFETIME
+
+
+def test_redis_logout_ttl_is_the_session_lifetime(monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    monkeypatch.setattr(session_tokens.redis, 'Redis', fakeredis.FakeRedis)
+    denylist = RedisDenylist(f'redis://fake-{uuid.uuid4().hex[:8]}:6379/0')
+    monkeypatch.setattr(session_tokens, 'denylist', denylist)
+    client = denylist._client
+
+    newer = session_tokens.decode_token(
+        SECRET, session_tokens.issue_token(SECRET, 7, 'bruno', session_tokens.time.time() + LIFETIME))
+    older = session_tokens.decode_token(
+        SECRET, session_tokens.issue_token(SECRET, 7, 'bruno', session_tokens.time.time() + 30))
+    logout(newer)
+    logout(older)
+
+    # Il logout con il token quasi scaduto non accorcia la vita dell'ultimo logout
+    assert client.ttl('nte:logout:7') > LIFETIME - 60
+    assert client.ttl('nte:revoked:' + older['jti']) <= 31
+    assert session_tokens.is_revoked(newer)
+    assert session_tokens.is_revoked(older)
@@ -0,0 +1,117 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine, exc, text
+
+import sqlite_mode
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    """Coda del writer nuova per ogni test (le connessioni la leggono all'apertura)"""
+    gate = sqlite_mode.WriterGate(timeout=5)
+    monkeypatch.setattr(sqlite_mode, 'writer_gate', gate)
+    return gate
+
+
+@pytest.fixture
+def engine(gate, monkeypatch):
+    # Senza attese nel busy handler: ogni conflitto di lock diventerebbe subito "database is locked"
+    monkeypatch.setattr(sqlite_mode, 'BUSY_TIMEOUT_MS', 0)
+    path = os.path.join(tempfile.mkdtemp(prefix='nte-sqlite-'), 'test.db')
+    engine = create_engine(f'sqlite:///{path}', **sqlite_mode.engine_options())
+    sqlite_mode.configure_engine(engine)
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT NOT NULL)'))
+    yield engine
+    engine.dispose()
+
+
+def held(gate):
+    return gate._lock.locked()
+
+
+def test_production_pragmas(engine):
+    with engine.connect() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert conn.execute(text('PRAGMA synchronous')).scalar() == 1  # NORMAL
+        assert conn.execute(text('PRAGMA temp_store')).scalar() == 2  # MEMORY
+
+
+def test_gate_released_on_commit(engine, gate):
+    with engine.connect() as conn:
+        conn.execute(text("INSERT INTO items (value) VALUES ('a')"))
+        assert held(gate)
+        conn.commit()
+        assert not held(gate)
+
+
+def test_gate_released_on_rollback(engine, gate):
+    with engine.connect() as conn:
+        conn.execute(text("INSERT INTO items (value) VALUES ('a')"))
+        conn.rollback()
+        assert not held(gate)
+
+
+def test_gate_released_on_close(gate, tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'close.db'), factory=sqlite_mode.GatedConnection)
+    conn.enter_writer_queue()
+    assert held(gate)
+    conn.close()
+    assert not held(gate)
+
+
+def test_reads_do_not_enter_the_queue(engine, gate):
+    with engine.connect() as conn:
+        conn.execute(text('SELECT * FROM items')).all()
+        assert not held(gate)
+
+
+def test_failed_statement_does_not_leak_the_gate(engine, gate):
+    with pytest.raises(exc.IntegrityError):
+        with engine.begin() as conn:
+            conn.execute(text('INSERT INTO items (value) VALUES (NULL)'))
+    assert not held(gate)
+
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO items (value) VALUES ('dopo')"))
+    assert gate.stats()['timeouts'] == 0
+
+
+def test_concurrent_writers_are_serialized(engine, gate):
+    errors = []
+
+    def writer(name):
+        for i in range(10):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text('INSERT INTO items (value) VALUES (:v)'), {'v': f'{name}-{i}'})
+                    time.sleep(0.001)  # transazioni che si sovrappongono
+            except exc.OperationalError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(f'w{n}',)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with engine.connect() as conn:
+        assert conn.execute(text('SELECT COUNT(*) FROM items')).scalar() == 40
+    assert gate.stats()['acquisitions'] >= 40
+
+
+def test_second_connection_in_the_same_greenlet_fails_fast(engine, gate):
+    with engine.connect() as first, engine.connect() as second:
+        first.execute(text("INSERT INTO items (value) VALUES ('prima')"))
+        start = time.perf_counter()
+        with pytest.raises(exc.OperationalError, match='turno di scrittura'):
+            second.execute(text("INSERT INTO items (value) VALUES ('seconda')"))
+        assert time.perf_counter() - start < 1
+        first.commit()
+    assert not held(gate)
@@ -0,0 +1,113 @@
+import threading
+import uuid
+
+import pytest
+
+import state_backend
+from models import db, User, Room
+from room_state import RoomState, RoomStateRegistry
+from state_backend import MemoryStateBackend, RedisStateBackend, RoomNotLoaded
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def redis_url(monkeypatch):
+    """URL di un Redis finto (con Lua), condiviso da tutti i client con la stessa URL"""
+    monkeypatch.setattr(state_backend.redis, 'Redis', fakeredis.FakeRedis)
+    return f'redis://fake-{uuid.uuid4().hex[:8]}:6379/0'
+
+
+@pytest.fixture
+def db_room(app):
+    user = User(username=f'backend-{uuid.uuid4().hex[:8]}', password_hash='x')
+    db.session.add(user)
+    db.session.flush()
+    room = Room(room_id=uuid.uuid4().hex[:8], owner_id=user.id, bag_successi=4, bag_complicazioni=2)
+    db.session.add(room)
+    db.session.commit()
+    return room
+
+
+def test_memory_backend_does_not_invent_rooms():
+    backend = MemoryStateBackend()
+    with pytest.raises(RoomNotLoaded):
+        backend.get_bag('sconosciuta')
+
+    backend.init_room('stanza', 3, 1)
+    backend.discard('stanza')
+    with pytest.raises(RoomNotLoaded):
+        backend.compare_and_set_bag('stanza', 0, 0, 0)
+
+
+def test_evicted_room_is_reloaded_from_database(db_room):
+    registry = RoomStateRegistry(idle_ttl=0, backend=MemoryStateBackend())
+    state = registry.register(db_room)
+    state.set_bag(5, 3)
+    registry.flush()
+    registry.evict_idle()
+    assert db_room.room_id not in registry
+
+    # Un handler che tiene ancora il vecchio stato non vede un sacchetto vuoto
+    assert state.bag() == {'successi': 5, 'complicazioni': 3}
+    state.update_bag(lambda successi, complicazioni: (successi - 1, complicazioni, None))
+    assert state.bag() == {'successi': 4, 'complicazioni': 3}
+
+
+def test_redis_compare_and_set(redis_url):
+    worker_a = RedisStateBackend(redis_url)
+    worker_b = RedisStateBackend(redis_url)
+    worker_a.init_room('stanza', 4, 2, bag_version=7)
+    # init_room non sovrascrive una stanza già presente
+    worker_b.init_room('stanza', 0, 0)
+
+    successi, complicazioni, version = worker_b.get_bag('stanza')
+    assert (successi, complicazioni, version) == (4, 2, 7)
+
+    assert worker_a.compare_and_set_bag('stanza', 7, 3, 2)
+    # Versione ormai vecchia: il secondo worker deve rileggere
+    assert not worker_b.compare_and_set_bag('stanza', 7, 4, 1)
+    assert worker_b.get_bag('stanza') == (3, 2, 8)
+    assert worker_b.get_version('stanza') == 1
+
+
+def test_redis_missing_room(redis_url):
+    backend = RedisStateBackend(redis_url)
+    with pytest.raises(RoomNotLoaded):
+        backend.get_bag('scaduta')
+    with pytest.raises(RoomNotLoaded):
+        backend.compare_and_set_bag('scaduta', 0, 1, 1)
+    # Il compare-and-set fallito non lascia una stanza a metà
+    with pytest.raises(RoomNotLoaded):
+        backend.get_bag('scaduta')
+
+
+def test_redis_concurrent_draws_from_two_workers(redis_url):
+    states = [
+        RoomState(1, 'stanza', 1, bag_successi=200, bag_complicazioni=0, backend=RedisStateBackend(redis_url))
+        for _ in range(2)
+    ]
+
+    def draw_many(state):
+        for _ in range(50):
+            state.update_bag(lambda successi, complicazioni: (successi - 1, complicazioni, None), retries=100)
+
+    threads = [threading.Thread(target=draw_many, args=(state,)) for state in states for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Nessuna estrazione persa: 4 thread × 50
+    assert states[0].bag() == {'successi': 0, 'complicazioni': 0}
+    assert states[1].backend.get_bag('stanza')[2] == 200
+
+
+def test_redis_expired_room_is_reloaded_from_database(db_room, redis_url):
+    backend = RedisStateBackend(redis_url)
+    state = RoomState(db_room.id, db_room.room_id, db_room.owner_id,
+                      bag_successi=db_room.bag_successi, bag_complicazioni=db_room.bag_complicazioni,
+                      backend=backend)
+    backend._client.delete(backend._key(db_room.room_id))
+
+    assert state.bag() == {'successi': 4, 'complicazioni': 2}
@@ -0,0 +1,46 @@
+import pytest
+
+import wire_format
+from conftest import received
+
+pytest.importorskip('msgpack')
+
+
+@pytest.fixture
+def packed(monkeypatch):
+    """Payload impacchettati in MessagePack"""
+    calls = []
+    pack = wire_format.pack
+
+    def counting_pack(payload):
+        calls.append(payload)
+        return pack(payload)
+
+    monkeypatch.setattr(wire_format, 'pack', counting_pack)
+    return calls
+
+
+def test_no_msgpack_without_msgpack_clients(app, room, packed):
+    client, _, room_id = room()
+
+    client.emit('draw_tokens', {'room_id': room_id, 'num_tokens': 1, 'player_name': 'Anna'})
+
+    assert received(client, 'tokens_drawn')
+    assert packed == []
+
+
+def test_msgpack_only_for_msgpack_clients(app, room, socket_client, packed):
+    client, _, room_id = room()
+    compact_client = socket_client()
+    compact_client.emit('set_wire_format', {'format': 'msgpack'})
+    compact_client.emit('join_room', {'room_id': room_id, 'player_name': 'Bruno'})
+    compact_client.get_received()
+    packed.clear()
+
+    client.emit('draw_tokens', {'room_id': room_id, 'num_tokens': 1, 'player_name': 'Anna'})
+
+    # Un solo messaggio compatto per tutta la sotto-stanza msgpack
+    assert len(packed) == 1
+    assert isinstance(received(client, 'tokens_drawn')[0], dict)
+    (compact,) = received(compact_client, 'tokens_drawn')
+    assert isinstance(compact, bytes)
@@ -0,0 +1,158 @@
+"""
+Formato compatto (opzionale) dei messaggi Socket.IO.
+
+I client che lo chiedono con l'evento 'set_wire_format' ({'format':
+'msgpack'}) ricevono gli eventi più pesanti (room_joined, tokens_drawn,
+risk_all_result, characters_loaded) come un unico allegato binario
+MessagePack con uno schema senza duplicati:
+
+- token come interi: 1 = successo, 0 = complicazione
+- niente blocco 'history' ripetuto: l'estrazione è già la voce di storico
+- chiavi corte e timestamp in millisecondi (UTC)
+
+Estrazione (tokens_drawn, risk_all_result e voci di storico):
+    {'p': giocatore, 'd': [1, 0, ...], 's': successi, 'c': complicazioni,
+     't': timestamp_ms, 'a': adrenalina, 'f': confusione, 'r': rischia_tutto,
+     'b': [successi, complicazioni] sacchetto rimanente (solo eventi),
+     'ts'/'tc': totali cumulativi (solo risk_all_result)}
+
+Gli altri client continuano a ricevere JSON invariato. Ogni socket entra,
+oltre che nella stanza, nella sotto-stanza del proprio formato
+('<room_id>#json' o '<room_id>#msgpack'): i broadcast pesanti vengono
+inviati alle due sotto-stanze, ognuna nel suo formato. Il messaggio
+MessagePack viene costruito solo se la sotto-stanza msgpack ha membri (con
+una coda messaggi i membri possono essere su altri worker, e si invia
+sempre).
+"""
+from datetime import datetime, timezone
+
+from flask import current_app, session
+from flask_socketio import emit, join_room, leave_room
+from socketio import PubSubManager
+
+try:
+    import msgpack
+except ImportError:  # msgpack opzionale: senza, solo JSON
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+TOKEN_CODES = {'complicazione': 0, 'successo': 1}
+
+
+def available_formats():
+    """Formati supportati dal server"""
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def get_format():
+    """Formato negoziato dal socket corrente"""
+    return session.get('wire_format', JSON)
+
+
+def format_room(room_id, wire_format):
+    """Sotto-stanza dei socket di una stanza che usano il formato indicato"""
+    return f'{room_id}#{wire_format}'
+
+
+def join_format_room(room_id):
+    """Fa entrare il socket corrente nella sotto-stanza del suo formato"""
+    join_room(format_room(room_id, get_format()))
+
+
+def set_format(wire_format, room_ids=()):
+    """Imposta il formato del socket corrente e ne sposta le sotto-stanze"""
+    previous = get_format()
+    session['wire_format'] = wire_format
+    if previous != wire_format:
+        for room_id in room_ids:
+            leave_room(format_room(room_id, previous))
+            join_room(format_room(room_id, wire_format))
+
+
+def pack(payload):
+    """Payload compatto codificato in MessagePack"""
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def _timestamp_ms(value):
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def compact_draw(entry, bag=None, totals=None):
+    """Estrazione o voce di storico nello schema compatto"""
+    compact = {
+        'p': entry.get('player'),
+        'd': [TOKEN_CODES.get(token, 0) for token in entry.get('drawn') or []],
+        's': entry.get('successi'),
+        'c': entry.get('complicazioni'),
+        't': _timestamp_ms(entry.get('timestamp')),
+        'a': bool(entry.get('adrenaline')),
+        'f': bool(entry.get('confusion')),
+        'r': bool(entry.get('risk_all'))
+    }
+    if bag is not None:
+        compact['b'] = [bag['successi'], bag['complicazioni']]
+    if totals is not None:
+        compact['ts'], compact['tc'] = totals
+    return compact
+
+
+def compact_tokens_drawn(result):
+    return compact_draw(result['history'], bag=result['bag_remaining'])
+
+
+def compact_risk_all_result(result):
+    return compact_draw(
+        result['history'],
+        bag=result['bag_remaining'],
+        totals=(result['total_successi'], result['total_complicazioni'])
+    )
+
+
+def compact_room_joined(payload):
+    room_data = payload['room_data']
+    return {
+        'r': payload['room_id'],
+        'p': payload['player_name'],
+        'pl': room_data['players'],
+        'o': room_data['owner_name'],
+        'b': [room_data['bag']['successi'], room_data['bag']['complicazioni']],
+        'h': [compact_draw(entry) for entry in room_data['history']]
+    }
+
+
+def compact_characters_loaded(payload):
+    compact = {'ch': payload['characters']}
+    if 'is_master' in payload:
+        compact['m'] = payload['is_master']
+    return compact
+
+
+def emit_to_client(event, payload, compact):
+    """Invia un evento al socket corrente nel formato che ha negoziato"""
+    if get_format() == MSGPACK and msgpack is not None:
+        emit(event, pack(compact(payload)))
+    else:
+        emit(event, payload)
+
+
+def _has_members(room):
+    """True se qualche socket (di questo o, con la coda messaggi, di altri worker) è nella stanza"""
+    manager = current_app.extensions['socketio'].server.manager
+    if isinstance(manager, PubSubManager):
+        # Il manager conosce solo i socket di questo worker
+        return True
+    return next(manager.get_participants('/', room), None) is not None
+
+
+def emit_to_room(event, payload, room_id, compact):
+    """Broadcast di un evento a una stanza, un messaggio per formato"""
+    emit(event, payload, room=format_room(room_id, JSON))
+    if msgpack is not None and _has_members(format_room(room_id, MSGPACK)):
+        emit(event, pack(compact(payload)), room=format_room(room_id, MSGPACK))